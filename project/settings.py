@@ -80,6 +80,10 @@ STATICFILES_FINDERS = (
 #    'django.contrib.staticfiles.finders.DefaultStorageFinder',
 )
 
+# Absolute filesystem path to the directory that will hold user-uploaded files,
+# such as TBX files waiting to be imported.
+MEDIA_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media')
+
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = 'e_d&6)l3hqg+336*+j$id*0s_q5i36webcq@hs4+5uztfuzc)b'
 
@@ -95,6 +99,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'simple_history.middleware.HistoryRequestMiddleware',
+    'terminator.replicas.ReplicaMiddleware',
 ]
 ROOT_URLCONF = 'urls'
 
@@ -196,6 +201,31 @@ FEATURES = {
         'collaboration': True,
 }
 
+# Import uploaded TBX files in the background. This requires the job worker to
+# be running:
+#     python manage.py run_import_jobs
+# Set to False to import during the upload request instead.
+IMPORT_IN_BACKGROUND = True
+
+# Exported TBX files are kept here (compressed) until something changes in
+# their glossaries, so that repeated downloads don't have to be generated
+# again. The files can be removed at any time. Set to None to disable.
+EXPORT_CACHE_DIR = os.path.join(BASE_DIR, 'export_cache')
+
+# The class used for partial (substring) searches of terms. By default the
+# trigram index is used on PostgreSQL, and an in-memory n-gram index otherwise
+# (see terminator/search.py). Every process keeps its in-memory indexes up to
+# date with the changes recorded in the database, without a shared cache.
+SEARCH_BACKEND = None
+
+# Aliases in DATABASES of read-only replicas of the default database. Pages
+# like search results, glossaries and feeds are then read from a replica,
+# except for DATABASE_REPLICA_PIN_SECONDS after a session changed something
+# (see terminator/replicas.py).
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_PIN_SECONDS = 10
+DATABASE_ROUTERS = ['terminator.replicas.ReplicaRouter']
+
 
 # Get local overrides
 try:
@@ -21,6 +21,7 @@ from django.contrib import admin
 from django.contrib.admin.utils import quote
 from django.core.exceptions import PermissionDenied
 from django.core.mail import send_mail
+from django.db import transaction
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.utils.encoding import force_text
@@ -682,6 +683,7 @@ class ProposalAdmin(ChangePermissionFromQS, admin.ModelAdmin):
                                         Glossary, False)
         return qs.filter(for_glossary__in=inner_qs)
 
+    @transaction.atomic
     def convert_proposals(self, request, queryset):
         for proposal in queryset:
             concept = Concept(glossary=proposal.for_glossary)
@@ -925,4 +927,17 @@ if settings.FEATURES.get('collaboration', False):
     admin.site.register(CollaborationRequest, CollaborationRequestAdmin)
 
 
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('glossary_name', 'user', 'status', 'concept_count', 'created', 'finished')
+    ordering = ('-created',)
+    list_filter = ['status']
+    readonly_fields = ('glossary_name', 'glossary_description', 'source_language',
+                       'user', 'glossary', 'status', 'concept_count', 'error',
+                       'created', 'started', 'finished')
+    exclude = ('imported_file',)
 
+    def has_add_permission(self, request):
+        return False
+
+if settings.FEATURES.get('import_tbx', False):
+    admin.site.register(ImportJob, ImportJobAdmin)
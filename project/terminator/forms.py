@@ -41,6 +41,15 @@ class AdvancedSearchForm(SearchForm):
     also_show_partial_matches = forms.BooleanField(required=False,
         label=_("Also show partial matches")
     )
+    max_differences = forms.TypedChoiceField(
+        required=False, coerce=int, empty_value=0,
+        choices=(
+            (0, _("none")),
+            (1, _("1 letter")),
+            (2, _("2 letters")),
+        ),
+        label=_("Allow spelling differences")
+    )
     filter_by_glossary = forms.ModelChoiceField(
         queryset=Glossary.objects.all(), required=False,
         label=_("Filter by glossary")
@@ -62,6 +71,9 @@ class AdvancedSearchForm(SearchForm):
     )
 
 
+GLOSSARY_NAME_TAKEN = _(u"Already exists a glossary with the given name. You should provide another one.")
+
+
 class ImportForm(forms.ModelForm):
     imported_file = forms.FileField(label=_("File"))
 
@@ -72,8 +84,13 @@ class ImportForm(forms.ModelForm):
     def clean(self):
         super(forms.ModelForm, self).clean()
         cleaned_data = self.cleaned_data
-        if Glossary.objects.filter(name=cleaned_data.get("name")):
-            msg = _(u"Already exists a glossary with the given name. You should provide another one.")
+        name = cleaned_data.get("name")
+        msg = None
+        if Glossary.objects.filter(name=name):
+            msg = GLOSSARY_NAME_TAKEN
+        elif ImportJob.objects.filter(glossary_name=name, status__in=[ImportJob.PENDING, ImportJob.RUNNING]):
+            msg = _(u"A glossary with the given name is already being imported. You should provide another one.")
+        if msg:
             self._errors["name"] = self.error_class([msg])
             # This field is no longer valid. So remove it from the cleaned data.
             del cleaned_data["name"]
@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from terminator.models import Concept, Definition, Glossary, Language, Translation
+from terminator.views import attach_definitions
+from terminator.views.tbx_import import bulk_create_with_ids
+
+
+BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = ("Compare the ways of getting the definitions for pages of search "
+            "results on generated data. Nothing is kept in the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+                '--terms',
+                type=int,
+                default=1000000,
+                help="The number of terms to generate (default: 1000000).",
+        )
+        parser.add_argument(
+                '--words',
+                type=int,
+                default=1000,
+                help="The number of different terms (default: 1000).",
+        )
+        parser.add_argument(
+                '--searches',
+                type=int,
+                default=100,
+                help="The number of searches to time (default: 100).",
+        )
+        parser.add_argument(
+                '--page-size',
+                type=int,
+                default=100,
+                help="The number of results on a page (default: 100).",
+        )
+
+    def generate(self, terms, words):
+        """
+        Two terms (English and Galician) for every concept, and a definition
+        for every second concept in every language.
+        """
+        english = Language.objects.get_or_create(pk='en', defaults={'name': 'English'})[0]
+        galician = Language.objects.get_or_create(pk='gl', defaults={'name': 'Galician'})[0]
+        glossary = Glossary.objects.create(name="benchmark_search", description="")
+        scope = Concept.objects.filter(glossary=glossary)
+        for start in range(0, terms // 2, BATCH_SIZE):
+            count = min(BATCH_SIZE, terms // 2 - start)
+            concepts = [Concept(glossary=glossary) for _ in range(count)]
+            bulk_create_with_ids(Concept, concepts, scope)
+            translations = []
+            definitions = []
+            for i, concept in enumerate(concepts, start):
+                for language in (english, galician):
+                    text = "%s term %d" % (language.pk, i % words)
+                    translations.append(Translation(
+                            concept=concept,
+                            language=language,
+                            translation_text=text,
+                            search_key=text,
+                    ))
+                    if i % 2:
+                        definitions.append(Definition(
+                                concept=concept,
+                                language=language,
+                                text="Definition %d" % i,
+                        ))
+            Translation.objects.bulk_create(translations)
+            Definition.objects.bulk_create(definitions)
+
+    def with_subquery(self, qs):
+        definition = Definition.objects.filter(
+                concept=OuterRef('concept'),
+                language=OuterRef('language'),
+        )
+        page = list(qs.annotate(definition=Subquery(definition.values('text'))))
+        return [t.definition for t in page]
+
+    def batched(self, qs):
+        page = list(qs)
+        attach_definitions(page)
+        return [t.definition for t in page]
+
+    def handle(self, *args, **options):
+        if options['terms'] < 2 or options['words'] < 1:
+            raise CommandError("Give at least 2 terms and 1 word.")
+        strategies = [
+                ("correlated subquery", self.with_subquery),
+                ("batched lookup", self.batched),
+        ]
+        with transaction.atomic():
+            start = time.time()
+            self.generate(options['terms'], options['words'])
+            self.stdout.write("Generated %d terms in %.1f s." % (
+                    options['terms'], time.time() - start))
+
+            timings = dict((name, 0.0) for name, _strategy in strategies)
+            for i in range(options['searches']):
+                search_key = "en term %d" % (i % options['words'])
+                qs = Translation.objects.filter(search_key=search_key)
+                qs = qs.order_by('concept_id', 'language_id', 'pk')[:options['page_size']]
+                results = []
+                for name, strategy in strategies:
+                    start = time.time()
+                    results.append(strategy(qs))
+                    timings[name] += time.time() - start
+                if results[0] != results[1]:
+                    raise CommandError("The strategies found different definitions for \"%s\"." % search_key)
+
+            for name, _strategy in strategies:
+                self.stdout.write("%s: %.2f ms per page" % (
+                        name, timings[name] * 1000 / max(options['searches'], 1)))
+            transaction.set_rollback(True)
@@ -0,0 +1,162 @@
+# -*- coding: UTF-8 -*-
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import re
+import sys
+import time
+import zipfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from terminator.models import Glossary, Language
+from terminator.views.tbx_export import export_cache_key, export_parallel, write_through_cache
+
+
+def zip_member_name(glossary, taken):
+    """
+    A file name for the glossary in a zip file, without directories or
+    characters that are special in file names, and not in taken yet.
+    """
+    name = re.sub(r'[^\w\-. ]+', '_', glossary.name, flags=re.UNICODE).strip('. ') or "glossary"
+    if name.lower() in taken:
+        name = "%s-%d" % (name, glossary.pk)
+    taken.add(name.lower())
+    return "%s.tbx" % name
+
+
+class Command(BaseCommand):
+    help = ("Export glossaries (all of them by default) to TBX, rendering "
+            "every glossary in a separate process.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+                'glossaries',
+                nargs='*',
+                help="The glossaries to export (ids or names).",
+        )
+        parser.add_argument(
+                '-o', '--output',
+                default='-',
+                help="The file to write to, or - for stdout (the default).",
+        )
+        parser.add_argument(
+                '--language',
+                action='append',
+                dest='languages',
+                default=[],
+                help="A language to export. Can be given more than once.",
+        )
+        parser.add_argument(
+                '--terms',
+                default='all',
+                choices=['all', 'preferred', 'preferred+admitted', 'preferred+admitted+not_recommended'],
+                help="Which terms to export (default: all).",
+        )
+        parser.add_argument(
+                '--all-definitions',
+                action='store_true',
+                help="Also export definitions that are not finalized.",
+        )
+        parser.add_argument(
+                '--processes',
+                type=int,
+                default=multiprocessing.cpu_count(),
+                help="The number of worker processes (default: the number of CPUs).",
+        )
+        parser.add_argument(
+                '--zip',
+                action='store_true',
+                help="Write a zip file with a TBX file for every glossary.",
+        )
+        parser.add_argument(
+                '--cache',
+                action='store_true',
+                help="Store the export in EXPORT_CACHE_DIR, from where the web "
+                     "site serves the same export.",
+        )
+
+    def get_glossaries(self, lookups):
+        if not lookups:
+            return list(Glossary.objects.all())
+        glossaries = []
+        for lookup in lookups:
+            qs = Glossary.objects.filter(name=lookup)
+            if lookup.isdigit():
+                qs = qs | Glossary.objects.filter(pk=lookup)
+            try:
+                glossaries.append(qs.get())
+            except Glossary.DoesNotExist:
+                raise CommandError("Glossary \"%s\" does not exist." % lookup)
+        return glossaries
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1:
+            raise CommandError("The number of processes must be at least 1.")
+        if options['zip'] and options['cache']:
+            raise CommandError("--zip can not be combined with --cache.")
+        if options['cache'] and not getattr(settings, 'EXPORT_CACHE_DIR', None):
+            raise CommandError("EXPORT_CACHE_DIR is not set.")
+        glossaries = self.get_glossaries(options['glossaries'])
+        if not glossaries:
+            raise CommandError("There are no glossaries to export.")
+        languages = list(Language.objects.filter(pk__in=options['languages']))
+        if len(languages) != len(set(options['languages'])):
+            raise CommandError("Unknown language in: %s" % ", ".join(options['languages']))
+        start = time.time()
+
+        export_args = (glossaries, languages, options['all_definitions'], options['terms'])
+        parts = export_parallel(
+                *export_args,
+                processes=options['processes'],
+                separate_files=options['zip']
+        )
+        if options['cache']:
+            cache_dir = settings.EXPORT_CACHE_DIR
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            cache_key, _last_modified = export_cache_key(*export_args)
+            cache_path = os.path.join(cache_dir, cache_key + '.tbx.gz')
+            for _chunk in write_through_cache(parts, cache_path):
+                pass
+            output_name = cache_path
+        else:
+            if options['output'] == '-':
+                output = getattr(sys.stdout, 'buffer', sys.stdout)
+                output_name = "stdout"
+            else:
+                output = open(options['output'], 'wb')
+                output_name = options['output']
+            try:
+                if options['zip']:
+                    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                        names = set()
+                        for glossary, path in parts:
+                            zip_file.write(path, zip_member_name(glossary, names))
+                else:
+                    for chunk in parts:
+                        output.write(chunk.encode('utf-8'))
+            finally:
+                if options['output'] != '-':
+                    output.close()
+
+        if options['verbosity'] > 0 and (options['cache'] or options['output'] != '-'):
+            self.stdout.write("Exported %d glossaries to %s in %.1f s." % (
+                    len(glossaries),
+                    output_name,
+                    time.time() - start))
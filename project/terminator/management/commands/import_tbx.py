@@ -0,0 +1,151 @@
+# -*- coding: UTF-8 -*-
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.encoding import force_text
+
+from terminator.models import Glossary, Language
+from terminator.views.tbx_import import IMPORT_BATCH_SIZE, TBXImporter
+
+
+class Command(BaseCommand):
+    help = "Import a TBX file from disk (or stdin) into a new or existing glossary."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+                'path',
+                help="The TBX file to import, or - to read from stdin.",
+        )
+        parser.add_argument(
+                '--glossary',
+                help="Import into this existing glossary (id or name) instead of creating one.",
+        )
+        parser.add_argument('--name', help="The name of the new glossary.")
+        parser.add_argument(
+                '--description',
+                default="",
+                help="The description of the new glossary.",
+        )
+        parser.add_argument(
+                '--source-language',
+                default='en',
+                help="The source language of the new glossary (default: en).",
+        )
+        parser.add_argument(
+                '--batch-size',
+                type=int,
+                default=IMPORT_BATCH_SIZE,
+                help="Concepts to write per batch (default: %d)." % IMPORT_BATCH_SIZE,
+        )
+        parser.add_argument(
+                '--dry-run',
+                action='store_true',
+                help="Check the file without saving anything.",
+        )
+        parser.add_argument(
+                '--merge',
+                action='store_true',
+                help="Update the concepts of the --glossary that have the same "
+                     "termEntry id instead of adding them again.",
+        )
+
+    def get_glossary(self, options):
+        if options['glossary']:
+            lookup = options['glossary']
+            glossaries = Glossary.objects.filter(name=lookup)
+            if lookup.isdigit():
+                glossaries = glossaries | Glossary.objects.filter(pk=lookup)
+            try:
+                return glossaries.get()
+            except Glossary.DoesNotExist:
+                raise CommandError("Glossary \"%s\" does not exist." % lookup)
+        if not options['name']:
+            raise CommandError("Provide either --glossary or --name.")
+        if Glossary.objects.filter(name=options['name']).exists():
+            raise CommandError("A glossary named \"%s\" already exists." % options['name'])
+        if not Language.objects.filter(pk=options['source_language']).exists():
+            raise CommandError("There is no language with code \"%s\"." % options['source_language'])
+        glossary = Glossary(
+                name=options['name'],
+                description=options['description'],
+                source_language_id=options['source_language'],
+        )
+        glossary.save()
+        return glossary
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("The batch size must be at least 1.")
+        if options['merge'] and not options['glossary']:
+            raise CommandError("--merge can only be used with --glossary.")
+        verbosity = options['verbosity']
+        start = time.time()
+
+        def report_progress(importer):
+            if verbosity > 1:
+                elapsed = time.time() - start
+                self.stdout.write("%d concepts (%.0f concepts/s)" % (
+                        importer.concept_count,
+                        importer.concept_count / max(elapsed, 0.001)))
+
+        if options['path'] == '-':
+            tbx_file = getattr(sys.stdin, 'buffer', sys.stdin)
+        else:
+            try:
+                tbx_file = open(options['path'], 'rb')
+            except IOError as e:
+                raise CommandError(force_text(e))
+
+        try:
+            with transaction.atomic():
+                glossary = self.get_glossary(options)
+                importer = TBXImporter(
+                        glossary,
+                        batch_size=options['batch_size'],
+                        progress=report_progress,
+                        merge=options['merge'],
+                )
+                importer.import_file(tbx_file)
+                if options['dry_run']:
+                    transaction.set_rollback(True)
+        except CommandError:
+            raise
+        except Exception as e:
+            raise CommandError("The import process failed:\n\n%s" %
+                               (force_text(e.args[0]) if e.args else force_text(e)))
+        finally:
+            if options['path'] != '-':
+                tbx_file.close()
+
+        elapsed = time.time() - start
+        if options['dry_run']:
+            message = "Checked %d concepts in %.1f s (%.0f concepts/s). Nothing was saved."
+        else:
+            message = "Imported %d concepts in %.1f s (%.0f concepts/s)."
+        if verbosity > 0:
+            self.stdout.write(message % (
+                    importer.concept_count,
+                    elapsed,
+                    importer.concept_count / max(elapsed, 0.001)))
+            if options['merge']:
+                self.stdout.write("%d added, %d updated, %d unchanged." % (
+                        importer.created_count,
+                        importer.updated_count,
+                        importer.concept_count - importer.created_count - importer.updated_count))
@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from terminator.models import (Concept, ConceptSnapshot, Glossary,
+                               snapshots_changed, update_repr_caches)
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the cached representation of the concepts in glossaries "
+            "(all of them by default) and the snapshots of their pages, "
+            "for example after terms were changed directly in the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+                'glossaries',
+                nargs='*',
+                help="The glossaries to rebuild (ids or names).",
+        )
+        parser.add_argument(
+                '--all-snapshots',
+                action='store_true',
+                help="Also build the snapshots of the source language pages "
+                     "of all concepts, instead of only the existing ones.",
+        )
+
+    def get_glossaries(self, lookups):
+        if not lookups:
+            return list(Glossary.objects.all())
+        glossaries = []
+        for lookup in lookups:
+            qs = Glossary.objects.filter(name=lookup)
+            if lookup.isdigit():
+                qs = qs | Glossary.objects.filter(pk=lookup)
+            try:
+                glossaries.append(qs.get())
+            except Glossary.DoesNotExist:
+                raise CommandError("Glossary \"%s\" does not exist." % lookup)
+        return glossaries
+
+    def handle(self, *args, **options):
+        for glossary in self.get_glossaries(options['glossaries']):
+            with transaction.atomic():
+                count = update_repr_caches(Concept.objects.filter(glossary=glossary))
+                # Built again after the commit
+                snapshots = ConceptSnapshot.objects.filter(concept__glossary=glossary)
+                snapshots_changed(snapshots.values_list('concept_id', 'language_id'))
+                snapshots.delete()
+                if options['all_snapshots']:
+                    concept_ids = Concept.objects.filter(glossary=glossary).values_list('pk', flat=True)
+                    snapshots_changed((pk, glossary.source_language_id) for pk in concept_ids)
+            if options['verbosity'] > 0:
+                self.stdout.write("Rebuilt %d concepts in %s." % (count, glossary))
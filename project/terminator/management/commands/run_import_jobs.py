@@ -0,0 +1,57 @@
+# -*- coding: UTF-8 -*-
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from terminator.models import ImportJob
+from terminator.views.tbx_import import claim_import_job, run_import_job
+
+
+class Command(BaseCommand):
+    help = "Run the TBX import jobs uploaded through the import page."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+                '--once',
+                action='store_true',
+                help="Stop when there are no pending jobs instead of waiting for new ones.",
+        )
+        parser.add_argument(
+                '--interval',
+                type=float,
+                default=5.0,
+                help="Seconds to wait before checking for new jobs again (default: 5).",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job = claim_import_job()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+                continue
+            self.stdout.write("Importing \"%s\" (job %d)" % (job.glossary_name, job.pk))
+            run_import_job(job)
+            if job.status == ImportJob.SUCCEEDED:
+                self.stdout.write("Imported %d concepts in %.1f s" % (
+                        job.concept_count, job.elapsed().total_seconds()))
+            else:
+                self.stderr.write("Import failed: %s" % job.error)
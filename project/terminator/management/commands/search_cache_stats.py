@@ -0,0 +1,45 @@
+# -*- coding: UTF-8 -*-
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+
+from terminator.search import search_cache_stats
+
+
+class Command(BaseCommand):
+    help = "Show how often searches were answered from the cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+                '--reset',
+                action='store_true',
+                help="Start counting again.",
+        )
+
+    def handle(self, *args, **options):
+        if isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache):
+            # The counters of the web server processes are not in this one.
+            self.stderr.write(
+                    "Warning: the cache is local to every process, so this only "
+                    "counts the searches of this command. Configure a cache that "
+                    "is shared between processes (like memcached) in CACHES."
+            )
+        hits, misses = search_cache_stats(reset=options['reset'])
+        total = hits + misses
+        ratio = 100.0 * hits / total if total else 0.0
+        self.stdout.write("%d hits, %d misses (%.1f%% hits)" % (hits, misses, ratio))
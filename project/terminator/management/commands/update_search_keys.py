@@ -0,0 +1,57 @@
+# -*- coding: UTF-8 -*-
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+
+from terminator.models import Translation, bulk_update_field, make_search_key
+from terminator.search import translations_changed
+
+
+class Command(BaseCommand):
+    help = ("Fill in the search keys of terms, for example after they were "
+            "changed directly in the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+                '--batch-size',
+                type=int,
+                default=5000,
+                help="The number of terms to check at a time (default: 5000).",
+        )
+
+    def handle(self, *args, **options):
+        terms = Translation.objects.order_by('pk').values_list('pk', 'translation_text', 'search_key')
+        last_pk = 0
+        checked = 0
+        updated = 0
+        while True:
+            batch = list(terms.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            keys = {}
+            for pk, text, search_key in batch:
+                new_key = make_search_key(text)
+                if new_key != search_key:
+                    keys[pk] = new_key
+            bulk_update_field(Translation, 'search_key', keys)
+            checked += len(batch)
+            updated += len(keys)
+        if updated:
+            # The in-memory indexes of all processes are built again.
+            translations_changed()
+        if options['verbosity'] > 0:
+            self.stdout.write("Updated %d of %d search keys." % (updated, checked))
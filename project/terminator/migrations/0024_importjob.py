@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('terminator', '0023_rename_glossary_permissions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('imported_file', models.FileField(upload_to='imports/', verbose_name='file')),
+                ('glossary_name', models.CharField(max_length=50, verbose_name='glossary name')),
+                ('glossary_description', models.TextField(verbose_name='glossary description')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=10, verbose_name='status')),
+                ('concept_count', models.PositiveIntegerField(default=0, verbose_name='concepts processed')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='started')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='finished')),
+                ('glossary', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='terminator.Glossary', verbose_name='glossary')),
+                ('source_language', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='terminator.Language', verbose_name='source language')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'ordering': ['id'],
+                'verbose_name': 'import job',
+                'verbose_name_plural': 'import jobs',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminator', '0024_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='concept',
+            name='import_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='concept',
+            name='tbx_id',
+            field=models.CharField(blank=True, editable=False, max_length=100, verbose_name='TBX id'),
+        ),
+        migrations.AlterIndexTogether(
+            name='concept',
+            index_together=set([('glossary', 'tbx_id')]),
+        ),
+    ]
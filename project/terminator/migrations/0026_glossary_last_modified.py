@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminator', '0025_concept_tbx_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='glossary',
+            name='last_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='last modified'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# The search view uses icontains, which PostgreSQL does as
+# UPPER("translation_text"::text) LIKE UPPER(...), so that is what we index.
+# Creating the extension might need a database superuser.
+def create_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.execute(
+        "CREATE INDEX terminator_translation_text_trgm "
+        "ON terminator_translation "
+        "USING gin (UPPER(translation_text::text) gin_trgm_ops)"
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS terminator_translation_text_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminator', '0026_glossary_last_modified'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+# Copies of terminator.models.make_search_key() and bulk_update_field() as
+# they were, since migrations must not change with the models.
+def make_search_key(text):
+    text = getattr(text, 'casefold', text.lower)()
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return text[:255]
+
+
+def bulk_update_field(model, field_name, values, batch_size=300):
+    field = model._meta.get_field(field_name)
+    values = list(values.items())
+    # Every object needs three query parameters, which must stay below the
+    # default SQLite limit of 999.
+    for i in range(0, len(values), batch_size):
+        batch = values[i:i+batch_size]
+        model.objects.filter(pk__in=[pk for pk, value in batch]).update(**{
+            field_name: models.Case(
+                *[models.When(pk=pk, then=models.Value(value)) for pk, value in batch],
+                output_field=field
+            )
+        })
+
+
+def fill_search_keys(apps, schema_editor):
+    Translation = apps.get_model('terminator', 'Translation')
+    terms = Translation.objects.order_by('pk').values_list('pk', 'translation_text')
+    last_pk = 0
+    while True:
+        batch = list(terms.filter(pk__gt=last_pk)[:5000])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        bulk_update_field(Translation, 'search_key', dict(
+                (pk, make_search_key(text)) for (pk, text) in batch
+        ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminator', '0027_translation_trigram_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='translation',
+            name='search_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(fill_search_keys, migrations.RunPython.noop),
+    ]
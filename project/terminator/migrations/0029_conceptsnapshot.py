@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminator', '0028_translation_search_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConceptSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.TextField()),
+                ('concept', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='terminator.Concept')),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='terminator.Language')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='conceptsnapshot',
+            unique_together=set([('concept', 'language')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# For fuzzy searches with the % operator of pg_trgm (see
+# TrigramSearchBackend.fuzzy_match()). The extension was created in 0027.
+def create_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "CREATE INDEX terminator_translation_search_key_trgm "
+        "ON terminator_translation "
+        "USING gin (search_key gin_trgm_ops)"
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS terminator_translation_search_key_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminator', '0031_termchange'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminator', '0032_translation_search_key_trigram_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='glossary',
+            name='navigation_version',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
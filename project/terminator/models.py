@@ -21,21 +21,33 @@ from __future__ import unicode_literals
 from django.contrib.admin.models import LogEntry
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
-from django.db.models import Field, Transform
-from django.db.models.signals import post_delete
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Field, IntegerField, Q, Transform, Value, When
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from django.urls import reverse
+from django.utils.dateparse import parse_datetime
 from django.utils.encoding import force_text, python_2_unicode_compatible
 from django.utils.html import format_html, mark_safe
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
 from guardian.shortcuts import assign_perm, get_users_with_perms
 from simple_history.models import HistoricalRecords
 
+from terminator.replicas import use_primary
+
+import array
+import bisect
+import functools
 import itertools
+import json
+import operator
 import re
+import threading
+import unicodedata
 
 @python_2_unicode_compatible
 class PartOfSpeech(models.Model):
@@ -195,6 +207,11 @@ class Glossary(models.Model):
     # limit_choices_to = {'glossary__exact': self} in order to reduce the
     # options shown in the admin site.
     subject_fields = models.ManyToManyField('Concept', related_name='glossary_subject_fields', blank=True, verbose_name=_("subject fields"))
+    # Updated whenever anything in the glossary changes, see touch_glossary()
+    last_modified = models.DateTimeField(default=now, editable=False, verbose_name=_("last modified"))
+    # Incremented whenever the navigation between its concepts changes, see
+    # navigation_changed()
+    navigation_version = models.IntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name = _("glossary")
@@ -208,6 +225,16 @@ class Glossary(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.last_modified = now()
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Don't undo an increment since this instance was loaded
+            kwargs['update_fields'] = [
+                    f.name for f in self._meta.concrete_fields
+                    if not f.primary_key and f.name != 'navigation_version'
+            ]
+        super(Glossary, self).save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('terminator_glossary_detail', kwargs={'pk': self.pk})
 
@@ -276,11 +303,17 @@ class Concept(models.Model):
     # This keeps a readable version cached in this table so that no joining
     # with Translation is required for a human readable form.
     repr_cache = models.CharField(max_length=200, editable=False, null=True, blank=True, verbose_name=_("representation"))
+    # The termEntry id and a hash of what was imported from the termEntry in
+    # the last TBX import, so that a later import can merge changes into this
+    # concept.
+    tbx_id = models.CharField(max_length=100, blank=True, editable=False, verbose_name=_("TBX id"))
+    import_hash = models.CharField(max_length=40, blank=True, editable=False)
 
     class Meta:
         verbose_name = _("concept")
         verbose_name_plural = _("concepts")
         ordering = ['id']
+        index_together = [('glossary', 'tbx_id')]
 
     def __str__(self):
         if self.repr_cache:
@@ -312,40 +345,161 @@ class Concept(models.Model):
                     is_finalized=True,
         ).exists()
 
+    def neighbours(self, before, after):
+        """
+        Up to `before` concepts before this one in the glossary, and up to
+        `after` concepts from this one on, with only their id and repr_cache.
+        """
+        if connection.in_atomic_block:
+            # The navigation index only learns of committed changes
+            previous_concepts = Concept.objects.filter(
+                    glossary=self.glossary_id,
+                    id__lt=self.pk,
+            ).only("id", "repr_cache").order_by('-id')[:before]
+            next_concepts = Concept.objects.filter(
+                    glossary=self.glossary_id,
+                    id__gte=self.pk,
+            ).only("id", "repr_cache").order_by('id')[:after]
+            return list(reversed(previous_concepts)) + list(next_concepts)
+
+        ids, reprs = glossary_navigation(self.glossary_id)
+        i = bisect.bisect_left(ids, self.pk)
+        return [
+                Concept(id=ids[j], glossary_id=self.glossary_id, repr_cache=reprs[j])
+                for j in range(max(i - before, 0), min(i + after, len(ids)))
+        ]
+
     def prev_concept(self):
         """The previous concept in the same glossary."""
-        return Concept.objects.filter(
-                glossary=self.glossary,
-                id__lt=self.id,
-        ).only("id", "repr_cache").order_by('-id').first()
+        previous_concepts = self.neighbours(1, 0)
+        return previous_concepts[0] if previous_concepts else None
 
     def next_concept(self):
         """The next concept in the same glossary."""
-        return Concept.objects.filter(
-                glossary=self.glossary,
-                id__gt=self.id,
-        ).only("id", "repr_cache").order_by('id').first()
+        next_concepts = [c for c in self.neighbours(0, 2) if c.pk != self.pk]
+        return next_concepts[0] if next_concepts else None
 
     def other_concepts(self):
         """Some surrounding concepts in the glossary."""
-        previous_concepts = Concept.objects.filter(
-                glossary=self.glossary,
-                id__lt=self.pk,
-        ).only("id", "repr_cache").order_by('-id')[:5]
-        next_concepts = Concept.objects.filter(
-                glossary=self.glossary,
-                id__gte=self.pk,
-        ).only("id", "repr_cache").order_by('id')[:6]
-
-        return itertools.chain(reversed(previous_concepts), next_concepts)
+        return self.neighbours(5, 6)
 
     def get_absolute_url(self):
         return reverse('terminator_concept_detail', kwargs={'pk': self.pk})
 
 
+# The concepts of every glossary in this process, for navigating between them:
+# glossary id -> (version, sorted ids, repr_cache of every id)
+_navigation = {}
+_navigation_lock = threading.Lock()
+
+
+def navigation_version(glossary_id):
+    # From the primary, like the navigation itself, so that a lagging replica
+    # doesn't make it look outdated again.
+    with use_primary():
+        return Glossary.objects.filter(pk=glossary_id).values_list('navigation_version', flat=True).first()
+
+
+def navigation_changed(glossary_id):
+    """
+    Outdate the navigation index of the glossary in all processes, once the
+    current transaction is committed.
+
+    The signals take care of this for single concepts, but bulk operations
+    should call it themselves.
+    """
+    def next_version():
+        Glossary.objects.filter(pk=glossary_id).update(navigation_version=F('navigation_version') + 1)
+    transaction.on_commit(next_version)
+
+
+def glossary_navigation(glossary_id):
+    """
+    The sorted ids of the concepts in the glossary as an array, and their
+    repr_cache, (re)built in this process if they are outdated.
+    """
+    version = navigation_version(glossary_id)
+    with _navigation_lock:
+        navigation = _navigation.get(glossary_id)
+        if navigation is None or navigation[0] != version:
+            with use_primary():
+                concepts = list(Concept.objects.filter(
+                        glossary=glossary_id,
+                ).order_by('id').values_list('id', 'repr_cache'))
+            ids = array.array('l', (pk for pk, _repr in concepts))
+            reprs = tuple(repr_ for _pk, repr_ in concepts)
+            navigation = _navigation[glossary_id] = (version, ids, reprs)
+        return navigation[1:]
+
+
+def concept_navigation_changed(sender, **kwargs):
+    # Other changes to concepts (like their repr_cache) don't change the
+    # navigation, or are taken care of elsewhere.
+    if kwargs.get('created', True):
+        navigation_changed(kwargs['instance'].glossary_id)
+post_save.connect(concept_navigation_changed, sender=Concept)
+post_delete.connect(concept_navigation_changed, sender=Concept)
+
+
+# The concepts of which terms changed in the current transaction (per thread)
+_changed_concepts = threading.local()
+
+
+def repr_cache_changed(concept_ids):
+    """
+    Record that the terms of the concepts changed, so that their repr_cache
+    is recomputed (once) when the transaction commits.
+    """
+    changed = getattr(_changed_concepts, 'ids', None)
+    if changed is None:
+        changed = _changed_concepts.ids = set()
+    changed.update(concept_ids)
+    # Every change registers a callback, since the callbacks of a transaction
+    # are dropped on rollback. Only the first one finds anything to do.
+    transaction.on_commit(update_changed_repr_caches)
+
+
+def update_changed_repr_caches():
+    """Recompute the repr_cache of the concepts recorded as changed."""
+    concept_ids = list(getattr(_changed_concepts, 'ids', None) or [])
+    _changed_concepts.ids = set()
+    # Three query parameters per concept in bulk_update_field()
+    for i in range(0, len(concept_ids), 300):
+        update_repr_caches(Concept.objects.filter(pk__in=concept_ids[i:i+300]))
+
+
+def update_repr_caches(concepts):
+    """
+    Recompute the repr_cache of all the concepts in the given queryset in a
+    few queries, and return the number of concepts.
+    """
+    translations = {}
+    old = {}
+    for pk, glossary_id, repr_cache in concepts.values_list('pk', 'glossary_id', 'repr_cache'):
+        translations[pk] = []
+        old[pk] = (glossary_id, repr_cache)
+    source_translations = Translation.objects.filter(
+            concept__in=concepts,
+            language=F('concept__glossary__source_language'),
+    ).only('concept_id', 'translation_text', 'administrative_status_id')
+    for translation in source_translations:
+        if translation.concept_id in translations:
+            translations[translation.concept_id].append(translation)
+    changed = {}
+    for pk, concept_translations in translations.items():
+        repr_cache = Concept(pk=pk).repr_from(concept_translations)
+        if repr_cache != old[pk][1]:
+            changed[pk] = repr_cache
+    bulk_update_field(Concept, 'repr_cache', changed)
+    # The navigation shows the repr_cache
+    for glossary_id in set(old[pk][0] for pk in changed):
+        navigation_changed(glossary_id)
+    return len(translations)
+
+
 def update_repr_cache(sender, **kwargs):
     translation = kwargs.get('instance')
-    translation.concept.update_repr_cache()
+    repr_cache_changed([translation.concept_id])
 post_delete.connect(update_repr_cache, sender='terminator.Translation')
 
 
@@ -367,6 +521,26 @@ class ConceptInLanguage(models.Model, ConceptLangUrlMixin):
     class Meta:
         unique_together = ("concept", "language")
 
+    @classmethod
+    def get_or_unsaved(cls, concept, language):
+        """
+        The concept in the language, or an unsaved one if it was never
+        finalized or commented on, so that reading doesn't write.
+        """
+        concept_in_lang = cls.objects.filter(concept=concept, language=language).first()
+        if concept_in_lang is None:
+            concept_in_lang = cls(concept=concept, language=language)
+        return concept_in_lang
+
+    def get_admin_url(self):
+        if self.pk:
+            return reverse('admin:terminator_conceptinlanguage_change', args=[self.pk])
+        # Created when somebody wants to edit it
+        return reverse('terminator_concept_in_language_admin', kwargs={
+                'pk': self.concept_id,
+                'lang': self.language_id,
+        })
+
     def definition(self):
         try:
             return Definition.objects.get(concept=self.concept_id, language=self.language_id)
@@ -486,11 +660,31 @@ class ConceptInLanguage(models.Model, ConceptLangUrlMixin):
     date_html.short_description = _("Date")
 
 
+# Decomposition can make a text many times longer (up to 18 characters for
+# one), so long search keys are cut off.
+SEARCH_KEY_MAX_LENGTH = 255
+
+
+def make_search_key(text):
+    """
+    Fold text for comparison in searches: ignoring case and accents, and
+    treating compatibility characters (like ligatures) as their equivalents.
+    """
+    # Python 2 doesn't have str.casefold()
+    text = getattr(text, 'casefold', text.lower)()
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return text[:SEARCH_KEY_MAX_LENGTH]
+
+
 @python_2_unicode_compatible
 class Translation(models.Model, ConceptLangUrlMixin):
     concept = models.ForeignKey(Concept, on_delete=models.CASCADE, verbose_name=_("concept"))
     language = models.ForeignKey(Language, on_delete=models.PROTECT, verbose_name=_("language"))
     translation_text = models.CharField(max_length=100, verbose_name=_("translation text"))
+    # Folded translation_text (see make_search_key()) for searching. Longer,
+    # since decomposition can make the text longer.
+    search_key = models.CharField(max_length=SEARCH_KEY_MAX_LENGTH, db_index=True, editable=False, default='')
     is_finalized = models.BooleanField(default=False, verbose_name=_("Is finalized"))
     administrative_status = models.ForeignKey(AdministrativeStatus, null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_("administrative status"))
     administrative_status_reason = models.ForeignKey(AdministrativeStatusReason, null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_("administrative status reason"))
@@ -514,27 +708,41 @@ class Translation(models.Model, ConceptLangUrlMixin):
 
     def save(self, *args, **kwargs):
         update_repr_cache = kwargs.pop("update_repr_cache", True)
+        self.search_key = make_search_key(self.translation_text)
         super(Translation, self).save(*args, **kwargs)
         if update_repr_cache:
-            self.concept.update_repr_cache()
+            repr_cache_changed([self.concept_id])
+
+    # The perceived worth of terms by administrative status (lower is better)
+    STATUS_WEIGHTS = {
+            "preferredTerm-admn-sts": 0,
+            "": 1,
+            None: 1,
+            "admittedTerm-admn-sts": 2,
+            "supersededTerm-admn-sts": 3,
+            "deprecatedTerm-admn-sts": 4,
+    }
 
     def cmp_key(self):
         # used to sort terms according to their perceived worth
-        keys = {
-                "preferredTerm-admn-sts": 0,
-                "": 1,
-                None: 1,
-                "admittedTerm-admn-sts": 2,
-                "supersededTerm-admn-sts": 3,
-                "deprecatedTerm-admn-sts": 4,
-        }
         # We return a tuple with the "quality" key, and the text to allow
         # alphabetic sorting for all adminitted terms, for example.
-        return (keys.get(self.administrative_status_id, 1), self.translation_text.lower())
+        return (self.STATUS_WEIGHTS.get(self.administrative_status_id, 1), self.translation_text.lower())
         #TODO: for proper i18n, use locale aware sorting/lowercasing for the
         #language involved
 
 
+class TermChange(models.Model):
+    """
+    A committed change to a term, or to many terms if translation_id is None.
+    Processes follow these to keep their in-memory search indexes up to date
+    (see terminator/search.py).
+    """
+    # Not a foreign key, since the term might be deleted
+    translation_id = models.IntegerField(null=True)
+    time = models.DateTimeField(default=now, db_index=True)
+
+
 @python_2_unicode_compatible
 class Definition(models.Model, ConceptLangUrlMixin):
     concept = models.ForeignKey(Concept, on_delete=models.CASCADE, verbose_name=_("concept"))
@@ -648,6 +856,362 @@ class CorpusExample(models.Model):
         return _("%(address)s for translation %(translation)s") % trans_data
 
 
+# The glossaries, concepts and terms that changed in the current transaction
+# (per thread)
+_touched = threading.local()
+
+
+def touch_glossary(sender, **kwargs):
+    """
+    Record that something in the glossary of the instance changed. The
+    glossary is updated (once) when the transaction commits, so that editors
+    of the same glossary don't wait for each other on its row.
+    """
+    instance = kwargs.get('instance')
+    touched = getattr(_touched, 'ids', None)
+    if touched is None:
+        touched = _touched.ids = {'pk__in': set(), 'concept__in': set(), 'concept__translation__in': set()}
+    if isinstance(instance, Concept):
+        touched['pk__in'].add(instance.glossary_id)
+    elif hasattr(instance, 'concept_id'):
+        touched['concept__in'].add(instance.concept_id)
+    else:
+        touched['concept__translation__in'].add(instance.translation_id)
+    # See repr_cache_changed()
+    transaction.on_commit(update_touched_glossaries)
+
+
+def update_touched_glossaries():
+    """Set last_modified of the glossaries recorded as changed."""
+    touched = getattr(_touched, 'ids', None)
+    _touched.ids = None
+    if not touched:
+        return
+    conditions = []
+    for lookup, ids in touched.items():
+        ids = list(ids)
+        conditions.extend(Q(**{lookup: ids[i:i+300]}) for i in range(0, len(ids), 300))
+    # Usually one query, but stay below the query parameter limit of SQLite
+    timestamp = now()
+    for i in range(0, len(conditions), 3):
+        Glossary.objects.filter(
+                functools.reduce(operator.or_, conditions[i:i+3]),
+        ).update(last_modified=timestamp)
+for _sender in (Concept, Translation, Definition, ExternalResource,
+                ConceptInLanguage, ContextSentence, CorpusExample):
+    post_save.connect(touch_glossary, sender=_sender)
+    post_delete.connect(touch_glossary, sender=_sender)
+m2m_changed.connect(touch_glossary, sender=Concept.related_concepts.through)
+
+
+def term_data(translation):
+    status = translation.administrative_status
+    return {
+        "id": translation.id,
+        "translation_text": translation.translation_text,
+        "administrative_status_id": translation.administrative_status_id,
+        "administrative_status": status.name if status else None,
+    }
+
+
+def term_from_data(data, concept, language):
+    translation = Translation(
+            id=data["id"],
+            concept=concept,
+            language=language,
+            translation_text=data["translation_text"],
+            administrative_status_id=data["administrative_status_id"],
+    )
+    if data["administrative_status_id"]:
+        translation.administrative_status = AdministrativeStatus(
+                tbx_representation=data["administrative_status_id"],
+                name=data["administrative_status"],
+        )
+    return translation
+
+
+class ConceptSnapshot(models.Model):
+    """
+    What the concept pages show of a concept in a language, serialized, so
+    that they can be shown from a single row.
+
+    Snapshots are deleted when something in them changes, and built again
+    once the transaction commits (see snapshots_changed()). Pages that only
+    read never store them.
+    """
+    concept = models.ForeignKey(Concept, on_delete=models.CASCADE)
+    language = models.ForeignKey(Language, on_delete=models.CASCADE)
+    data = models.TextField()
+
+    class Meta:
+        unique_together = ("concept", "language")
+
+    @classmethod
+    def build_data(cls, concept, language):
+        concept_in_lang = ConceptInLanguage.get_or_unsaved(concept, language)
+        translations = Translation.objects.filter(
+                concept=concept,
+                language=language,
+        ).select_related('administrative_status')
+        translations = sorted(translations, key=lambda t: t.cmp_key())
+        definition = Definition.objects.filter(concept=concept, language=language).first()
+        last_change = None
+        if definition:
+            history = definition.history.select_related('history_user').first()
+            if history:
+                last_change = {
+                    "history_user": history.history_user.username if history.history_user else None,
+                    "history_date": history.history_date.isoformat(),
+                }
+            definition = {
+                "id": definition.id,
+                "text": definition.text,
+                "is_finalized": definition.is_finalized,
+                "source": definition.source,
+                "last_change": last_change,
+            }
+        other_languages = {}
+        for lang, data in concept_in_lang.other_language_data().items():
+            terms = data.get("terms", [])
+            other_definition = data.get("definition")
+            other_languages[lang] = {
+                "name": terms[0].language.name if terms else None,
+                "terms": [term_data(t) for t in terms],
+                "definition": other_definition.text if other_definition else None,
+            }
+        related_concepts = {}
+        for concept_id, data in concept_in_lang.related_concepts_data().items():
+            terms = data.get("terms", [])
+            related_definition = data.get("definition")
+            related_concepts[concept_id] = {
+                "terms": [term_data(t) for t in terms],
+                "definition": related_definition.text if related_definition else None,
+                # Shown instead of the terms if there are none
+                "concept": force_text(related_definition.concept) if related_definition and not terms else None,
+            }
+        external_resources = [{
+                "id": resource.id,
+                "address": resource.address,
+                "link_type_id": resource.link_type_id,
+                "description": resource.description,
+        } for resource in concept_in_lang.external_resources()]
+        return {
+            "concept_in_lang": {
+                "id": concept_in_lang.id,
+                "summary": concept_in_lang.summary,
+                "is_finalized": concept_in_lang.is_finalized,
+            },
+            "translations": [term_data(t) for t in translations],
+            "definition": definition,
+            "other_languages": other_languages,
+            "related_concepts": related_concepts,
+            "external_resources": external_resources,
+        }
+
+    @classmethod
+    def build(cls, concept_id, language_id):
+        """Build the snapshot of the concept in the language (again)."""
+        with use_primary(), transaction.atomic():
+            concept = Concept.objects.filter(pk=concept_id).first()
+            language = Language.objects.filter(pk=language_id).first()
+            if concept is None or language is None:
+                # Deleted in the mean time
+                return
+            snapshot, created = cls.objects.get_or_create(concept=concept, language=language)
+            if not created:
+                # Concurrent builds wait for each other, so that the last one
+                # only reads after all the changes before it were committed.
+                snapshot = cls.objects.select_for_update().get(pk=snapshot.pk)
+            snapshot.data = json.dumps(cls.build_data(concept, language))
+            snapshot.save()
+
+    @classmethod
+    def get_data(cls, concept, language):
+        """
+        The snapshot of the concept in the language, as a dictionary with
+        unsaved model instances for the templates.
+        """
+        try:
+            data = json.loads(cls.objects.get(concept=concept, language=language).data)
+        except cls.DoesNotExist:
+            # Not stored, since it might already be outdated
+            with use_primary():
+                data = cls.build_data(concept, language)
+
+        definition = data["definition"]
+        last_change = None
+        if definition:
+            last_change = definition.pop("last_change")
+            if last_change:
+                last_change["history_date"] = parse_datetime(last_change["history_date"])
+            definition = Definition(concept=concept, language=language, **definition)
+        other_languages = {}
+        for lang, other in data["other_languages"].items():
+            other_language = Language(iso_code=lang, name=other["name"])
+            other_languages[lang] = {
+                "terms": [term_from_data(t, concept, other_language) for t in other["terms"]],
+            }
+            if other["definition"] is not None:
+                other_languages[lang]["definition"] = Definition(
+                        concept=concept,
+                        language=other_language,
+                        text=other["definition"],
+                )
+        related_concepts = {}
+        for concept_id, related in data["related_concepts"].items():
+            # The keys are strings in JSON
+            related_concept = Concept(pk=int(concept_id), glossary_id=concept.glossary_id, repr_cache=related["concept"])
+            related_concepts[related_concept.pk] = {
+                "terms": [term_from_data(t, related_concept, language) for t in related["terms"]],
+            }
+            if related["definition"] is not None:
+                related_concepts[related_concept.pk]["definition"] = Definition(
+                        concept=related_concept,
+                        language=language,
+                        text=related["definition"],
+                )
+        return {
+            "concept_in_lang": ConceptInLanguage(concept=concept, language=language, **data["concept_in_lang"]),
+            "translations": [term_from_data(t, concept, language) for t in data["translations"]],
+            "definition": definition,
+            "last_change": last_change,
+            "other_languages": other_languages,
+            "related_concepts": related_concepts,
+            "external_resources": [
+                ExternalResource(concept=concept, language=language, **resource)
+                for resource in data["external_resources"]
+            ],
+        }
+
+
+# The snapshots to build again when the current transaction commits (per
+# thread), as (concept_id, language_id)
+_changed_snapshots = threading.local()
+
+
+def snapshots_changed(pairs):
+    """
+    Record that the snapshots of the concepts in the languages changed, so
+    that they are built again (once) when the transaction commits.
+    """
+    changed = getattr(_changed_snapshots, 'pairs', None)
+    if changed is None:
+        changed = _changed_snapshots.pairs = set()
+    changed.update(pairs)
+    # See repr_cache_changed()
+    transaction.on_commit(build_changed_snapshots)
+
+
+def build_changed_snapshots():
+    """Build the snapshots recorded as changed."""
+    pairs = getattr(_changed_snapshots, 'pairs', None) or set()
+    _changed_snapshots.pairs = set()
+    for concept_id, language_id in sorted(pairs):
+        ConceptSnapshot.build(concept_id, language_id)
+
+
+def outdate_snapshots(snapshots, pairs=()):
+    """
+    Delete the snapshots in the queryset, and build them (and the ones of the
+    given (concept_id, language_id) pairs) again after the commit.
+    """
+    pairs = set(pairs)
+    pairs.update(snapshots.values_list('concept_id', 'language_id'))
+    snapshots.delete()
+    snapshots_changed(pairs)
+
+
+def neighbour_concept_ids(concept_ids):
+    """
+    The ids of the concepts that show the given concepts among their related
+    concepts (see ConceptInLanguage.related_concepts_data()).
+    """
+    Through = Concept.related_concepts.through
+    ids = set(Through.objects.filter(
+            from_concept__in=concept_ids,
+    ).values_list('to_concept_id', flat=True))
+    ids.update(Concept.objects.filter(
+            broader_concept__in=concept_ids,
+    ).values_list('pk', flat=True))
+    ids.update(Concept.objects.filter(
+            pk__in=concept_ids,
+            broader_concept__isnull=False,
+    ).values_list('broader_concept_id', flat=True))
+    return ids
+
+
+def delete_concept_snapshots(sender, **kwargs):
+    """
+    Delete the snapshots that show the changed instance, and build them (and
+    the one of its own page) again after the commit.
+    """
+    instance = kwargs.get('instance')
+    if kwargs.get('raw'):
+        return
+    snapshots = ConceptSnapshot.objects.filter(concept=instance.concept_id)
+    if isinstance(instance, ConceptInLanguage):
+        # Only shown on its own page
+        snapshots = snapshots.filter(language=instance.language_id)
+    elif isinstance(instance, ExternalResource):
+        if instance.language_id:
+            snapshots = snapshots.filter(language=instance.language_id)
+    else:
+        # Also shown on the pages of related concepts in the language
+        snapshots = ConceptSnapshot.objects.filter(
+                Q(concept=instance.concept_id) |
+                Q(concept__in=neighbour_concept_ids([instance.concept_id]), language=instance.language_id)
+        )
+    pairs = []
+    if instance.language_id:
+        pairs.append((instance.concept_id, instance.language_id))
+    outdate_snapshots(snapshots, pairs)
+for _sender in (Translation, Definition, ConceptInLanguage, ExternalResource):
+    post_save.connect(delete_concept_snapshots, sender=_sender)
+    post_delete.connect(delete_concept_snapshots, sender=_sender)
+
+
+def broader_concept_changing(sender, instance, raw, update_fields, **kwargs):
+    """The old and new broader concept show the concept as related."""
+    if raw or not instance.pk:
+        return
+    if update_fields and not {'broader_concept', 'broader_concept_id'} & set(update_fields):
+        return
+    old = Concept.objects.filter(pk=instance.pk).values_list('broader_concept_id', flat=True).first()
+    if old != instance.broader_concept_id:
+        concept_ids = set([instance.pk, old, instance.broader_concept_id]) - set([None])
+        outdate_snapshots(ConceptSnapshot.objects.filter(concept__in=concept_ids))
+pre_save.connect(broader_concept_changing, sender=Concept)
+
+
+def concept_deleting(sender, instance, **kwargs):
+    """Its relations are deleted without signals."""
+    outdate_snapshots(ConceptSnapshot.objects.filter(concept__in=neighbour_concept_ids([instance.pk])))
+pre_delete.connect(concept_deleting, sender=Concept)
+
+
+def related_concepts_changed(sender, instance, action, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove'):
+        concept_ids = set(pk_set)
+    elif action == 'pre_clear':
+        concept_ids = set(instance.related_concepts.values_list('pk', flat=True))
+    else:
+        return
+    concept_ids.add(instance.pk)
+    outdate_snapshots(ConceptSnapshot.objects.filter(concept__in=concept_ids))
+m2m_changed.connect(related_concepts_changed, sender=Concept.related_concepts.through)
+
+
+def delete_all_snapshots(sender, **kwargs):
+    """
+    Names of languages and statuses are in all snapshots. Building all of
+    them again would take too long here (see the rebuild_repr_cache command).
+    """
+    ConceptSnapshot.objects.all().delete()
+for _sender in (Language, AdministrativeStatus):
+    post_save.connect(delete_all_snapshots, sender=_sender)
+    post_delete.connect(delete_all_snapshots, sender=_sender)
+
+
 @python_2_unicode_compatible
 class CollaborationRequest(models.Model):
     COLLABORATION_ROLE_CHOICES = (
@@ -674,6 +1238,70 @@ class CollaborationRequest(models.Model):
         return _("%(user)s requested %(role)s for %(glossary)s") % trans_data
 
 
+@python_2_unicode_compatible
+class ImportJob(models.Model):
+    """A TBX file waiting to be imported (or imported) by the job worker."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (RUNNING, _('Running')),
+        (SUCCEEDED, _('Succeeded')),
+        (FAILED, _('Failed')),
+    )
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_("user"))
+    imported_file = models.FileField(upload_to='imports/', verbose_name=_("file"))
+    # The glossary is only created when the import is committed, so we keep
+    # the details from the import form until then.
+    glossary_name = models.CharField(max_length=50, verbose_name=_("glossary name"))
+    glossary_description = models.TextField(verbose_name=_("glossary description"))
+    source_language = models.ForeignKey(Language, on_delete=models.PROTECT, verbose_name=_("source language"))
+    glossary = models.ForeignKey(Glossary, null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_("glossary"))
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, verbose_name=_("status"))
+    concept_count = models.PositiveIntegerField(default=0, verbose_name=_("concepts processed"))
+    error = models.TextField(blank=True, verbose_name=_("error"))
+    created = models.DateTimeField(auto_now_add=True, verbose_name=_("created"))
+    started = models.DateTimeField(null=True, blank=True, verbose_name=_("started"))
+    # Updated by the worker while the job is running, so that jobs of workers
+    # that died can be claimed again (see claim_import_job()).
+    heartbeat = models.DateTimeField(null=True, blank=True, verbose_name=_("heartbeat"))
+    finished = models.DateTimeField(null=True, blank=True, verbose_name=_("finished"))
+
+    class Meta:
+        verbose_name = _("import job")
+        verbose_name_plural = _("import jobs")
+        ordering = ['id']
+
+    def __str__(self):
+        return _("Import of %(glossary)s (%(status)s)") % {
+            'glossary': self.glossary_name,
+            'status': self.get_status_display(),
+        }
+
+    def get_absolute_url(self):
+        return reverse('terminator_import_job', kwargs={'pk': self.pk})
+
+    def progress_cache_key(self):
+        # The import runs in one transaction, so the progress is reported
+        # through the cache where other processes can see it before the
+        # commit.
+        return 'terminator-import-job-%d' % self.pk
+
+    def progress(self):
+        """The number of concepts processed so far."""
+        if self.status == self.RUNNING:
+            return cache.get(self.progress_cache_key(), self.concept_count)
+        return self.concept_count
+
+    def elapsed(self):
+        """The running time of the job as a timedelta, or None."""
+        if not self.started:
+            return None
+        return (self.finished or now()) - self.started
+
+
 @Field.register_lookup
 class IntegerValue(Transform):
     lookup_name = 'integer'  # e.g. field__integer__in
@@ -684,6 +1312,29 @@ class IntegerValue(Transform):
         return sql, params
 
 
+def bulk_update_field(model, field_name, values, batch_size=300):
+    """Set a field to a different value for many objects in a few queries.
+
+    values is a dictionary mapping the primary keys to the new values.
+    """
+    field = model._meta.get_field(field_name)
+    if field.is_relation:
+        output_field = IntegerField()
+    else:
+        output_field = field
+    values = list(values.items())
+    # Every object needs three query parameters, which must stay below the
+    # default SQLite limit of 999.
+    for i in range(0, len(values), batch_size):
+        batch = values[i:i+batch_size]
+        model.objects.filter(pk__in=[pk for pk, value in batch]).update(**{
+            field_name: Case(
+                *[When(pk=pk, then=Value(value)) for pk, value in batch],
+                output_field=output_field
+            )
+        })
+
+
 def process_recent_changes(changes):
     """Helper to provide template variables for changes to certain models."""
     log = []
@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Reading some pages from replicas of the database.
+
+The router sends the reads of views marked with use_replica() to one of the
+database aliases in settings.DATABASE_REPLICAS, for GET requests of sessions
+that didn't change anything recently. Everything else, and all writes, use the
+default database. Users see their own changes, because their session stays
+with the default database for DATABASE_REPLICA_PIN_SECONDS after every
+request that wrote something.
+"""
+
+from contextlib import contextmanager
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+PIN_SESSION_KEY = 'replica_pinned_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# The replica for reads in the current request of this thread (if any), and
+# whether the request wrote something
+_state = threading.local()
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', None) or []
+
+
+def use_replica(view):
+    """Mark the view as safe to read from a replica."""
+    view.use_replica = True
+    return view
+
+
+@contextmanager
+def use_primary():
+    """
+    Read from the default database in this block, for example for data that
+    is stored again, and must not be older than the default database.
+    """
+    replica = getattr(_state, 'replica', None)
+    _state.replica = None
+    try:
+        yield
+    finally:
+        _state.replica = replica
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        return getattr(_state, 'replica', None)
+
+    def db_for_write(self, model, **hints):
+        # Asked before every write (and a few reads, like get_or_create())
+        _state.wrote = True
+        # Also for instances that were read from a replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = [DEFAULT_DB_ALIAS] + replicas()
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in replicas():
+            # They get everything from the default database
+            return False
+        return None
+
+
+def stream_from(replica, content):
+    """Generate the content of a streaming response, reading from the replica."""
+    _state.replica = replica
+    try:
+        for chunk in content:
+            yield chunk
+    finally:
+        # Also when the response is closed early
+        _state.replica = None
+
+
+class ReplicaMiddleware(object):
+    """Decides for every request whether it can read from a replica."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.wrote = False
+        try:
+            response = self.get_response(request)
+            replica = getattr(_state, 'replica', None)
+        finally:
+            _state.replica = None
+        if replica and response.streaming:
+            # The content is only generated after we return.
+            response.streaming_content = stream_from(replica, response.streaming_content)
+        if replicas() and _state.wrote and hasattr(request, 'session'):
+            # Stay with the default database until the replicas caught up.
+            pin_seconds = getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10)
+            request.session[PIN_SESSION_KEY] = time.time() + pin_seconds
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not replicas() or request.method not in SAFE_METHODS:
+            return None
+        if not getattr(view_func, 'use_replica', False):
+            return None
+        session = getattr(request, 'session', {})
+        if session.get(PIN_SESSION_KEY, 0) > time.time():
+            return None
+        _state.replica = random.choice(replicas())
+        return None
@@ -0,0 +1,941 @@
+# -*- coding: UTF-8 -*-
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Search backends for finding terms by a part of their text, and suggestions of
+terms starting with some text.
+
+On PostgreSQL the database does the work with the help of a pg_trgm index (see
+migration 0027). Other databases can't use an index for substring searches, so
+we keep an n-gram index of all the terms in memory instead.
+
+Suggestions come from sorted lists of the search keys of every language,
+fuzzy searches use an index of the bigrams of all the search keys (or
+pg_trgm), and texts are annotated with Aho-Corasick automatons of the terms
+of a language, also kept in memory.
+
+Every process keeps its in-memory indexes up to date with the changes to the
+terms that any process commits, which are recorded in the TermChange table.
+Bulk changes (like imports) make the indexes of every process be built again.
+"""
+
+from collections import Counter, deque, namedtuple
+from datetime import timedelta
+import bisect
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, connections, transaction
+from django.db.models import Case, ExpressionWrapper, IntegerField, Value, When
+from django.db.models.functions import Length
+from django.db.models.signals import post_delete, post_save
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+
+from terminator.models import Language, TermChange, Translation, make_search_key
+from terminator.replicas import use_primary
+
+
+NGRAM_SIZE = 3
+
+# The number of different terms to suggest
+SUGGESTION_COUNT = 10
+
+# What the in-memory indexes need to know about a term
+Term = namedtuple('Term', 'search_key translation_text concept_id language_id glossary_id')
+
+# Changes committed by other processes are looked for this often (in seconds).
+CHANGE_POLL_INTERVAL = 1
+# Changes are looked at again for this long (in seconds) after they were
+# recorded, since they can be committed (or recorded by servers with clocks
+# that are behind) out of order.
+CHANGE_OVERLAP = 60
+# Older changes are deleted. Processes that didn't look at the changes for
+# this long build their indexes again.
+CHANGE_RETENTION = 24 * 60 * 60
+
+# Search results are cached for this long, unless something changes earlier.
+SEARCH_CACHE_TIMEOUT = 60 * 60
+SEARCH_CACHE_HITS_KEY = 'terminator-search-cache-hits'
+SEARCH_CACHE_MISSES_KEY = 'terminator-search-cache-misses'
+
+
+def levenshtein(a, b):
+    """The number of insertions, deletions and substitutions from a to b."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (char_a != char_b),
+            ))
+        previous = current
+    return previous[-1]
+
+
+def ngrams(text):
+    return set(text[i:i+NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1))
+
+
+def bigrams(search_key):
+    """The different bigrams of a search key, padded to count the ends too."""
+    search_key = "\0%s\0" % search_key
+    return set(search_key[i:i+2] for i in range(len(search_key) - 1))
+
+
+# The ids of the terms that changed in the current transaction (per thread)
+_changed_terms = threading.local()
+
+
+def terms_changed(pks):
+    """
+    Record that the terms with the given ids changed, so that the indexes of
+    all processes apply the changes once the current transaction commits.
+    """
+    changed = getattr(_changed_terms, 'pks', None)
+    if changed is None:
+        changed = _changed_terms.pks = set()
+    changed.update(pks)
+    # See repr_cache_changed()
+    transaction.on_commit(record_term_changes)
+
+
+def translations_changed():
+    """
+    Tell the search indexes of all processes that the terms changed (once
+    the current transaction is committed), so that they are built again.
+
+    The signals take care of this for single changes, but bulk operations
+    should call it themselves.
+    """
+    terms_changed([None])
+
+
+_last_pruned = [0]
+
+
+def record_term_changes():
+    """Store the changes recorded by terms_changed() for all processes."""
+    pks = getattr(_changed_terms, 'pks', None)
+    _changed_terms.pks = set()
+    if not pks:
+        return
+    if None in pks:
+        # Everything is built again anyway
+        pks = [None]
+    TermChange.objects.bulk_create([TermChange(translation_id=pk) for pk in pks])
+    if time.time() - _last_pruned[0] > CHANGE_OVERLAP:
+        _last_pruned[0] = time.time()
+        TermChange.objects.filter(time__lt=now() - timedelta(seconds=CHANGE_RETENTION)).delete()
+    # This process sees its own changes right away.
+    sync_indexes(force=True)
+
+
+class ChangeFeed(object):
+    """
+    Follows the TermChange table, for the changes that are new to this
+    process.
+    """
+
+    def __init__(self):
+        # When we last looked, and the changes seen then
+        self.polled = None
+        self.seen = set()
+
+    def start(self):
+        """Look for the changes from now on (if we don't yet)."""
+        if self.polled is None:
+            self.polled = now()
+
+    def poll(self):
+        """
+        Return the ids of the terms that changed since the last poll, with
+        None for bulk changes. Returns None if too much time passed to know.
+        """
+        current = now()
+        if current - self.polled > timedelta(seconds=CHANGE_RETENTION - CHANGE_OVERLAP):
+            self.polled = current
+            self.seen = set()
+            return None
+        changes = TermChange.objects.filter(
+                time__gte=self.polled - timedelta(seconds=CHANGE_OVERLAP),
+        ).values_list('pk', 'time', 'translation_id')
+        with use_primary():
+            changes = list(changes)
+        self.polled = current
+        # With the time, since some databases reuse the ids of deleted rows
+        new = [pk for (change_id, change_time, pk) in changes if (change_id, change_time) not in self.seen]
+        # Everything older than the overlap is not looked at again
+        self.seen = set((change_id, change_time) for (change_id, change_time, pk) in changes)
+        return new
+
+
+def current_terms(pks):
+    """A dictionary with the current Term of every id (or None if deleted)."""
+    pks = list(pks)
+    terms = dict((pk, None) for pk in pks)
+    # Stay below the query parameter limit of SQLite
+    for i in range(0, len(pks), 900):
+        rows = Translation.objects.filter(pk__in=pks[i:i+900]).values_list(
+                'pk', 'search_key', 'translation_text', 'concept_id', 'language_id', 'concept__glossary_id')
+        with use_primary():
+            for row in rows:
+                terms[row[0]] = Term(*row[1:])
+    return terms
+
+
+def count_search_cache_lookup(hit):
+    key = SEARCH_CACHE_HITS_KEY if hit else SEARCH_CACHE_MISSES_KEY
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The key was just evicted
+        pass
+
+
+def search_cache_stats(reset=False):
+    """Return the numbers of hits and misses of the search result cache."""
+    stats = cache.get_many([SEARCH_CACHE_HITS_KEY, SEARCH_CACHE_MISSES_KEY])
+    if reset:
+        cache.delete_many([SEARCH_CACHE_HITS_KEY, SEARCH_CACHE_MISSES_KEY])
+    return (stats.get(SEARCH_CACHE_HITS_KEY, 0), stats.get(SEARCH_CACHE_MISSES_KEY, 0))
+
+
+class NgramIndex(object):
+    """
+    An inverted index from n-grams to the ids of the terms containing them.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.texts = {}
+        self.outdated = False
+
+    def build(self):
+        terms = Translation.objects.values_list('pk', 'translation_text')
+        for (pk, text) in terms.iterator():
+            self.add(pk, text)
+
+    def update(self, pk, term):
+        """Apply a change to the term pk (None if it was deleted)."""
+        self.remove(pk)
+        if term is not None:
+            self.add(pk, term.translation_text)
+
+    def add(self, pk, text):
+        self.remove(pk)
+        text = text.lower()
+        self.texts[pk] = text
+        for ngram in ngrams(text):
+            self.postings.setdefault(ngram, set()).add(pk)
+
+    def remove(self, pk):
+        text = self.texts.pop(pk, None)
+        if text is None:
+            return
+        for ngram in ngrams(text):
+            pks = self.postings.get(ngram)
+            if pks is not None:
+                pks.discard(pk)
+                if not pks:
+                    del self.postings[ngram]
+
+    def search(self, search_string):
+        """
+        Return the ids of the terms that contain search_string (ignoring case),
+        or None if the search string is too short for the index.
+        """
+        search_string = search_string.lower()
+        query_ngrams = ngrams(search_string)
+        if not query_ngrams:
+            return None
+        postings = sorted((self.postings.get(ngram, set()) for ngram in query_ngrams), key=len)
+        candidates = set(postings[0])
+        for pks in postings[1:]:
+            candidates &= pks
+            if not candidates:
+                break
+        return [pk for pk in candidates if search_string in self.texts[pk]]
+
+
+class PrefixIndex(object):
+    """
+    The terms of one language sorted by their search keys, for finding the
+    terms that start with some text.
+    """
+
+    def __init__(self, language_id):
+        self.language_id = language_id
+        # Sorted tuples of (search_key, pk, translation_text, concept_id)
+        self.entries = []
+        self.by_pk = {}
+        self.outdated = False
+
+    def build(self):
+        terms = Translation.objects.filter(language_id=self.language_id)
+        terms = terms.values_list('search_key', 'pk', 'translation_text', 'concept_id')
+        self.entries = sorted(terms.iterator())
+        self.by_pk = dict((entry[1], entry) for entry in self.entries)
+
+    def update(self, pk, term):
+        self.remove(pk)
+        # The language might have changed
+        if term is not None and term.language_id == self.language_id:
+            self.add(pk, term.search_key, term.translation_text, term.concept_id)
+
+    def add(self, pk, search_key, text, concept_id):
+        self.remove(pk)
+        entry = (search_key, pk, text, concept_id)
+        bisect.insort(self.entries, entry)
+        self.by_pk[pk] = entry
+
+    def remove(self, pk):
+        entry = self.by_pk.pop(pk, None)
+        if entry is not None:
+            del self.entries[bisect.bisect_left(self.entries, entry)]
+
+    def matches(self, prefix):
+        """Generate the entries with a search key starting with prefix."""
+        entries = self.entries
+        i = bisect.bisect_left(entries, (prefix,))
+        while i < len(entries) and entries[i][0].startswith(prefix):
+            yield entries[i]
+            i += 1
+
+
+class FuzzyIndex(object):
+    """
+    An inverted index from the bigrams of the search keys of all terms to the
+    keys containing them, for finding the terms within some edit distance.
+
+    Every edit changes at most two bigrams of a (padded) key, so a key within
+    distance d of a query shares at least all but 2 * d of its different
+    bigrams. Only the keys with enough bigrams in common (and a similar length)
+    are compared with the query.
+    """
+
+    def __init__(self):
+        # Every search key gets a number. Deleted search keys stay in the
+        # index, without any terms.
+        self.search_keys = []
+        self.numbers = {}
+        # search_key -> {pk: (language_id, glossary_id)}
+        self.pks = {}
+        self.keys = {}
+        # bigram -> numbers of the search keys with it
+        self.postings = {}
+        # length -> numbers of the search keys of that length
+        self.lengths = {}
+        self.outdated = False
+
+    def build(self):
+        terms = Translation.objects.values_list('pk', 'search_key', 'language_id', 'concept__glossary_id')
+        for (pk, search_key, language_id, glossary_id) in terms.iterator():
+            self.add(pk, search_key, language_id, glossary_id)
+
+    def update(self, pk, term):
+        self.remove(pk)
+        if term is not None:
+            self.add(pk, term.search_key, term.language_id, term.glossary_id)
+
+    def add(self, pk, search_key, language_id, glossary_id):
+        self.remove(pk)
+        self.keys[pk] = search_key
+        if search_key not in self.pks:
+            self.pks[search_key] = {}
+            self.insert(search_key)
+        self.pks[search_key][pk] = (language_id, glossary_id)
+
+    def insert(self, search_key):
+        number = self.numbers[search_key] = len(self.search_keys)
+        self.search_keys.append(search_key)
+        for bigram in bigrams(search_key):
+            self.postings.setdefault(bigram, []).append(number)
+        self.lengths.setdefault(len(search_key), []).append(number)
+
+    def remove(self, pk):
+        search_key = self.keys.pop(pk, None)
+        if search_key is not None:
+            del self.pks[search_key][pk]
+
+    def search(self, search_key, max_distance, language_id=None, glossary_id=None):
+        """
+        Return a dictionary mapping the ids of the terms within max_distance
+        of search_key to their distance, only in the given language and
+        glossary (if any).
+        """
+        length = len(search_key)
+        query_bigrams = bigrams(search_key)
+        needed = len(query_bigrams) - 2 * max_distance
+        if needed > 0:
+            counts = Counter()
+            for bigram in query_bigrams:
+                counts.update(self.postings.get(bigram, ()))
+            candidates = [self.search_keys[number] for (number, count) in counts.items() if count >= needed]
+        else:
+            # Short queries: everything of a similar length
+            candidates = [self.search_keys[number]
+                          for key_length in range(length - max_distance, length + max_distance + 1)
+                          for number in self.lengths.get(key_length, ())]
+        results = {}
+        for key in candidates:
+            if abs(len(key) - length) > max_distance or not self.pks[key]:
+                continue
+            distance = levenshtein(search_key, key)
+            if distance > max_distance:
+                continue
+            for pk, (term_language_id, term_glossary_id) in self.pks[key].items():
+                if language_id is not None and term_language_id != language_id:
+                    continue
+                if glossary_id is not None and term_glossary_id != glossary_id:
+                    continue
+                results[pk] = distance
+        return results
+
+
+class TermAutomaton(object):
+    """
+    An Aho-Corasick automaton of the search keys of the terms in a language
+    (in one glossary, or in all of them), for finding all of them in a text
+    in one pass.
+
+    Changes to the terms are applied to self.terms. The automaton itself is
+    only compiled again (from memory) when it is used after a new search key
+    was added, which self.version counts.
+    """
+
+    def __init__(self, language_id, glossary_id=None):
+        self.language_id = language_id
+        self.glossary_id = glossary_id
+        # search_key -> {pk: (translation_text, concept_id)}. Deleted search
+        # keys stay in the automaton with an empty dictionary.
+        self.terms = {}
+        self.keys = {}
+        self.compiled = None
+        self.version = 0
+        self.outdated = False
+
+    def build(self):
+        terms = Translation.objects.filter(language_id=self.language_id)
+        if self.glossary_id is not None:
+            terms = terms.filter(concept__glossary_id=self.glossary_id)
+        terms = terms.values_list('pk', 'search_key', 'translation_text', 'concept_id')
+        for (pk, search_key, text, concept_id) in terms.iterator():
+            self.add(pk, search_key, text, concept_id)
+
+    def update(self, pk, term):
+        self.remove(pk)
+        if term is None or term.language_id != self.language_id:
+            return
+        if self.glossary_id is None or term.glossary_id == self.glossary_id:
+            self.add(pk, term.search_key, term.translation_text, term.concept_id)
+
+    def add(self, pk, search_key, text, concept_id):
+        self.remove(pk)
+        if not search_key:
+            return
+        if search_key not in self.terms:
+            self.terms[search_key] = {}
+            self.compiled = None
+            self.version += 1
+        self.terms[search_key][pk] = (text, concept_id)
+        self.keys[pk] = search_key
+
+    def remove(self, pk):
+        search_key = self.keys.pop(pk, None)
+        if search_key is not None:
+            del self.terms[search_key][pk]
+
+    def compile(self, search_keys=None):
+        """
+        Build the trie of the search keys (by default of self.terms) with its
+        failure links, and return it as lists indexed by state (0 is the root):
+        - goto: dictionaries mapping characters to the next state
+        - fail: the state for the longest proper suffix that is in the trie
+        - output: the search key ending in the state (or None)
+        - next_output: the closest state through the failure links that has
+          an output (or None), to find keys ending inside longer ones
+        """
+        goto = [{}]
+        output = [None]
+        for search_key in (self.terms if search_keys is None else search_keys):
+            state = 0
+            for char in search_key:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto.append({})
+                    output.append(None)
+                    goto[state][char] = next_state
+                state = next_state
+            output[state] = search_key
+
+        fail = [0] * len(goto)
+        next_output = [None] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                suffix = fail[state]
+                while suffix and char not in goto[suffix]:
+                    suffix = fail[suffix]
+                fail[next_state] = goto[suffix].get(char, 0)
+                suffix = fail[next_state]
+                if output[suffix] is not None:
+                    next_output[next_state] = suffix
+                else:
+                    next_output[next_state] = next_output[suffix]
+        return (goto, fail, output, next_output)
+
+    def scan(self, text, compiled=None):
+        """
+        Generate (start, end, search_key) for every occurrence of a search key
+        in (folded) text, in one pass over the text.
+        """
+        if compiled is None:
+            if self.compiled is None:
+                self.compiled = self.compile()
+            compiled = self.compiled
+        goto, fail, output, next_output = compiled
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            found = state if output[state] is not None else next_output[state]
+            while found is not None:
+                search_key = output[found]
+                yield (i + 1 - len(search_key), i + 1, search_key)
+                found = next_output[found]
+
+
+_indexes = {}
+_index_lock = threading.Lock()
+# Index key -> the changes applied while the index is being built
+_building = {}
+# Index key -> a lock held while the index is being built
+_build_locks = {}
+_feed = ChangeFeed()
+_poll_lock = threading.Lock()
+
+
+def apply_changes(pks):
+    """Apply the changes to the given terms (None for bulk changes) to the indexes."""
+    bulk = None in pks
+    terms = {} if bulk else current_terms(pks)
+    with _index_lock:
+        for index in _indexes.values():
+            if bulk:
+                # The old one is used until the new one is built.
+                index.outdated = True
+            else:
+                for pk, term in terms.items():
+                    index.update(pk, term)
+        for changes in _building.values():
+            changes.append(None if bulk else terms)
+
+
+def sync_indexes(force=False):
+    """
+    Apply the changes that were committed since we last looked (by any
+    process) to the indexes of this process. We look at most every
+    CHANGE_POLL_INTERVAL seconds, unless forced.
+    """
+    if _feed.polled is None:
+        # No indexes yet
+        return
+    if not force and now() - _feed.polled < timedelta(seconds=CHANGE_POLL_INTERVAL):
+        return
+    # Another thread is looking already
+    if not _poll_lock.acquire(False):
+        return
+    try:
+        pks = _feed.poll()
+        if pks is None:
+            # Changes might have been deleted before we saw them
+            pks = [None]
+        if pks:
+            apply_changes(set(pks))
+    finally:
+        _poll_lock.release()
+
+
+def get_index(key, factory):
+    """
+    The index of this process with the given key, built if needed.
+
+    Indexes are built without holding up the use of other indexes. While an
+    outdated index is built again, the old one is still used.
+    """
+    sync_indexes()
+    with _index_lock:
+        index = _indexes.get(key)
+        if index is not None and not index.outdated:
+            return index
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+    # Only wait for another thread building the index if we have none
+    if not build_lock.acquire(index is None):
+        return index
+    try:
+        with _index_lock:
+            current = _indexes.get(key)
+            if current is not None and not current.outdated:
+                # Built by another thread in the mean time
+                return current
+            _feed.start()
+            changes = _building[key] = []
+        try:
+            index = factory()
+            # Kept up to date from here on, so it must not miss anything
+            with use_primary():
+                index.build()
+            with _index_lock:
+                # Committed while the index was built (maybe already in it)
+                for terms in changes:
+                    if terms is None:
+                        index.outdated = True
+                    else:
+                        for pk, term in terms.items():
+                            index.update(pk, term)
+                _indexes[key] = index
+        finally:
+            with _index_lock:
+                del _building[key]
+        return index
+    finally:
+        build_lock.release()
+
+
+def ngram_index():
+    """The n-gram index of this process, built if needed."""
+    return get_index('ngram', NgramIndex)
+
+
+def update_indexes(sender, **kwargs):
+    terms_changed([kwargs['instance'].pk])
+
+# Rolled back changes must not end up in the indexes, so they are applied on
+# commit.
+post_save.connect(update_indexes, sender=Translation)
+post_delete.connect(update_indexes, sender=Translation)
+
+
+def group_suggestions(entries, count):
+    """
+    Collect the first count different terms (by search key) from entries of
+    (search_key, pk, translation_text, concept_id), with all their concepts.
+    """
+    suggestions = []
+    previous_key = None
+    for search_key, _pk, text, concept_id in entries:
+        if search_key == previous_key:
+            concepts = suggestions[-1]["concepts"]
+            if concept_id not in concepts:
+                concepts.append(concept_id)
+            continue
+        if len(suggestions) == count:
+            break
+        previous_key = search_key
+        suggestions.append({"term": text, "concepts": [concept_id]})
+    return suggestions
+
+
+def suggestions(language_id, text, count=SUGGESTION_COUNT):
+    """
+    Return the terms in the given language that start with text (ignoring
+    case and accents) as a list of dictionaries with the term and the ids of
+    its concepts.
+
+    Raises Language.DoesNotExist for unknown languages.
+    """
+    prefix = make_search_key(text)
+    if connection.in_atomic_block:
+        # See NgramSearchBackend.partial_match()
+        if not Language.objects.filter(pk=language_id).exists():
+            raise Language.DoesNotExist
+        if not prefix:
+            return []
+        terms = Translation.objects.filter(language_id=language_id, search_key__startswith=prefix)
+        terms = terms.order_by('search_key', 'pk')
+        entries = terms.values_list('search_key', 'pk', 'translation_text', 'concept_id')
+        return group_suggestions(entries.iterator(), count)
+
+    key = ('prefix', language_id)
+    if key not in _indexes and not Language.objects.filter(pk=language_id).exists():
+        raise Language.DoesNotExist
+    index = get_index(key, lambda: PrefixIndex(language_id))
+    if not prefix:
+        return []
+    # Changes of other processes are applied from other threads
+    with _index_lock:
+        return group_suggestions(index.matches(prefix), count)
+
+
+def fuzzy_matches(search_string, max_distance, limit=None, queryset=None, language_id=None, glossary_id=None):
+    """
+    Return a dictionary mapping the ids of the terms within max_distance
+    edits of search_string (ignoring case and accents) to their distance.
+    Only the closest limit terms are returned, if given.
+
+    See SearchBackend.fuzzy_match() for the filters.
+    """
+    search_key = make_search_key(search_string)
+    if queryset is None:
+        queryset = Translation.objects.all()
+    distances = get_search_backend().fuzzy_match(queryset, search_key, max_distance, language_id, glossary_id)
+    if limit is not None and len(distances) > limit:
+        closest = sorted(distances, key=distances.get)[:limit]
+        distances = dict((pk, distances[pk]) for pk in closest)
+    return distances
+
+
+def fold_with_offsets(text):
+    """
+    Fold text like make_search_key(), and return it with a list of the
+    position in text of every folded character.
+    """
+    folded = []
+    offsets = []
+    folded_chars = {}
+    for i, char in enumerate(text):
+        folded_char = folded_chars.get(char)
+        if folded_char is None:
+            folded_char = folded_chars[char] = make_search_key(char)
+        folded.append(folded_char)
+        offsets.extend([i] * len(folded_char))
+    return ''.join(folded), offsets
+
+
+def find_terms(text, language_id, glossary_id=None):
+    """
+    Find the terms of a language (and optionally a glossary) in text, as
+    whole words, ignoring case and accents. Overlapping matches are resolved
+    in favour of the one that starts first, and then the longest.
+
+    Returns a list of dictionaries with the start and end of the match in
+    text, the text itself and the terms and concepts that were found.
+
+    Raises Language.DoesNotExist for unknown languages.
+    """
+    key = ('annotate', language_id, glossary_id)
+    if connection.in_atomic_block:
+        # See NgramSearchBackend.partial_match()
+        if not Language.objects.filter(pk=language_id).exists():
+            raise Language.DoesNotExist
+        automaton = TermAutomaton(language_id, glossary_id)
+        automaton.build()
+        compiled = automaton.compile()
+    else:
+        if key not in _indexes and not Language.objects.filter(pk=language_id).exists():
+            raise Language.DoesNotExist
+        automaton = get_index(key, lambda: TermAutomaton(language_id, glossary_id))
+        with _index_lock:
+            compiled = automaton.compiled
+            version = automaton.version
+            search_keys = list(automaton.terms) if compiled is None else None
+        if compiled is None:
+            # Compiling takes a while, so other indexes are used (and changed)
+            # in the mean time. Keys added since then are only found once it
+            # is compiled again.
+            compiled = automaton.compile(search_keys)
+            with _index_lock:
+                if automaton.version == version:
+                    automaton.compiled = compiled
+
+    folded, offsets = fold_with_offsets(text)
+    found = list(automaton.scan(folded, compiled))
+    # A copy of the terms that were found, which other threads might change
+    with _index_lock:
+        entries = dict((search_key, list(automaton.terms[search_key].values()))
+                       for search_key in set(match[2] for match in found)
+                       if automaton.terms.get(search_key))
+    matches = []
+    for start, end, search_key in found:
+        if search_key not in entries:
+            continue
+        # Only whole words
+        if start > 0 and folded[start - 1].isalnum() and folded[start].isalnum():
+            continue
+        if end < len(folded) and folded[end].isalnum() and folded[end - 1].isalnum():
+            continue
+        matches.append((start, end, search_key))
+    matches.sort(key=lambda match: (match[0], -match[1]))
+
+    annotations = []
+    position = 0
+    for start, end, search_key in matches:
+        if start < position:
+            continue
+        position = end
+        text_start = offsets[start]
+        text_end = offsets[end - 1] + 1
+        # Combining characters after the match (that were folded away)
+        while text_end < len(text) and unicodedata.combining(text[text_end]):
+            text_end += 1
+        annotations.append({
+            "start": text_start,
+            "end": text_end,
+            "text": text[text_start:text_end],
+            "terms": sorted(set(term for (term, _concept_id) in entries[search_key])),
+            "concepts": sorted(set(concept_id for (_term, concept_id) in entries[search_key])),
+        })
+    return annotations
+
+
+def search_rank(search_key):
+    """
+    An expression for ordering search results, best first: exact matches
+    before prefix matches before other partial matches, then by administrative
+    status (like Translation.cmp_key()), and finalized terms first.
+    """
+    match = Case(
+            When(search_key=search_key, then=Value(0)),
+            When(search_key__startswith=search_key, then=Value(1)),
+            default=Value(2),
+            output_field=IntegerField(),
+    )
+    weights = [(status_id, weight) for (status_id, weight) in
+               Translation.STATUS_WEIGHTS.items() if status_id]
+    status = Case(
+            *[When(administrative_status_id=status_id, then=Value(weight))
+              for (status_id, weight) in sorted(weights)],
+            default=Value(1),
+            output_field=IntegerField()
+    )
+    not_finalized = Case(
+            When(is_finalized=True, then=Value(0)),
+            default=Value(1),
+            output_field=IntegerField(),
+    )
+    # Status weights are at most 4
+    return ExpressionWrapper(
+            match * 10 + status * 2 + not_finalized,
+            output_field=IntegerField(),
+    )
+
+
+class SearchBackend(object):
+    """
+    Find terms by a part of their text, or by their spelling. The default does
+    a table scan.
+    """
+
+    def partial_match(self, queryset, search_string):
+        return queryset.filter(translation_text__icontains=search_string)
+
+    def fuzzy_match(self, queryset, search_key, max_distance, language_id=None, glossary_id=None):
+        """
+        Return a dictionary mapping the ids of the terms in queryset within
+        max_distance edits of search_key to their distance.
+
+        The language and glossary (if given) must be the same as in the
+        filters of queryset. They are for backends that don't look in the
+        database, and can't use the other filters of queryset.
+        """
+        length = len(search_key)
+        terms = queryset.annotate(length=Length('search_key')).filter(
+                length__gte=length - max_distance,
+                length__lte=length + max_distance,
+        )
+        return self.closest(terms, search_key, max_distance)
+
+    def closest(self, terms, search_key, max_distance):
+        """The distances of the terms (a queryset) within max_distance."""
+        distances = {}
+        for (pk, key) in terms.values_list('pk', 'search_key').iterator():
+            distance = levenshtein(search_key, key)
+            if distance <= max_distance:
+                distances[pk] = distance
+        return distances
+
+
+class TrigramSearchBackend(SearchBackend):
+    """
+    For PostgreSQL. The icontains lookup is answered with the trigram index on
+    UPPER(translation_text) of migration 0027.
+
+    Fuzzy searches only compare the terms with enough trigrams in common
+    (with the % operator and the trigram index on search_key of migration
+    0032). An edit changes at most three trigrams, so the similarity of
+    a close term has a lower bound. pg_trgm splits the text into words, so
+    close terms that differ in spaces or punctuation might not be found.
+    """
+
+    def similar(self, queryset, search_key):
+        """The terms in queryset with a trigram similarity above the limit."""
+        # Without the lookups of django.contrib.postgres, which needs psycopg2
+        # to be installed. The % is doubled for the database adapter.
+        return queryset.extra(where=['"terminator_translation"."search_key" %% %s'], params=[search_key])
+
+    def fuzzy_match(self, queryset, search_key, max_distance, language_id=None, glossary_id=None):
+        terms = self.similar(queryset, search_key)
+        # The setting is per connection, so it has to be the one of the query.
+        with connections[terms.db].cursor() as cursor:
+            cursor.execute("SELECT COALESCE(array_length(show_trgm(%s), 1), 0)", [search_key])
+            count = cursor.fetchone()[0]
+            # At least count - 3d trigrams in common, and at most count + 3d
+            # trigrams in the other term
+            edits = 3 * max_distance
+            if count <= edits:
+                # Too short to use the index
+                return super(TrigramSearchBackend, self).fuzzy_match(queryset, search_key, max_distance)
+            cursor.execute("SELECT set_limit(%s)", [float(count - edits) / (count + 2 * edits)])
+            return self.closest(terms, search_key, max_distance)
+
+
+class NgramSearchBackend(SearchBackend):
+    """Look the terms up in the in-memory n-gram index of this process."""
+
+    # Keep enough query parameters free for the rest of the query.
+    max_results = 900
+
+    def partial_match(self, queryset, search_string):
+        if connection.in_atomic_block:
+            # The transaction might see uncommitted changes the index doesn't
+            # know about, and we should not build the index from them.
+            return super(NgramSearchBackend, self).partial_match(queryset, search_string)
+        pks = ngram_index().search(search_string)
+        if pks is None or len(pks) > self.max_results:
+            return super(NgramSearchBackend, self).partial_match(queryset, search_string)
+        return queryset.filter(pk__in=pks)
+
+    def fuzzy_match(self, queryset, search_key, max_distance, language_id=None, glossary_id=None):
+        if connection.in_atomic_block:
+            # See partial_match()
+            return super(NgramSearchBackend, self).fuzzy_match(queryset, search_key, max_distance)
+        index = get_index('fuzzy', FuzzyIndex)
+        # Changes of other processes are applied from other threads
+        with _index_lock:
+            return index.search(search_key, max_distance, language_id, glossary_id)
+
+
+def get_search_backend():
+    """The backend set in settings.SEARCH_BACKEND, or the best one for the database."""
+    backend = getattr(settings, 'SEARCH_BACKEND', None)
+    if backend:
+        return import_string(backend)()
+    if connection.vendor == 'postgresql':
+        return TrigramSearchBackend()
+    return NgramSearchBackend()
@@ -1,15 +1,33 @@
 # -*- coding: UTF-8 -*-
 from __future__ import print_function
 
+from datetime import timedelta
+import json
 import os.path
+import time
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
-from django.test.client import Client
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command, CommandError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.client import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.utils import six
+from django.utils.timezone import now
+import django_comments
 
 from terminator.forms import *
+from terminator.replicas import PIN_SESSION_KEY, ReplicaMiddleware, use_primary, use_replica
+from terminator.search import levenshtein, search_cache_stats
+from terminator.views.tbx_export import ConceptCursor, chunked, export_data
+from terminator.views.tbx_import import (TBXImporter, bulk_create_with_ids,
+                                         claim_import_job, import_uploaded_file,
+                                         run_import_job)
 
 # These are meant as high-level tests. The idea is to exercise a lot code in
 # an attempt to test interaction with the Django components, primarily. This
@@ -182,6 +200,213 @@ class URLsB(TestCase):
             "filter_by_language": "en",
             })
         self.assertNotContains(response, "No results found.")
+        # Case and accents are ignored
+        response = self.c.get('/search/', {"search_string": "PESTANA"})
+        self.assertContains(response, "pestaña")
+
+    def test_search_pages(self):
+        glossary = Glossary.objects.get(pk=1)
+        created = []
+        for i in range(45):
+            concept = Concept.objects.create(glossary=glossary)
+            translation = Translation(concept=concept, language_id="en", translation_text="Paged")
+            translation.save()
+            created.append(translation.pk)
+        found = []
+        query_counts = []
+        url = '/search/?search_string=paged'
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.c.get(url)
+            query_counts.append(len(queries))
+            found.extend(r["translation"].pk for r in response.context["search_results"])
+            url = response.context["next_page_url"]
+            if url:
+                url = '/search/' + url
+        self.assertEqual(found, created)
+        self.assertEqual(query_counts, [query_counts[0]] * 3)
+        self.assertContains(response, "First page")
+
+    def test_search_ranking(self):
+        glossary = Glossary.objects.get(pk=1)
+        expected = [
+                ("Rankable", "preferredTerm-admn-sts", True),
+                ("rankable", "preferredTerm-admn-sts", False),
+                ("Rankable", None, True),
+                ("rankable", "deprecatedTerm-admn-sts", True),
+                ("Rankables", "preferredTerm-admn-sts", True),
+                ("unrankable", "preferredTerm-admn-sts", True),
+        ]
+        for text, status, finalized in reversed(expected):
+            concept = Concept.objects.create(glossary=glossary)
+            Translation(concept=concept, language_id="en", translation_text=text,
+                        administrative_status_id=status, is_finalized=finalized).save()
+        response = self.c.get('/advanced_search/', {
+            "search_string": "rankable",
+            "also_show_partial_matches": True,
+            })
+        self.assertEqual([
+                (t.translation_text, t.administrative_status_id, t.is_finalized) for t in
+                (r["translation"] for r in response.context["search_results"])
+        ], expected)
+
+    def test_search_definitions(self):
+        glossary = Glossary.objects.get(pk=1)
+        for i in range(3):
+            concept = Concept.objects.create(glossary=glossary)
+            Translation(concept=concept, language_id="en", translation_text="defined").save()
+            Translation(concept=concept, language_id="gl", translation_text="definido").save()
+            if i:
+                Definition.objects.create(concept=concept, language_id="gl", text="Definición %d" % i)
+                Definition.objects.create(concept=concept, language_id="en", text="Definition %d" % i)
+
+        response = self.c.get('/search/', {"search_string": "defined"})
+        self.assertEqual([r["definition"] for r in response.context["search_results"]],
+                         [None, "Definition 1", "Definition 2"])
+        self.assertContains(response, "Definition 2")
+        self.assertNotContains(response, "Definición 2")
+
+    def test_search_cache(self):
+        search_cache_stats(reset=True)
+        params = {
+            "search_string": "window",
+            "filter_by_glossary": 1,
+            "also_show_partial_matches": True,
+        }
+        response = self.c.get('/advanced_search/', params)
+        self.assertContains(response, "window")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.c.get('/advanced_search/', params)
+        self.assertContains(response, "window")
+        # Only the glossary of the form
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(search_cache_stats(), (1, 1))
+
+        # Changes in the glossary are seen immediately
+        translation = Translation.objects.get(translation_text="window")
+        translation.translation_text = "windows"
+        translation.save()
+        # Done when the transaction commits
+        update_touched_glossaries()
+        response = self.c.get('/advanced_search/', params)
+        self.assertContains(response, "windows")
+        out = six.StringIO()
+        err = six.StringIO()
+        call_command('search_cache_stats', '--reset', stdout=out, stderr=err)
+        self.assertEqual(out.getvalue(), "1 hits, 2 misses (33.3% hits)\n")
+        # The tests use the default cache, which is local to the process
+        self.assertIn("shared between processes", err.getvalue())
+        self.assertEqual(search_cache_stats(), (0, 0))
+
+    def test_fuzzy_search(self):
+        self.assertEqual(levenshtein("kitten", "sitting"), 3)
+        self.assertEqual(levenshtein("", "abc"), 3)
+        response = self.c.get('/advanced_search/', {
+            "search_string": "windw",
+            "max_differences": 1,
+            })
+        self.assertEqual(
+                [r["translation"].translation_text for r in response.context["search_results"]],
+                ["window"],
+        )
+        response = self.c.get('/advanced_search/', {
+            "search_string": "tabs",
+            "max_differences": 2,
+            "filter_by_language": "en",
+            })
+        results = [r["translation"] for r in response.context["search_results"]]
+        self.assertEqual(results[0].translation_text, "tab")
+        # The closest first, and then the preferred terms
+        self.assertEqual([levenshtein("tabs", t.search_key) for t in results],
+                         sorted(levenshtein("tabs", t.search_key) for t in results))
+        self.assertGreater(len(results), 1)
+
+    def test_fuzzy_search_pages(self):
+        glossary = Glossary.objects.get(pk=1)
+        created = []
+        for text in ["Pagex", "Paged", "Pages", "Pagrd"] * 12:
+            concept = Concept.objects.create(glossary=glossary)
+            translation = Translation(concept=concept, language_id="en", translation_text=text)
+            translation.save()
+            created.append(translation)
+        found = []
+        url = '/advanced_search/?search_string=paged&max_differences=1'
+        while url:
+            response = self.c.get(url)
+            found.extend(r["translation"].pk for r in response.context["search_results"])
+            url = response.context["next_page_url"]
+            if url:
+                url = '/advanced_search/' + url
+        self.assertEqual(len(found), len(created))
+        # The exact matches first
+        self.assertEqual(set(found[:12]), set(t.pk for t in created if t.translation_text == "Paged"))
+        self.assertEqual(set(found), set(t.pk for t in created))
+
+    def test_lookup(self):
+        def lookup(data):
+            return self.c.post('/api/lookup/', json.dumps(data), content_type="application/json")
+
+        with self.assertNumQueries(4):
+            response = lookup({"source": "en", "target": "gl", "terms": ["Window", "TAB", "nothing"]})
+        results = response.json()["results"]
+        self.assertEqual([r["term"] for r in results], ["Window", "TAB", "nothing"])
+        self.assertEqual(results[0]["concepts"], [{
+            "id": 2,
+            "glossary": Concept.objects.get(pk=2).glossary.name,
+            "target_terms": [
+                {"term": "xanela", "status": "preferredTerm-admn-sts", "is_finalized": True},
+                {"term": "fiestra", "status": None, "is_finalized": True},
+                {"term": "ventá", "status": "deprecatedTerm-admn-sts", "is_finalized": True},
+            ],
+            # Only finalized definitions
+            "definitions": {"en": Definition.objects.get(concept=2, language="en").text},
+        }])
+        self.assertEqual([c["id"] for c in results[1]["concepts"]], [3, 14, 15])
+        self.assertEqual([t["term"] for t in results[1]["concepts"][2]["target_terms"]], ["TAB", "tabulador"])
+        self.assertEqual(results[2]["concepts"], [])
+
+        # The same number of queries for many terms
+        terms = ["term %d" % i for i in range(800)] + ["window"]
+        with self.assertNumQueries(4):
+            response = lookup({"source": "en", "target": "gl", "terms": terms, "glossaries": [1]})
+        self.assertEqual(len(response.json()["results"][-1]["concepts"]), 1)
+        # The glossaries count against the query parameter limit too
+        glossaries = list(range(1, 101))
+        with self.assertNumQueries(5):
+            response = lookup({"source": "en", "target": "gl", "terms": terms, "glossaries": glossaries})
+        self.assertEqual(len(response.json()["results"][-1]["concepts"]), 1)
+        response = lookup({"source": "en", "target": "gl", "terms": terms, "glossaries": glossaries + [101]})
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(lookup({"source": "en", "target": "xx", "terms": []}).status_code, 400)
+        self.assertEqual(lookup({"source": "en", "target": "gl", "terms": "tab"}).status_code, 400)
+        self.assertEqual(lookup(["tab"]).status_code, 400)
+        self.assertEqual(lookup({"source": ["en"], "target": "gl", "terms": []}).status_code, 400)
+        self.assertEqual(self.c.get('/api/lookup/').status_code, 405)
+
+    def test_annotate(self):
+        def annotate(data):
+            return self.c.post('/api/annotate/', json.dumps(data), content_type="application/json")
+
+        text = "Preme a TABULACIÓN ou o tabulador\u0301 na fiestra."
+        response = annotate({"language": "gl", "text": text})
+        annotations = response.json()["annotations"]
+        self.assertEqual([(a["text"], a["concepts"]) for a in annotations], [
+                ("TABULACIÓN", [14]),
+                ("tabulador\u0301", [15]),
+                ("fiestra", [2]),
+        ])
+        self.assertEqual(text[annotations[0]["start"]:annotations[0]["end"]], "TABULACIÓN")
+        self.assertEqual(annotations[0]["terms"], ["tabulación"])
+        self.assertEqual(annotate({"language": "xx", "text": text}).status_code, 400)
+        self.assertEqual(annotate({"language": "gl", "text": text, "glossary": 1000}).status_code, 400)
+        self.assertEqual(annotate({"language": "gl"}).status_code, 400)
+
+    def test_suggest(self):
+        response = self.c.get('/api/suggest/en/', {"q": "TA"})
+        self.assertEqual(response.json()["suggestions"][0]["term"], "tab")
+        response = self.c.get('/api/suggest/xx/', {"q": "TA"})
+        self.assertEqual(response.status_code, 404)
 
     def test_concept(self):
         response = self.c.get('/concepts/1/')
@@ -295,6 +520,101 @@ class URLsB(TestCase):
         })
         self.assertContains(response, "today")
         self.assertContains(response, "usuario", count=4) #header + history
+        response = self.c.get('/concepts_source/1/')
+        self.assertContains(response, "today")
+        self.assertContains(response, "usuario", count=4)
+
+    def test_concept_snapshot(self):
+        # Template fragments of other tests are cached by concept and language
+        cache.clear()
+        # Pages that only read don't store anything
+        response = self.c.get('/concepts_source/1/')
+        self.assertFalse(ConceptSnapshot.objects.filter(concept=1, language="en").exists())
+        ConceptSnapshot.build(1, "en")
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.c.get('/concepts_source/1/')
+        self.assertEqual(cached.context["translations"], response.context["translations"])
+        self.assertContains(cached, "search")
+        # Only the navigation and the comments need more than the snapshot
+        tables = ("terminator_translation", "terminator_definition", "terminator_conceptinlanguage")
+        self.assertFalse([q for q in queries.captured_queries if any(t in q['sql'] for t in tables)])
+
+        translation = Translation(concept_id=1, language_id="en", translation_text="snapshotted")
+        translation.save()
+        self.assertFalse(ConceptSnapshot.objects.filter(concept=1).exists())
+        self.assertContains(self.c.get('/concepts_source/1/'), "snapshotted")
+        # Built again when the transaction commits
+        build_changed_snapshots()
+        self.assertIn("snapshotted", ConceptSnapshot.objects.get(concept=1, language="en").data)
+
+        # Terms in other languages are shown on the pages of the concept
+        Glossary.objects.get(pk=1).other_languages.add("gl")
+        ConceptSnapshot.build(1, "gl")
+        self.assertContains(self.c.get('/concepts/1/gl/edit'), "snapshotted")
+        translation.language_id = "gl"
+        translation.save()
+        self.assertFalse(ConceptSnapshot.objects.filter(concept=1).exists())
+        build_changed_snapshots()
+        self.assertEqual(ConceptSnapshot.objects.filter(concept=1).count(), 2)
+        self.assertIn("snapshotted",
+                [t.translation_text for t in self.c.get('/concepts/1/gl/edit').context["translations"]])
+        self.assertNotContains(self.c.get('/concepts_source/1/'), "snapshotted")
+
+        # Related concepts are shown from the snapshot, and outdate it
+        Concept.objects.get(pk=1).related_concepts.add(2)
+        self.assertFalse(ConceptSnapshot.objects.filter(concept__in=[1, 2]).exists())
+        build_changed_snapshots()
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.c.get('/concepts_source/1/'), "window")
+        self.assertFalse([q for q in queries.captured_queries if any(t in q['sql'] for t in tables)])
+        Translation(concept_id=2, language_id="en", translation_text="casement").save()
+        self.assertFalse(ConceptSnapshot.objects.filter(concept=1, language="en").exists())
+        build_changed_snapshots()
+        cache.clear()
+        self.assertContains(self.c.get('/concepts_source/1/'), "casement")
+
+        status = AdministrativeStatus.objects.get(pk="preferredTerm-admn-sts")
+        status.name = "Very preferred"
+        status.save()
+        self.assertFalse(ConceptSnapshot.objects.exists())
+
+    def test_concept_in_language_on_write(self):
+        ConceptInLanguage.objects.all().delete()
+        Glossary.objects.get(pk=1).other_languages.add("gl")
+        self.c.login(username='usuario', password='usuario')
+        for url in ('/concepts_source/1/', '/concepts/1/gl/edit', '/concepts/1/gl/'):
+            response = self.c.get(url)
+            self.assertEqual(response.status_code, 200)
+        self.assertFalse(ConceptInLanguage.objects.exists())
+        self.assertContains(self.c.get('/concepts_source/1/'), 'href="/concepts/1/en/admin"')
+
+        response = self.c.get('/concepts/1/en/admin')
+        concept_in_lang = ConceptInLanguage.objects.get()
+        self.assertRedirects(response, '/admin/terminator/conceptinlanguage/%d/change/' % concept_in_lang.pk)
+        self.assertContains(self.c.get('/concepts_source/1/'), 'href="/admin/terminator/conceptinlanguage/%d/change/"' % concept_in_lang.pk)
+
+        # The first comment
+        response = self.c.get('/concepts/1/gl/edit')
+        self.assertContains(response, 'action="/concepts/1/gl/comment"')
+        data = dict(django_comments.get_form()(ConceptInLanguage(concept_id=1, language_id="gl")).initial)
+        data["comment"] = "The first comment"
+        # Nothing is created for comments that are not posted
+        self.assertEqual(Client().post('/concepts/1/gl/comment', data).status_code, 302)
+        tampered = dict(data, security_hash="0" * 40)
+        self.assertEqual(self.c.post('/concepts/1/gl/comment', tampered).status_code, 400)
+        self.assertEqual(self.c.post('/concepts/1/gl/comment', dict(data, comment="")).status_code, 200)
+        self.assertEqual(self.c.post('/concepts/1/es/comment', data).status_code, 404)
+        self.assertFalse(ConceptInLanguage.objects.filter(concept=1).exclude(language="en").exists())
+        response = self.c.post('/concepts/1/gl/comment', data)
+        self.assertEqual(response.status_code, 302)
+        concept_in_lang = ConceptInLanguage.objects.get(concept=1, language="gl")
+        self.assertContains(self.c.get('/concepts/1/gl/edit'), "The first comment")
+        self.assertEqual(self.c.get('/concepts/1/gl/edit').context["concept_in_lang"].pk, concept_in_lang.pk)
+
+        self.login()
+        self.assertEqual(self.c.get('/concepts/2/en/admin').status_code, 403)
+        self.assertFalse(ConceptInLanguage.objects.filter(concept=2).exists())
 
     def test_concept_target(self):
         # language not added to glossary
@@ -431,9 +751,13 @@ class TBXURLs(TestCase):
         self.c.login(username='test', password='test')
 
     def is_tbx(self, response):
+        """Check that this is a TBX download, and return its content."""
         assert "attachment;" in response['Content-Disposition']
         assert "tbx" in response['Content-Disposition']
-        self.assertContains(response, '<martif type="TBX"')
+        # A streaming response can only be read once.
+        content = b"".join(response.streaming_content)
+        self.assertIn(b'<martif type="TBX"', content)
+        return content
 
     def not_tbx(self, response):
         assert 'Content-Disposition' not in response
@@ -456,14 +780,136 @@ class TBXURLs(TestCase):
             })
             self.is_tbx(response)
 
+    def test_export_streaming(self):
+        from xml.etree import ElementTree
+        self.login()
+        response = self.c.post('/export/', data={
+            "from_glossaries": 1,
+            "export_terms": "all",
+        })
+        self.assertTrue(response.streaming)
+        chunks = list(response.streaming_content)
+        self.assertIn(b"<martif", chunks[0])
+        self.assertNotIn(b"<termEntry", chunks[0])
+        self.assertIn(b"</martif>", chunks[-1])
+        root = ElementTree.fromstring(b"".join(chunks))
+        entries = root.findall("text/body/termEntry")
+        self.assertEqual(len(chunks), len(entries) + 2)
+        self.assertTrue(entries)
+
+    def test_concept_cursor(self):
+        translations = Translation.objects.order_by('concept_id', 'language_id', 'id')
+        concept_ids = sorted(set(translations.values_list('concept_id', flat=True)))
+        # Concepts with more rows than a chunk, and chunks that end in the
+        # middle of a concept
+        for chunk_size in (1, 2, 3, 100):
+            cursor = ConceptCursor(translations, chunk_size=chunk_size)
+            for concept_id in concept_ids:
+                self.assertEqual(cursor.take(concept_id), list(translations.filter(concept_id=concept_id)))
+            self.assertIsNone(cursor.current)
+            self.assertEqual(list(chunked(Concept.objects.order_by('id'), chunk_size)), list(Concept.objects.order_by('id')))
+
+    def test_export_cache(self):
+        import gzip
+        import shutil
+        import tempfile
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        with override_settings(EXPORT_CACHE_DIR=cache_dir):
+            response = self.c.get('/autoterm/gl/')
+            self.assertTrue(response.streaming)
+            etag = response['ETag']
+            content = self.is_tbx(response)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            response = self.c.get('/autoterm/gl/', HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['ETag'], etag)
+            self.assertIn('Accept-Encoding', response['Vary'])
+            self.assertEqual(gzip.GzipFile(fileobj=six.BytesIO(b"".join(response.streaming_content))).read(), content)
+            response = self.c.get('/autoterm/gl/')
+            self.assertEqual(self.is_tbx(response), content)
+            for accept_encoding in ('gzip;q=0', 'deflate, gzip; q=0.0', 'identity', '*;q=0'):
+                response = self.c.get('/autoterm/gl/', HTTP_ACCEPT_ENCODING=accept_encoding)
+                self.assertFalse(response.has_header('Content-Encoding'))
+                self.assertEqual(self.is_tbx(response), content)
+            for accept_encoding in ('GZIP;q=0.5', 'br, *'):
+                response = self.c.get('/autoterm/gl/', HTTP_ACCEPT_ENCODING=accept_encoding)
+                self.assertEqual(response['Content-Encoding'], 'gzip')
+
+            response = self.c.get('/autoterm/gl/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            response = self.c.get('/autoterm/gl/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+
+            translation = Translation.objects.filter(language_id="gl").first()
+            translation.translation_text = "changed"
+            translation.save()
+            update_touched_glossaries()
+            response = self.c.get('/autoterm/gl/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            self.assertIn(b"<term>changed</term>", self.is_tbx(response))
+            # The outdated file is gone
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_export_command(self):
+        import gzip
+        import shutil
+        import tempfile
+        import zipfile
+        from xml.etree import ElementTree
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.login()
+        response = self.c.post('/export/', data={
+            "from_glossaries": [1, 2],
+            "export_terms": "all",
+        })
+        content = self.is_tbx(response)
+
+        path = os.path.join(tmp_dir, "export.tbx")
+        call_command('export_tbx', '1', '2', output=path, processes=1, stdout=six.StringIO())
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+        Glossary.objects.create(name="../up/dir", description="-")
+        path = os.path.join(tmp_dir, "export.zip")
+        call_command('export_tbx', output=path, processes=1, zip=True, stdout=six.StringIO())
+        with zipfile.ZipFile(path) as zip_file:
+            names = sorted(zip_file.namelist())
+            expected = dict(("%s.tbx" % g.name, g.name) for g in Glossary.objects.all())
+            expected["_up_dir.tbx"] = expected.pop("../up/dir.tbx")
+            self.assertEqual(names, sorted(expected))
+            for name in names:
+                root = ElementTree.fromstring(zip_file.read(name))
+                self.assertEqual(root.find("martifHeader/fileDesc/titleStmt/title").text, expected[name])
+
+        # What the web site would serve for /autoterm/gl/
+        content = self.is_tbx(self.c.get('/autoterm/gl/'))
+        with override_settings(EXPORT_CACHE_DIR=tmp_dir):
+            call_command('export_tbx', cache=True, languages=['gl', 'en'], processes=1, stdout=six.StringIO())
+            response = self.c.get('/autoterm/gl/', HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.GzipFile(fileobj=six.BytesIO(b"".join(response.streaming_content))).read(), content)
+        # Whatever order the database returns the glossaries in
+        glossaries = list(Glossary.objects.order_by('pk'))
+        self.assertEqual(
+                export_data(glossaries[::-1])['glossary'],
+                export_data(glossaries)['glossary'],
+        )
+
+        with self.assertRaisesRegexp(CommandError, "does not exist"):
+            call_command('export_tbx', 'nothing', stdout=six.StringIO())
+
     def test_export_externalresources(self):
         self.login()
         response = self.c.post('/export/', data={
             "from_glossaries": 2,
             "export_terms": "all",
         })
-        self.is_tbx(response)
-        self.assertNotContains(response, 'xref')
+        content = self.is_tbx(response)
+        self.assertNotIn(b'xref', content)
 
         r = ExternalResource(concept_id=7, language=None, link_type_id="externalCrossReference")
         r.save()
@@ -471,9 +917,10 @@ class TBXURLs(TestCase):
             "from_glossaries": 2,
             "export_terms": "all",
         })
-        self.is_tbx(response)
-        self.assertContains(response, 'xref')
+        content = self.is_tbx(response)
+        self.assertIn(b'xref', content)
 
+    @override_settings(IMPORT_IN_BACKGROUND=False)
     def test_tbx_import(self):
         self.login()
         response = self.c.post('/import/', data={})
@@ -528,6 +975,822 @@ class TBXURLs(TestCase):
                 })
                 self.assertNotContains(response, "succesful")
                 self.assertContains(response, "Already exists a glossary with the given name. You should provide another one.")
+        # Nothing is stored for a worker
+        self.assertFalse(ImportJob.objects.exists())
+
+    @override_settings(IMPORT_IN_BACKGROUND=True)
+    def test_tbx_import_job(self):
+        self.login()
+        Language(iso_code="zu").save()
+        with open(os.path.join(os.path.dirname(__file__), 'small.tbx'), 'r') as f:
+            response = self.c.post('/import/', {
+                "name": "background",
+                "description": "test description",
+                "source_language": 'en',
+                'imported_file': f
+            })
+        self.assertContains(response, "in the background")
+        job = ImportJob.objects.get()
+        self.assertFalse(Glossary.objects.filter(name="background").exists())
+        status = self.c.get(job.get_absolute_url()).json()
+        self.assertEqual(status["status"], "pending")
+        self.assertEqual(status["concepts_processed"], 0)
+
+        call_command('run_import_jobs', '--once', stdout=six.StringIO())
+        status = self.c.get(job.get_absolute_url()).json()
+        self.assertEqual(status["status"], "succeeded")
+        self.assertEqual(status["concepts_processed"], 2)
+        self.assertTrue(status["elapsed"] >= 0)
+        glossary = Glossary.objects.get(name="background")
+        self.assertEqual(status["glossary"], glossary.get_absolute_url())
+        self.assertEqual(glossary.concept_set.count(), 2)
+
+        self.c.post('/import/', {
+            "name": "failing",
+            "description": "test description",
+            "source_language": 'en',
+            'imported_file': SimpleUploadedFile("failing.tbx", b'<martif><termEntry id="1">'),
+        })
+        call_command('run_import_jobs', '--once', stdout=six.StringIO(), stderr=six.StringIO())
+        job = ImportJob.objects.get(glossary_name="failing")
+        status = self.c.get(job.get_absolute_url()).json()
+        self.assertEqual(status["status"], "failed")
+        self.assertIn("no element found", status["error"])
+        self.assertFalse(Glossary.objects.filter(name="failing").exists())
+
+        # The name is taken while the job is pending
+        for i in range(2):
+            response = self.c.post('/import/', {
+                "name": "twice",
+                "description": "test description",
+                "source_language": 'en',
+                'imported_file': SimpleUploadedFile("empty.tbx", b'<martif></martif>'),
+            })
+        self.assertContains(response, "already being imported")
+        self.assertEqual(ImportJob.objects.filter(glossary_name="twice").count(), 1)
+
+        # A job of a worker that died is claimed again
+        job = claim_import_job()
+        self.assertEqual(job.glossary_name, "twice")
+        self.assertIsNone(claim_import_job())
+        ImportJob.objects.filter(pk=job.pk).update(heartbeat=now() - timedelta(hours=1))
+        self.assertEqual(claim_import_job(), job)
+        run_import_job(job)
+        self.assertEqual(job.status, ImportJob.SUCCEEDED)
+
+        # Only for the user who uploaded the file
+        self.c.logout()
+        User.objects.create_user(username="other", password="other")
+        self.c.login(username='other', password='other')
+        response = self.c.get(job.get_absolute_url())
+        self.assertEqual(response.status_code, 403)
+
+
+
+class ReplicaTests(TestCase):
+
+    def route(self, request, view, write=False):
+        """The database that the view reads from for the request."""
+        databases = []
+
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            databases.append(Translation.objects.db)
+            if write:
+                Translation.objects.filter(pk=0).update(translation_text="")
+            return HttpResponse()
+        middleware = ReplicaMiddleware(get_response)
+        middleware(request)
+        self.assertEqual(Translation.objects.db, "default")
+        return databases[0]
+
+    @override_settings(DATABASE_REPLICAS=["replica"])
+    def test_routing(self):
+        factory = RequestFactory()
+        view = use_replica(lambda request: None)
+        other_view = lambda request: None
+        request = factory.get('/search/')
+        request.session = {}
+        self.assertEqual(self.route(request, view), "replica")
+        self.assertEqual(self.route(request, other_view), "default")
+        with use_primary():
+            self.assertEqual(Translation.objects.db, "default")
+
+        request = factory.post('/search/')
+        request.session = {}
+        self.assertEqual(self.route(request, view), "default")
+        self.assertNotIn(PIN_SESSION_KEY, request.session)
+        self.assertEqual(self.route(request, view, write=True), "default")
+        # Pinned to the default database for a while
+        self.assertIn(PIN_SESSION_KEY, request.session)
+        request = factory.get('/search/')
+        request.session = {PIN_SESSION_KEY: time.time() + 10}
+        self.assertEqual(self.route(request, view), "default")
+        request.session = {PIN_SESSION_KEY: time.time() - 1}
+        self.assertEqual(self.route(request, view), "replica")
+
+        with self.settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.route(request, view), "default")
+
+    @override_settings(DATABASE_REPLICAS=["replica"])
+    def test_streaming(self):
+        databases = []
+
+        def content():
+            for i in range(2):
+                databases.append(Translation.objects.db)
+                yield b"chunk"
+
+        def get_response(request):
+            middleware.process_view(request, use_replica(lambda request: None), (), {})
+            return StreamingHttpResponse(content())
+        middleware = ReplicaMiddleware(get_response)
+        request = RequestFactory().get('/autoterm/')
+        request.session = {}
+        response = middleware(request)
+        self.assertEqual(Translation.objects.db, "default")
+        # Still from the replica while the content is generated
+        self.assertEqual(next(iter(response)), b"chunk")
+        self.assertEqual(databases, ["replica"])
+        response.close()
+        self.assertEqual(Translation.objects.db, "default")
+
+    @override_settings(DATABASE_REPLICAS=["default"])
+    def test_pinned_session(self):
+        client = Client()
+        self.assertEqual(client.get('/search/', {"search_string": "tab"}).status_code, 200)
+        self.assertNotIn(PIN_SESSION_KEY, client.session)
+        # Nothing written
+        client.post('/search/', {"search_string": "tab"})
+        self.assertNotIn(PIN_SESSION_KEY, client.session)
+        User.objects.create_user(username="replicated", password="replicated")
+        client.post('/accounts/login/', {"username": "replicated", "password": "replicated"})
+        self.assertGreater(client.session[PIN_SESSION_KEY], time.time())
+
+
+class SearchTests(TestCase):
+
+    fixtures = ['test_data']
+
+    def test_search_keys(self):
+        self.assertEqual(make_search_key("Ǆemal ﬁle ÀÉÎÕÜ Straße"), "dzemal file aeiou strasse")
+        translation = Translation.objects.get(translation_text="window")
+        self.assertEqual(translation.search_key, "window")
+        translation.translation_text = "Fenêtre"
+        translation.save()
+        self.assertEqual(translation.search_key, "fenetre")
+
+        Translation.objects.filter(pk=translation.pk).update(search_key="")
+        out = six.StringIO()
+        call_command('update_search_keys', stdout=out)
+        self.assertIn("Updated 1 of", out.getvalue())
+        self.assertEqual(Translation.objects.get(pk=translation.pk).search_key, "fenetre")
+        # The in-memory indexes are built again after the commit
+        from terminator import search
+        self.assertIn(None, search._changed_terms.pks)
+        search._changed_terms.pks = set()
+
+        # Decomposition can't make the search key too long
+        translation.translation_text = "\ufdfa" * 100
+        translation.save()
+        self.assertEqual(len(translation.search_key), 255)
+        self.assertEqual(translation.search_key[:18], make_search_key("\ufdfa"))
+
+
+class MemoryIndexTests(TransactionTestCase):
+    """The in-memory indexes only see committed changes."""
+
+    def setUp(self):
+        from terminator import search
+        # The indexes (and rolled back changes) of earlier tests would have
+        # their terms
+        search._indexes.clear()
+        search._feed = search.ChangeFeed()
+        search._changed_terms.pks = set()
+        TermChange.objects.all().delete()
+        for iso_code in ("en", "gl"):
+            Language.objects.get_or_create(iso_code=iso_code, defaults={"name": iso_code})
+        glossary = Glossary(name="indexed", description="-", source_language_id="en")
+        glossary.save()
+        self.concepts = [Concept.objects.create(glossary=glossary) for i in range(2)]
+        for concept, text in ((0, "Tab"), (1, "tab"), (0, "Table"), (1, "tabulación"), (0, "Window"), (1, "indoor")):
+            Translation(concept=self.concepts[concept], language_id="en", translation_text=text).save()
+
+    def test_trigram_backend(self):
+        from terminator import search
+        # Only PostgreSQL can run it, but the query is built the same
+        queryset = search.TrigramSearchBackend().similar(Translation.objects.filter(language_id="en"), "tabla")
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn('"terminator_translation"."search_key" %% %s', sql)
+        self.assertEqual(params[-1], "tabla")
+        self.assertIn('"terminator_translation"."search_key" % tabla', str(queryset.query))
+
+    def test_ngram_backend(self):
+        from terminator import search
+        backend = search.NgramSearchBackend()
+        for search_string in ("tab", "TAB", "indo", "ab", "window", "nothing"):
+            self.assertEqual(
+                    list(backend.partial_match(Translation.objects.all(), search_string)),
+                    list(Translation.objects.filter(translation_text__icontains=search_string)),
+            )
+        self.assertIsNone(search.ngram_index().search("ab"))
+
+        # Kept up to date without rebuilding
+        index = search.ngram_index()
+        translation = Translation(concept=self.concepts[0], language_id="en", translation_text="Tabulator")
+        translation.save()
+        self.assertIs(search.ngram_index(), index)
+        self.assertIn(translation.pk, index.search("bula"))
+        pk = translation.pk
+        translation.delete()
+        self.assertIs(search.ngram_index(), index)
+        self.assertNotIn(pk, index.search("bula"))
+
+        # Rolled back changes are not indexed
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                translation = Translation(concept=self.concepts[0], language_id="en", translation_text="Tabulator")
+                translation.save()
+                raise ValueError
+        self.assertNotIn(translation.pk, search.ngram_index().search("bula"))
+
+        # Bulk changes make it rebuild
+        search.translations_changed()
+        self.assertIsNot(search.ngram_index(), index)
+
+    def test_other_processes(self):
+        from terminator import search
+        index = search.ngram_index()
+        self.assertEqual(len(index.search("ndoo")), 1)
+        # Changes committed by another process (without our signals)
+        translation = Translation.objects.get(translation_text="indoor")
+        Translation.objects.filter(pk=translation.pk).update(translation_text="outdoor")
+        TermChange.objects.create(translation_id=translation.pk)
+        search.sync_indexes(force=True)
+        self.assertEqual(index.search("ndoo"), [])
+        self.assertEqual(index.search("outdo"), [translation.pk])
+        # Not applied again
+        self.assertEqual(search._feed.poll(), [])
+
+        # Changes that we might have missed make the indexes rebuild
+        search._feed.polled -= timedelta(seconds=search.CHANGE_RETENTION)
+        search.sync_indexes()
+        self.assertTrue(index.outdated)
+        self.assertIsNot(search.ngram_index(), index)
+
+        index = search.ngram_index()
+        TermChange.objects.create(translation_id=None)
+        search.sync_indexes(force=True)
+        self.assertIsNot(search.ngram_index(), index)
+
+    def test_suggestions(self):
+        from terminator import search
+        concept_ids = [c.pk for c in self.concepts]
+        self.assertEqual(search.suggestions("en", "TA"), [
+                {"term": "Tab", "concepts": concept_ids},
+                {"term": "Table", "concepts": concept_ids[:1]},
+                {"term": "tabulación", "concepts": concept_ids[1:]},
+        ])
+        self.assertEqual(search.suggestions("en", "tabulac"), [{"term": "tabulación", "concepts": concept_ids[1:]}])
+        self.assertEqual(len(search.suggestions("en", "t", count=2)), 2)
+        self.assertEqual(search.suggestions("en", ""), [])
+        self.assertEqual(search.suggestions("gl", "tab"), [])
+        with self.assertRaises(Language.DoesNotExist):
+            search.suggestions("xx", "tab")
+
+        # Kept up to date without rebuilding
+        index = search._indexes[("prefix", "en")]
+        translation = Translation(concept=self.concepts[0], language_id="en", translation_text="Tablet")
+        translation.save()
+        self.assertIn("Tablet", [s["term"] for s in search.suggestions("en", "tabl")])
+        translation.language_id = "gl"
+        translation.save()
+        self.assertNotIn("Tablet", [s["term"] for s in search.suggestions("en", "tabl")])
+        self.assertIn("Tablet", [s["term"] for s in search.suggestions("gl", "tabl")])
+        translation.delete()
+        self.assertEqual(search.suggestions("gl", "tabl"), [])
+        self.assertIs(search._indexes[("prefix", "en")], index)
+
+        # Changes committed by another process
+        translation = Translation.objects.get(translation_text="Table")
+        Translation.objects.filter(pk=translation.pk).update(translation_text="Tablet", search_key="tablet")
+        TermChange.objects.create(translation_id=translation.pk)
+        search.sync_indexes(force=True)
+        self.assertEqual(search.suggestions("en", "tabl"), [{"term": "Tablet", "concepts": concept_ids[:1]}])
+        self.assertIs(search._indexes[("prefix", "en")], index)
+
+    def test_find_terms(self):
+        from terminator import search
+        text = "Press the tab key, or the Table."
+        self.assertEqual([a["text"] for a in search.find_terms(text, "en")], ["tab", "Table"])
+        index = search._indexes[("annotate", "en", None)]
+        # Multi-word terms, and the longest match wins
+        translation = Translation(concept=self.concepts[1], language_id="en", translation_text="Tab key")
+        translation.save()
+        annotations = search.find_terms(text, "en")
+        self.assertEqual([a["text"] for a in annotations], ["tab key", "Table"])
+        self.assertEqual(annotations[0]["concepts"], [self.concepts[1].pk])
+        translation.delete()
+        self.assertEqual([a["text"] for a in search.find_terms(text, "en")], ["tab", "Table"])
+        self.assertIs(search._indexes[("annotate", "en", None)], index)
+
+        # Only the terms of the glossary
+        glossary_id = self.concepts[0].glossary_id
+        self.assertEqual(len(search.find_terms(text, "en", glossary_id)), 2)
+        other_glossary = Glossary.objects.create(name="other", description="-", source_language_id="en")
+        concept = Concept.objects.create(glossary=other_glossary)
+        Translation(concept=concept, language_id="en", translation_text="press").save()
+        self.assertEqual(len(search.find_terms(text, "en", glossary_id)), 2)
+        self.assertEqual(len(search.find_terms(text, "en", other_glossary.pk)), 1)
+        self.assertEqual(len(search.find_terms(text, "en")), 3)
+
+        # Changes committed by another process
+        translation = Translation.objects.get(translation_text="Window")
+        Translation.objects.filter(pk=translation.pk).update(translation_text="Key", search_key="key")
+        TermChange.objects.create(translation_id=translation.pk)
+        search.sync_indexes(force=True)
+        annotations = search.find_terms(text, "en", glossary_id)
+        self.assertEqual([a["text"] for a in annotations], ["tab", "key", "Table"])
+        self.assertEqual(annotations[1]["concepts"], [self.concepts[0].pk])
+        self.assertEqual(len(search.find_terms(text, "en")), 4)
+        self.assertIs(search._indexes[("annotate", "en", None)], index)
+
+    def test_fuzzy_matches(self):
+        from terminator import search
+        pks = dict(Translation.objects.values_list('translation_text', 'pk'))
+        self.assertEqual(search.fuzzy_matches("tabla", 1), {pks["Table"]: 1})
+        self.assertEqual(search.fuzzy_matches("tabla", 2), {
+                pks["Table"]: 1,
+                pks["Tab"]: 2,
+                pks["tab"]: 2,
+        })
+        self.assertEqual(search.fuzzy_matches("tabla", 2, limit=1), {pks["Table"]: 1})
+        self.assertEqual(search.fuzzy_matches("tabulacion", 0), {pks["tabulación"]: 0})
+        # The same as a table scan, also for short search strings
+        for search_string in ("t", "ta", "tabl", "indor", "window"):
+            for max_distance in (1, 2):
+                self.assertEqual(
+                        search.fuzzy_matches(search_string, max_distance),
+                        search.SearchBackend().fuzzy_match(Translation.objects.all(), search_string, max_distance),
+                )
+        # Only in the language and glossary
+        self.assertEqual(search.fuzzy_matches("tabla", 2, language_id="en"), {
+                pks["Table"]: 1,
+                pks["Tab"]: 2,
+                pks["tab"]: 2,
+        })
+        self.assertEqual(search.fuzzy_matches("tabla", 2, language_id="es"), {})
+        glossary_id = self.concepts[0].glossary_id
+        self.assertEqual(search.fuzzy_matches("tabla", 1, glossary_id=glossary_id), {pks["Table"]: 1})
+        self.assertEqual(search.fuzzy_matches("tabla", 1, glossary_id=glossary_id + 1), {})
+
+        # Kept up to date without rebuilding
+        index = search._indexes["fuzzy"]
+        translation = Translation(concept=self.concepts[0], language_id="en", translation_text="Tabla")
+        translation.save()
+        self.assertEqual(search.fuzzy_matches("tabla", 0), {translation.pk: 0})
+        translation.delete()
+        self.assertEqual(search.fuzzy_matches("tabla", 0), {})
+        translation = Translation(concept=self.concepts[1], language_id="en", translation_text="Tabla")
+        translation.save()
+        self.assertEqual(search.fuzzy_matches("tabla", 0), {translation.pk: 0})
+        self.assertIs(search._indexes["fuzzy"], index)
+
+
+class ReprCacheTests(TransactionTestCase):
+    """
+    The repr_cache (and last_modified of glossaries) is updated once per
+    transaction, after the commit.
+    """
+
+    def setUp(self):
+        for iso_code in ("en", "gl"):
+            Language.objects.get_or_create(iso_code=iso_code, defaults={"name": iso_code})
+        self.glossary = Glossary(name="represented", description="-", source_language_id="en")
+        self.glossary.save()
+        self.concepts = [Concept.objects.create(glossary=self.glossary) for i in range(3)]
+
+    def test_deferred_update(self):
+        concept = self.concepts[0]
+        with transaction.atomic():
+            for text in ("b", "a", "c"):
+                Translation(concept=concept, language_id="en", translation_text=text).save()
+            Translation(concept=concept, language_id="gl", translation_text="d").save()
+            self.assertIsNone(Concept.objects.get(pk=concept.pk).repr_cache)
+        self.assertEqual(Concept.objects.get(pk=concept.pk).repr_cache, "#%d: a, b, c" % concept.pk)
+
+        # Three queries for any number of changes
+        with transaction.atomic():
+            for concept in self.concepts:
+                Translation(concept=concept, language_id="en", translation_text="e").save()
+            with CaptureQueriesContext(connection) as queries:
+                update_changed_repr_caches()
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(Concept.objects.get(pk=self.concepts[2].pk).repr_cache, "#%d: e" % self.concepts[2].pk)
+
+        Translation.objects.filter(translation_text="a").delete()
+        self.assertEqual(Concept.objects.get(pk=self.concepts[0].pk).repr_cache, "#%d: b, c, e" % self.concepts[0].pk)
+
+        # Rolled back changes are not seen
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                Translation(concept=self.concepts[1], language_id="en", translation_text="f").save()
+                raise ValueError
+        Translation(concept=self.concepts[2], language_id="en", translation_text="g").save()
+        self.assertEqual(Concept.objects.get(pk=self.concepts[1].pk).repr_cache, "#%d: e" % self.concepts[1].pk)
+        self.assertEqual(Concept.objects.get(pk=self.concepts[2].pk).repr_cache, "#%d: e, g" % self.concepts[2].pk)
+
+    def test_touched_glossary(self):
+        old = Glossary.objects.get(pk=self.glossary.pk).last_modified
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                for concept in self.concepts:
+                    Translation(concept=concept, language_id="gl", translation_text="t").save(update_repr_cache=False)
+                ContextSentence(translation=Translation.objects.first(), text="A t.").save()
+            self.assertFalse(any(q['sql'].startswith('UPDATE') for q in queries))
+            self.assertEqual(Glossary.objects.get(pk=self.glossary.pk).last_modified, old)
+            with CaptureQueriesContext(connection) as queries:
+                update_touched_glossaries()
+            self.assertEqual(len(queries), 1)
+        self.assertGreater(Glossary.objects.get(pk=self.glossary.pk).last_modified, old)
+
+        old = Glossary.objects.get(pk=self.glossary.pk).last_modified
+        self.concepts[0].delete()
+        self.assertGreater(Glossary.objects.get(pk=self.glossary.pk).last_modified, old)
+
+    def test_rebuild_command(self):
+        for concept in self.concepts:
+            Translation(concept=concept, language_id="en", translation_text="term").save()
+        Concept.objects.update(repr_cache=None)
+        # The snapshots of the pages were built after the commits
+        self.assertEqual(ConceptSnapshot.objects.filter(concept__in=self.concepts).count(), 3)
+        ConceptSnapshot.objects.filter(pk=ConceptSnapshot.objects.first().pk).update(data="outdated")
+        out = six.StringIO()
+        call_command('rebuild_repr_cache', 'represented', stdout=out)
+        self.assertFalse(ConceptSnapshot.objects.filter(data="outdated").exists())
+        self.assertEqual(ConceptSnapshot.objects.filter(concept__in=self.concepts).count(), 3)
+        ConceptSnapshot.objects.all().delete()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('rebuild_repr_cache', 'represented', stdout=out)
+        self.assertEqual(out.getvalue(), "Rebuilt 3 concepts in represented.\n" * 2)
+        self.assertLess(len(queries), 10)
+        self.assertFalse(ConceptSnapshot.objects.exists())
+        call_command('rebuild_repr_cache', 'represented', '--all-snapshots', stdout=out)
+        self.assertEqual(
+                set(ConceptSnapshot.objects.values_list('concept_id', 'language_id')),
+                set((concept.pk, "en") for concept in self.concepts))
+        self.assertEqual(
+                list(Concept.objects.values_list('repr_cache', flat=True)),
+                ["#%d: term" % concept.pk for concept in self.concepts])
+        with self.assertRaises(CommandError):
+            call_command('rebuild_repr_cache', 'nothing', stdout=out)
+
+
+class NavigationTests(TransactionTestCase):
+    """Navigating between concepts uses a per glossary index."""
+
+    def setUp(self):
+        # Versions in the cache could belong to glossaries of other tests
+        cache.clear()
+        Language.objects.get_or_create(iso_code="en", defaults={"name": "en"})
+        self.glossary = Glossary(name="navigated", description="-", source_language_id="en")
+        self.glossary.save()
+        other = Glossary(name="other", description="-", source_language_id="en")
+        other.save()
+        self.concepts = []
+        for i in range(20):
+            self.concepts.append(Concept.objects.create(glossary=self.glossary))
+            Concept.objects.create(glossary=other)
+
+    def from_database(self, concept):
+        with transaction.atomic():
+            return (
+                concept.prev_concept(),
+                concept.next_concept(),
+                list(concept.other_concepts()),
+            )
+
+    def assertNavigation(self, concept):
+        expected = self.from_database(concept)
+        got = (concept.prev_concept(), concept.next_concept(), concept.other_concepts())
+        self.assertEqual(got, expected)
+        self.assertEqual(
+                [c.repr_cache for c in got[2]],
+                [c.repr_cache for c in expected[2]])
+
+    def test_navigation(self):
+        first, last = self.concepts[0], self.concepts[-1]
+        self.assertIsNone(first.prev_concept())
+        self.assertIsNone(last.next_concept())
+        for concept in self.concepts[:7] + self.concepts[-7:]:
+            self.assertNavigation(concept)
+        self.assertEqual(len(first.other_concepts()), 6)
+        self.assertEqual(len(last.other_concepts()), 6)
+
+        with CaptureQueriesContext(connection) as queries:
+            for concept in self.concepts:
+                concept.prev_concept()
+                concept.next_concept()
+                concept.other_concepts()
+        # Only the version of the glossary
+        self.assertFalse([q for q in queries.captured_queries if "terminator_concept" in q['sql']])
+
+    def test_changes(self):
+        concept = self.concepts[10]
+        self.assertNavigation(concept)
+        self.concepts[11].delete()
+        self.assertEqual(concept.next_concept(), self.concepts[12])
+        self.concepts[9].delete()
+        self.assertEqual(concept.prev_concept(), self.concepts[8])
+        new = Concept.objects.create(glossary=self.glossary)
+        self.assertEqual(self.concepts[-1].next_concept(), new)
+        self.assertNavigation(concept)
+
+        Translation(concept=self.concepts[12], language_id="en", translation_text="term").save()
+        self.assertEqual(concept.next_concept().repr_cache, "#%d: term" % self.concepts[12].pk)
+        self.assertNavigation(concept)
+
+        # Changes are only seen after the commit
+        with transaction.atomic():
+            Concept.objects.filter(pk=self.concepts[8].pk).delete()
+            self.assertEqual(concept.prev_concept(), self.concepts[7])
+        self.assertEqual(concept.prev_concept(), self.concepts[7])
+
+        # Seen when another process increments the version
+        last = Concept.objects.filter(glossary=self.glossary).last()
+        Concept.objects.bulk_create([Concept(glossary=self.glossary)])
+        self.assertIsNone(last.next_concept())
+        Glossary.objects.filter(pk=self.glossary.pk).update(navigation_version=F('navigation_version') + 1)
+        self.assertIsNotNone(last.next_concept())
+
+    def test_unchanged(self):
+        from terminator.models import navigation_version
+        other_id = Glossary.objects.get(name="other").pk
+        Language.objects.get_or_create(iso_code="gl", defaults={"name": "gl"})
+        Translation(concept=self.concepts[3], language_id="gl", translation_text="termo").save()
+        version = navigation_version(self.glossary.pk)
+        other_version = navigation_version(other_id)
+        # Nothing shown in the navigation changed
+        Concept.objects.get(pk=self.concepts[3].pk).save()
+        Translation(concept=self.concepts[3], language_id="gl", translation_text="outro termo").save()
+        self.assertEqual(navigation_version(self.glossary.pk), version)
+
+        Translation(concept=self.concepts[3], language_id="en", translation_text="term").save()
+        self.assertNotEqual(navigation_version(self.glossary.pk), version)
+        self.assertEqual(navigation_version(other_id), other_version)
+
+
+class TBXImportTests(TestCase):
+
+    fixtures = ['test_data']
+
+    def import_file(self, filename):
+        glossary = Glossary(name="imported", description="imported", source_language_id="en")
+        glossary.save()
+        with open(os.path.join(os.path.dirname(__file__), filename), 'rb') as f:
+            import_uploaded_file(f, glossary)
+        return glossary
+
+    def test_import_content(self):
+        Language(iso_code="zu").save()
+        glossary = self.import_file('most.tbx')
+        concepts = list(glossary.concept_set.order_by('id'))
+        self.assertEqual(len(concepts), 2)
+        concept = concepts[0]
+        self.assertSequenceEqual(
+                concept.related_concepts.values_list('id', flat=True),
+                [concepts[1].id],
+        )
+        self.assertEqual(concept.repr_cache, "#%d: English term, Alternative English term" % concept.id)
+        translation = concept.translation_set.get(translation_text="English term")
+        self.assertTrue(translation.is_finalized)
+        self.assertEqual(translation.search_key, "english term")
+        self.assertEqual(translation.part_of_speech.tbx_representation, "noun")
+        self.assertEqual(translation.administrative_status_id, "preferredTerm-admn-sts")
+        self.assertEqual(translation.note, "A translation note")
+        self.assertEqual(translation.contextsentence_set.get().text, "context phrase")
+        self.assertEqual(translation.corpusexample_set.get().description, 'Wikipedia page for "word"')
+        definition = concept.definition_set.get(language_id="en")
+        self.assertEqual(definition.text, "A term is a thing that is firm")
+        self.assertEqual(definition.source, "https://en.wikipedia.org/wiki/Word")
+        self.assertEqual(definition.history.count(), 1)
+        resource = concept.externalresource_set.get()
+        self.assertEqual(resource.language_id, "en")
+        self.assertEqual(resource.link_type_id, "externalCrossReference")
+        self.assertEqual(concept.definition_set.get(language_id="zu").text, "A Zulu term is not a Fulah term")
+
+        # The snapshots of the imported concepts are built after the commit
+        build_changed_snapshots()
+        self.assertTrue(ConceptSnapshot.objects.filter(concept=concepts[1], language="en").exists())
+        snapshot = ConceptSnapshot.get_data(concept, Language.objects.get(pk="en"))
+        # The related concept has nothing in English to show
+        self.assertEqual(snapshot["related_concepts"], {})
+        self.assertEqual([r.address for r in snapshot["external_resources"]], [resource.address])
+
+    def generated_tbx(self, count):
+        entries = []
+        for i in range(count):
+            entries.append("""
+            <termEntry id="c%(i)d">
+                <descrip type="broaderConceptGeneric" target="c0"/>
+                <ref type="crossReference" target="c%(related)d"/>
+                <langSet xml:lang="en">
+                    <descrip type="definition">definition %(i)d</descrip>
+                    <tig><term>term %(i)d</term><descrip type="context">context %(i)d</descrip></tig>
+                    <tig><term>other term %(i)d</term></tig>
+                </langSet>
+            </termEntry>""" % {"i": i, "related": (i + 1) % count})
+        tbx = "<martif><text><body>%s</body></text></martif>" % "".join(entries)
+        return six.BytesIO(tbx.encode('utf-8'))
+
+    def test_import_batches(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        query_counts = []
+        for count in (10, 30):
+            glossary = Glossary(name="generated %d" % count, description="-", source_language_id="en")
+            glossary.save()
+            with CaptureQueriesContext(connection) as queries:
+                importer = import_uploaded_file(self.generated_tbx(count), glossary, batch_size=50)
+            query_counts.append(len(queries))
+            self.assertEqual(importer.concept_count, count)
+            self.assertEqual(Translation.objects.filter(concept__glossary=glossary).count(), count * 2)
+            self.assertEqual(ContextSentence.objects.filter(translation__concept__glossary=glossary).count(), count)
+            self.assertEqual(Definition.history.filter(concept__glossary=glossary).count(), count)
+            first = glossary.concept_set.order_by('id').first()
+            self.assertEqual(first.narrower_concepts.count(), count)
+            self.assertEqual(first.related_concepts.count(), 2)
+            self.assertEqual(first.repr_cache, "#%d: other term 0, term 0" % first.id)
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        glossary = Glossary(name="small batches", description="-", source_language_id="en")
+        glossary.save()
+        import_uploaded_file(self.generated_tbx(7), glossary, batch_size=3)
+        self.assertSequenceEqual(
+                [c.translation_set.order_by('id').first().translation_text for c in glossary.concept_set.order_by('id')],
+                ["term %d" % i for i in range(7)],
+        )
+
+    def test_export_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from terminator.views.tbx_export import export_data, render_tbx
+
+        query_counts = []
+        for count in (10, 30):
+            glossary = Glossary(name="exported %d" % count, description="-", source_language_id="en")
+            glossary.save()
+            import_uploaded_file(self.generated_tbx(count), glossary)
+            first = glossary.concept_set.order_by('id').first()
+            glossary.concept_set.exclude(pk=first.pk).update(subject_field=first)
+            with CaptureQueriesContext(connection) as queries:
+                content = b"".join(s.encode('utf-8') for s in render_tbx(export_data([glossary])))
+            query_counts.append(len(queries))
+            self.assertEqual(content.count(b"<termEntry"), count)
+            self.assertEqual(content.count(b'<descrip type="broaderConceptGeneric" target="cid-%d">' % first.pk), count)
+            self.assertEqual(content.count(b'<descrip type="subjectField">term 0</descrip>'), count - 1)
+            # related concepts are symmetrical
+            self.assertEqual(content.count(b'<ref type="crossReference" target="cid-'), count * 3 - 1)
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_import_merge(self):
+        glossary = Glossary(name="merged", description="-", source_language_id="en")
+        glossary.save()
+        import_uploaded_file(self.generated_tbx(5), glossary)
+        ids = dict(glossary.concept_set.values_list('tbx_id', 'id'))
+        term_3 = Translation.objects.get(concept_id=ids["c3"], translation_text="term 3")
+        definition_2 = Definition.objects.get(concept_id=ids["c2"])
+
+        tbx = self.generated_tbx(6).getvalue()
+        tbx = tbx.replace(b"definition 2<", b"new definition 2<")
+        tbx = tbx.replace(b"other term 3<", b"renamed term 3<")
+        importer = TBXImporter(glossary, merge=True)
+        importer.import_file(six.BytesIO(tbx))
+        # c4 changed, since it is now related to c5 instead of c0
+        self.assertEqual(importer.created_count, 1)
+        self.assertEqual(importer.updated_count, 3)
+        new_ids = dict(glossary.concept_set.values_list('tbx_id', 'id'))
+        self.assertEqual(len(new_ids), 6)
+        self.assertEqual(dict((k, v) for (k, v) in new_ids.items() if k != "c5"), ids)
+
+        self.assertSequenceEqual(
+                Translation.objects.filter(concept_id=ids["c3"]).order_by('translation_text').values_list('translation_text', flat=True),
+                ["renamed term 3", "term 3"],
+        )
+        self.assertEqual(Translation.objects.get(concept_id=ids["c3"], translation_text="term 3").pk, term_3.pk)
+        definition = Definition.objects.get(concept_id=ids["c2"])
+        self.assertEqual(definition.pk, definition_2.pk)
+        self.assertEqual(definition.text, "new definition 2")
+        self.assertEqual(definition.history.count(), 2)
+        self.assertEqual(Concept.objects.get(pk=ids["c3"]).repr_cache, "#%d: renamed term 3, term 3" % ids["c3"])
+        self.assertSequenceEqual(
+                sorted(Concept.objects.get(pk=ids["c0"]).related_concepts.values_list('id', flat=True)),
+                sorted([ids["c1"], new_ids["c5"]]),
+        )
+        self.assertEqual(Concept.objects.get(pk=new_ids["c5"]).broader_concept_id, ids["c0"])
+        self.assertEqual(ContextSentence.objects.filter(translation__concept__glossary=glossary).count(), 6)
+
+        # Nothing changed this time
+        importer = TBXImporter(glossary, merge=True)
+        importer.import_file(six.BytesIO(tbx))
+        self.assertEqual(importer.created_count + importer.updated_count, 0)
+        self.assertEqual(Translation.objects.filter(concept__glossary=glossary).count(), 12)
+
+        # Long ids are cut the same way where they are referred to
+        long_id = "c" * 150
+        tbx = """<martif><text><body>
+            <termEntry id="%s"><langSet xml:lang="%s"><tig><term>long</term></tig></langSet></termEntry>
+            <termEntry id="short"><ref type="crossReference" target="%s"/></termEntry>
+            </body></text></martif>"""
+        importer = TBXImporter(glossary, merge=True)
+        importer.import_file(six.BytesIO((tbx % (long_id, "en", long_id)).encode('utf-8')))
+        concept = glossary.concept_set.get(tbx_id=long_id[:100])
+        self.assertEqual(list(concept.related_concepts.values_list('tbx_id', flat=True)), ["short"])
+        # Without source terms after a merge
+        importer = TBXImporter(glossary, merge=True)
+        importer.import_file(six.BytesIO((tbx % (long_id, "gl", long_id)).encode('utf-8')))
+        self.assertEqual((importer.created_count, importer.updated_count), (0, 1))
+        update_changed_repr_caches()
+        self.assertEqual(Concept.objects.get(pk=concept.pk).repr_cache, "#%d: " % concept.pk)
+
+    def test_merge_export(self):
+        import shutil
+        import tempfile
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        glossary = Glossary.objects.get(pk=1)
+        path = os.path.join(tmp_dir, "export.tbx")
+        call_command('export_tbx', '1', output=path, processes=1, stdout=six.StringIO())
+        for expected_updates in (glossary.concept_set.count(), 0):
+            importer = TBXImporter(glossary, merge=True)
+            with open(path, 'rb') as f:
+                importer.import_file(f)
+            self.assertEqual(importer.created_count, 0)
+            # Only the first time, since the concepts weren't imported before
+            self.assertEqual(importer.updated_count, expected_updates)
+
+        # More terms to delete than SQLite allows query parameters
+        terms = "".join("<tig><term>term %d</term></tig>" % i for i in range(1000))
+        tbx = '<martif><text><body><termEntry id="c1"><langSet xml:lang="en">%s</langSet></termEntry></body></text></martif>'
+        import_uploaded_file(six.BytesIO((tbx % terms).encode('utf-8')), glossary)
+        concept = glossary.concept_set.get(tbx_id="c1")
+        importer = TBXImporter(glossary, merge=True)
+        importer.import_file(six.BytesIO((tbx % "<tig><term>term 1</term></tig>").encode('utf-8')))
+        self.assertEqual(importer.updated_count, 1)
+        self.assertEqual(list(concept.translation_set.values_list('translation_text', flat=True)), ["term 1"])
+
+    def test_import_command(self):
+        Language(iso_code="zu").save()
+        path = os.path.join(os.path.dirname(__file__), 'most.tbx')
+        out = six.StringIO()
+        call_command('import_tbx', path, name="from disk", dry_run=True, stdout=out)
+        self.assertIn("Checked 2 concepts", out.getvalue())
+        self.assertFalse(Glossary.objects.filter(name="from disk").exists())
+
+        out = six.StringIO()
+        call_command('import_tbx', path, name="from disk", batch_size=1, verbosity=2, stdout=out)
+        self.assertIn("Imported 2 concepts", out.getvalue())
+        self.assertIn("concepts/s", out.getvalue())
+        glossary = Glossary.objects.get(name="from disk")
+        self.assertEqual(glossary.concept_set.count(), 2)
+
+        out = six.StringIO()
+        call_command('import_tbx', path, glossary="from disk", merge=True, stdout=out)
+        self.assertIn("0 added, 0 updated, 2 unchanged", out.getvalue())
+        call_command('import_tbx', path, glossary=str(glossary.pk), stdout=six.StringIO())
+        self.assertEqual(glossary.concept_set.count(), 4)
+        with self.assertRaisesRegexp(CommandError, "--merge"):
+            call_command('import_tbx', path, name="other", merge=True, stdout=six.StringIO())
+
+        with self.assertRaisesRegexp(CommandError, "already exists"):
+            call_command('import_tbx', path, name="from disk", stdout=six.StringIO())
+        with self.assertRaisesRegexp(CommandError, "does not exist"):
+            call_command('import_tbx', path, glossary="nothing", stdout=six.StringIO())
+        with self.assertRaisesRegexp(CommandError, "The import process failed"):
+            call_command('import_tbx', __file__, glossary="from disk", stdout=six.StringIO())
+
+    def test_import_errors(self):
+        glossary = Glossary(name="imported", description="imported", source_language_id="en")
+        glossary.save()
+        tbx = b"""<martif><text><body>
+            <termEntry id="c1"><descrip type="broaderConceptGeneric" target="c2"/></termEntry>
+            </body></text></martif>"""
+        with self.assertRaisesRegexp(Exception, 'uses the concept "c2" as its broader concept'):
+            import_uploaded_file(six.BytesIO(tbx), glossary)
+        with self.assertRaises(Exception):
+            import_uploaded_file(six.BytesIO(b"<martif><termEntry>"), glossary)
+
+    def test_bulk_create_ids(self):
+        glossary = Glossary.objects.get(pk=1)
+        concepts = [Concept(glossary=glossary) for i in range(3)]
+        bulk_create_with_ids(Concept, concepts, Concept.objects.filter(glossary=glossary))
+        self.assertEqual([c.glossary_id for c in Concept.objects.filter(pk__in=[c.pk for c in concepts])], [1, 1, 1])
+        if connection.features.can_return_ids_from_bulk_insert:
+            return
+        # Rows of others in the scope aren't matched to the wrong objects
+        with self.assertRaises(IntegrityError):
+            bulk_create_with_ids(Concept, [Concept(glossary=glossary)], Concept.objects.exclude(glossary=glossary))
 
 
 class AdminFormTests(TestCase):
@@ -715,6 +1978,8 @@ class ConceptTest(SharedTests, TestCase):
         tr = self.translation
         tr.translation_text = u"abcd"
         tr.save()
+        # Updated on commit, which never comes in a TestCase
+        update_changed_repr_caches()
         self.model.refresh_from_db()
         repr_cache = self.model.repr_cache
         assert repr_cache.startswith('#')
@@ -727,6 +1992,7 @@ class ConceptTest(SharedTests, TestCase):
                 administrative_status_id='preferredTerm-admn-sts',
         )
         tr.save()
+        update_changed_repr_caches()
         self.model.refresh_from_db()
         repr_cache = self.model.repr_cache
         assert repr_cache.startswith('#')
@@ -737,6 +2003,7 @@ class ConceptTest(SharedTests, TestCase):
         s.save()
         tr.administrative_status_id = 'deprecatedTerm-admn-sts'
         tr.save()
+        update_changed_repr_caches()
         self.model.refresh_from_db()
         repr_cache = self.model.repr_cache
         assert 'abcd, xyz' in repr_cache
@@ -23,7 +23,9 @@ from django_comments.feeds import LatestCommentFeed
 
 from terminator import feeds
 from terminator import views
+from terminator.views import lookup
 from terminator.models import Concept, Glossary, Proposal, Translation
+from terminator.replicas import use_replica
 from terminator_comments_app.feeds import CommentThreadFeed
 
 
@@ -40,9 +42,9 @@ urlpatterns = [
         ),
         name='terminator_glossary_list'),
     url(r'^glossaries/(?P<pk>\d+)/$',
-        views.GlossaryDetailView.as_view(
+        use_replica(views.GlossaryDetailView.as_view(
             model=Glossary,
-        ),
+        )),
         name='terminator_glossary_detail'),
     url(r'^glossaries/(?P<pk>\d+)/concepts/$',
         views.GlossaryConceptsView.as_view(
@@ -62,9 +64,9 @@ urlpatterns = [
         ),
         name='terminator_concept_detail_for_language'),
     url(r'^concepts_source/(?P<pk>\d+)/$',
-        views.ConceptSourceView.as_view(
+        use_replica(views.ConceptSourceView.as_view(
             model=Concept,
-        ),
+        )),
         name='terminator_concept_source'),
 
     url(r'^concepts/(?P<pk>\d+)/(?P<lang>\w+)/edit$',
@@ -72,34 +74,49 @@ urlpatterns = [
             model=Concept,
         ),
         name='terminator_concept_target'),
+    url(r'^concepts/(?P<pk>\d+)/(?P<lang>\w+)/admin$',
+        views.concept_in_language_admin,
+        name='terminator_concept_in_language_admin'),
+    url(r'^concepts/(?P<pk>\d+)/(?P<lang>\w+)/comment$',
+        views.concept_in_language_comment,
+        name='terminator_concept_in_language_comment'),
 
 
     # Search URLs
     url(r'^search/$',
-        views.search,
+        use_replica(views.search),
         name='terminator_search'),
     url(r'^advanced_search/$',
-        views.search,
+        use_replica(views.search),
         name='terminator_advanced_search'),
+    url(r'^api/suggest/(?P<language_code>[-\w]+)/$',
+        views.suggest,
+        name='terminator_suggest'),
+    url(r'^api/lookup/$',
+        lookup.lookup,
+        name='terminator_lookup'),
+    url(r'^api/annotate/$',
+        lookup.annotate,
+        name='terminator_annotate'),
 
     # Feed URLs
     url(r'^feeds/glossaries/$',
-        feeds.LatestChangesGenericFeed(Glossary),
+        use_replica(feeds.LatestChangesGenericFeed(Glossary)),
         name='terminator_feed_glossaries'),
     url(r'^feeds/concepts/$',
-        feeds.LatestChangesGenericFeed(Concept),
+        use_replica(feeds.LatestChangesGenericFeed(Concept)),
         name='terminator_feed_concepts'),
     url(r'^feeds/translations/$',
-        feeds.LatestChangesGenericFeed(Translation),
+        use_replica(feeds.LatestChangesGenericFeed(Translation)),
         name='terminator_feed_translations'),
     url(r'^feeds/all/$',
-        feeds.LatestChangesFeed((Glossary, Concept, Translation)),
+        use_replica(feeds.LatestChangesFeed((Glossary, Concept, Translation))),
         name='terminator_feed_all'),
     url(r'^feeds/comments/$',
-        LatestCommentFeed(),
+        use_replica(LatestCommentFeed()),
         name='terminator_feed_comments'),
     url(r'^feeds/comments/(?P<concept_id>\d+)/(?P<language_id>\w+)/$',
-        CommentThreadFeed(),
+        use_replica(CommentThreadFeed()),
         name='terminator_feed_commentthread'),
 
     # TODO URLs
@@ -148,18 +165,21 @@ if settings.FEATURES.get("autoterm"):
             ),
             name='terminator_autoterm_index'),
         url(r'^autoterm/(?P<language_code>\w+)/$',
-            views.autoterm,
+            use_replica(views.autoterm),
             name='terminator_autoterm_query'),
     ])
 
 # Import URLs
 if settings.FEATURES.get("import_tbx"):
     from terminator.views import tbx_import
-    urlpatterns.append(
+    urlpatterns.extend([
         url(r'^import/$',
             tbx_import.import_view,
             name='terminator_import'),
-    )
+        url(r'^import/jobs/(?P<pk>\d+)/$',
+            tbx_import.import_job_status,
+            name='terminator_import_job'),
+    ])
 
 # Export URLs
 if settings.FEATURES.get("export_tbx"):
@@ -16,7 +16,9 @@
 # You should have received a copy of the GNU General Public License along with
 # Terminator. If not, see <http://www.gnu.org/licenses/>.
 
-from itertools import groupby, islice
+from itertools import islice
+import hashlib
+import json
 import re
 
 from django.conf import settings
@@ -24,20 +26,23 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.core.paginator import EmptyPage, InvalidPage, Paginator
 from django.db import transaction, DatabaseError
-from django.db.models import Prefetch, Q
-from django.db.models import OuterRef, Subquery
+from django.db.models import Count, Max, Prefetch, Q
 from django.db.models import prefetch_related_objects
-from django.http import HttpResponse
+from django.http import JsonResponse
 from django.shortcuts import (get_object_or_404, render, Http404, redirect)
-from django.template import loader
 from django.utils.encoding import force_text
+from django.utils.html import escape
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.http import require_POST
 from django.views.generic import DetailView, ListView, TemplateView
+import django_comments
 from django_comments.models import Comment
+from django_comments.views.comments import CommentPostBadRequest, post_comment
 
 from guardian.core import ObjectPermissionChecker
 from guardian.shortcuts import get_perms
@@ -47,6 +52,10 @@ from terminator.forms import (AdvancedSearchForm, CollaborationRequestForm,
                               SubscribeForm, ConceptInLanguageForm,
                               ExternalResourceForm)
 from terminator.models import *
+from terminator.search import (SEARCH_CACHE_TIMEOUT, count_search_cache_lookup,
+                               fuzzy_matches, get_search_backend, search_rank,
+                               suggestions)
+from terminator.views.tbx_export import export_glossaries_to_TBX
 
 
 def terminator_profile_detail(request, username):
@@ -212,10 +221,7 @@ class ConceptDetailView(TerminatorDetailView):
             language = Language.objects.get(pk=self.kwargs.get('lang'))
         except Language.DoesNotExist:
             raise Http404
-        concept_in_language, created = ConceptInLanguage.objects.get_or_create(
-                concept=context['concept'],
-                language=language,
-        )
+        concept_in_language = ConceptInLanguage.get_or_unsaved(context['concept'], language)
         context['current_language'] = language
         translations = context['concept'].translation_set.filter(
                 language=language,
@@ -230,6 +236,9 @@ class ConceptDetailView(TerminatorDetailView):
 
 class ConceptSourceView(TerminatorDetailView):
 
+    concept_in_lang = None
+    snapshot = None
+
     def get_queryset(self):
         qs = super(ConceptSourceView, self).get_queryset()
         return qs.select_related('glossary', 'glossary__source_language')
@@ -246,31 +255,40 @@ class ConceptSourceView(TerminatorDetailView):
         return self.object.glossary.source_language
 
     def get_concept_in_lang(self):
-        self.concept_in_lang, _c = ConceptInLanguage.objects.get_or_create(
-                concept=self.object,
-                language=self.object.glossary.source_language,
-        )
-        # Avoid the query if the template uses concept_in_lang.concept:
-        self.concept_in_lang.concept = self.object
+        if not self.concept_in_lang:
+            self.concept_in_lang = ConceptInLanguage.get_or_unsaved(
+                    self.object,
+                    self.object.glossary.source_language,
+            )
+            # Avoid the query if the template uses concept_in_lang.concept:
+            self.concept_in_lang.concept = self.object
         return self.concept_in_lang
 
     def may_edit(self, glossary_perms):
         return 'terminologist' in glossary_perms or \
                     ('specialist' in glossary_perms and \
-                    not self.object.source_language_finalized())
+                    not self.get_concept_in_lang().is_finalized)
+
     def get_context_data(self, **kwargs):
         context = super(ConceptSourceView, self).get_context_data(**kwargs)
         concept = context['concept']
         language = self.get_language()
-        translations = Translation.objects.filter(concept=concept, language=language)
         initial = {}
-        try:
-            definition = Definition.objects.get(
-                    concept=concept,
-                    language=language,
-            )
-        except Definition.DoesNotExist:
-            definition = None
+        if self.request.method == 'POST':
+            translations = Translation.objects.filter(concept=concept, language=language)
+            try:
+                definition = Definition.objects.get(
+                        concept=concept,
+                        language=language,
+                )
+            except Definition.DoesNotExist:
+                definition = None
+        else:
+            # Everything from one row
+            self.snapshot = ConceptSnapshot.get_data(concept, language)
+            self.concept_in_lang = self.snapshot["concept_in_lang"]
+            translations = self.snapshot["translations"]
+            definition = self.snapshot["definition"]
         may_edit = False
         message = ""
         message_class = ""
@@ -331,8 +349,17 @@ class ConceptSourceView(TerminatorDetailView):
         context['message'] = message
         context['message_class'] = message_class
         context['current_language'] = language
-        translations = translations.select_related('administrative_status').order_by()
-        translations = sorted(translations, key=lambda t: t.cmp_key())
+        if self.snapshot:
+            context['last_change'] = self.snapshot["last_change"]
+            context['related_concepts'] = self.snapshot["related_concepts"]
+            context['external_resources'] = self.snapshot["external_resources"]
+        else:
+            translations = translations.select_related('administrative_status').order_by()
+            translations = sorted(translations, key=lambda t: t.cmp_key())
+            context['last_change'] = definition and definition.history.first()
+            # Only called if the template needs them
+            context['related_concepts'] = self.get_concept_in_lang().related_concepts_data
+            context['external_resources'] = self.get_concept_in_lang().external_resources
         context['translations'] = translations
         context['definition'] = definition
         context['concept_in_lang'] = self.get_concept_in_lang()
@@ -380,11 +407,7 @@ class ConceptTargetView(ConceptSourceView):
 
     def get_concept_in_lang(self):
         if not self.concept_in_lang:
-            concept_in_lang, created = ConceptInLanguage.objects.get_or_create(
-                    concept=self.object,
-                    language=self.language,
-            )
-            self.concept_in_lang = concept_in_lang
+            self.concept_in_lang = ConceptInLanguage.get_or_unsaved(self.object, self.language)
         return self.concept_in_lang
 
     def may_edit(self, glossary_perms):
@@ -393,7 +416,10 @@ class ConceptTargetView(ConceptSourceView):
 
     def get_context_data(self, **kwargs):
         context = super(ConceptTargetView, self).get_context_data(**kwargs)
-        other_languages = self.get_concept_in_lang().other_language_data()
+        if self.snapshot:
+            other_languages = self.snapshot["other_languages"]
+        else:
+            other_languages = self.get_concept_in_lang().other_language_data()
         if self.source_language_id in other_languages:
             # Shouldn't happen, but could be if terms+definition was deleted in
             # source language and URLs are manipulated. for example.
@@ -403,6 +429,72 @@ class ConceptTargetView(ConceptSourceView):
         return context
 
 
+def get_concept_and_language(pk, lang):
+    """The concept and one of the languages of its glossary, or a 404."""
+    concept = get_object_or_404(Concept.objects.select_related('glossary'), pk=pk)
+    language = get_object_or_404(Language, pk=lang)
+    glossary = concept.glossary
+    if language.pk != glossary.source_language_id and \
+            not glossary.other_languages.filter(pk=language.pk).exists():
+        raise Http404
+    return concept, language
+
+
+@login_required
+def concept_in_language_admin(request, pk, lang):
+    """Create the concept in the language for its first change."""
+    concept, language = get_concept_and_language(pk, lang)
+    if 'terminologist' not in get_perms(request.user, concept.glossary):
+        raise PermissionDenied
+    concept_in_lang, _created = ConceptInLanguage.objects.get_or_create(
+            concept=concept,
+            language=language,
+    )
+    return redirect('admin:terminator_conceptinlanguage_change', concept_in_lang.pk)
+
+
+@login_required
+@require_POST
+def concept_in_language_comment(request, pk, lang):
+    """
+    Post the first comment on a concept in a language, which creates the
+    concept in the language.
+    """
+    concept, language = get_concept_and_language(pk, lang)
+    # Like post_comment()
+    data = request.POST.copy()
+    if not data.get('name', ''):
+        data["name"] = request.user.get_full_name() or request.user.get_username()
+    if not data.get('email', ''):
+        data["email"] = request.user.email
+    # The form (and its security data) was for the unsaved object
+    form_class = django_comments.get_form()
+    form = form_class(ConceptInLanguage(concept=concept, language=language), data=data)
+    if form.security_errors():
+        return CommentPostBadRequest(
+                "The comment form failed security verification: %s" % escape(str(form.security_errors())))
+    if form.errors or "preview" in data:
+        return render(request, "comments/preview.html", {
+                "comment": form.data.get("comment", ""),
+                "form": form,
+                "next": data.get("next"),
+        })
+    with transaction.atomic():
+        concept_in_lang, _created = ConceptInLanguage.objects.get_or_create(
+                concept=concept,
+                language=language,
+        )
+        # Verified above, now signed for the saved object
+        data["object_pk"] = force_text(concept_in_lang.pk)
+        data["security_hash"] = form_class(concept_in_lang).initial_security_hash(data["timestamp"])
+        request.POST = data
+        response = post_comment(request)
+        if response.status_code >= 400:
+            # Without the comment
+            transaction.set_rollback(True)
+    return response
+
+
 class GlossaryDetailView(TerminatorDetailView):
     def post(self, request, *args, **kwargs):
         if not settings.FEATURES.get('collaboration', True) and \
@@ -553,165 +645,6 @@ def terminator_index(request):
     return render(request, 'index.html', context)
 
 
-def export_glossaries_to_TBX(glossaries, desired_languages=None, export_all_definitions=False, export_terms="all"):
-    if desired_languages is None:
-        desired_languages = []
-    if not glossaries:
-        raise Http404
-    elif len(glossaries) == 1:
-        glossary_data = glossaries[0]
-    else:
-        glossary_description = _("TBX file created by exporting the following "
-                                 "glossaries: ")
-        glossaries_names_list = []
-        for gloss in glossaries:
-            glossaries_names_list.append(gloss.name)
-        glossary_description += ", ".join(glossaries_names_list)
-        glossary_data = {
-            "name": _("Terminator TBX exported glossary"),
-            "description": glossary_description,
-        }
-    data = {
-        'glossary': glossary_data,
-        'concepts': [],
-    }
-
-    preferred = AdministrativeStatus.objects.get(name="Preferred")
-    admitted = AdministrativeStatus.objects.get(name="Admitted")
-    not_recommended = AdministrativeStatus.objects.get(name="Not recommended")
-
-    concept_qs = Concept.objects.filter(glossary__in=glossaries).order_by("glossary", "id")
-
-    #Give template an indication of whether any related concepts are used:
-    data["use_related_concepts"] = Concept.objects.filter(
-            related_concepts__id__in=concept_qs,
-    ).exists()
-
-    translation_filter = Q()
-    if export_terms == 'preferred':
-        translation_filter |= Q(administrative_status=preferred)
-    elif export_terms == 'preferred+admitted':
-        translation_filter |= Q(administrative_status=preferred)
-        translation_filter |= Q(administrative_status=admitted)
-    elif export_terms == 'preferred+admitted+not_recommended':
-        translation_filter |= Q(administrative_status__in=(preferred, admitted, not_recommended))
-
-    # Only the finished summary messages are exported
-    summary_filter = Q(is_finalized=True)
-    definition_filter = Q()
-    if not export_all_definitions:
-        definition_filter &= Q(is_finalized=True)
-
-    # Assume that there is at least a term or a definition for a used language.
-    glossary_filter = Q(concept__glossary__in=glossaries)
-    translations = Translation.objects.filter(glossary_filter & translation_filter)
-    definitions = Definition.objects.filter(glossary_filter & definition_filter)
-    used_languages = set(translations.values_list('language', flat=True).distinct())
-    used_languages.update(definitions.values_list('language', flat=True).distinct())
-    used_languages.difference_update(set(desired_languages))
-    used_languages = sorted(used_languages)
-
-    def key_func(obj):
-        return (obj.concept_id, obj.language_id)
-
-    def query_lookup_dict(qs):
-        results = {}
-        for key, group in groupby(qs, key_func):
-            results[key] = list(group)
-        return results
-
-    translations = translations.select_related(
-            'part_of_speech',
-            'grammatical_number',
-            'grammatical_gender',
-            'administrative_status',
-            'administrative_status_reason',
-    )
-    if "sqlite" in settings.DATABASES['default']['ENGINE']:
-        # SQLite can't handle more than 999 translations (by default). We do it
-        # in batches so that testing with SQLite is still possible.
-        bool(translations)
-        for i in range(0, len(translations), 999):
-            prefetch_related_objects(translations[i:i+999], "corpusexample_set", "contextsentence_set")
-    else:
-        translations = translations.prefetch_related("corpusexample_set", "contextsentence_set")
-
-    tr_dict = query_lookup_dict(translations)
-    def_dict = query_lookup_dict(definitions)
-
-    resources = ExternalResource.objects.filter(glossary_filter)
-    resource_dict = query_lookup_dict(resources)
-
-    summaries = ConceptInLanguage.objects.filter(glossary_filter & summary_filter).only('summary')
-    summary_dict = query_lookup_dict(summaries)
-
-    def generate_concepts():
-        #generator so that we don't keep things in memory
-        for concept in concept_qs.iterator():
-            concept_data = {
-                'concept': concept,
-                'languages': [],
-                'externalresources': resource_dict.get((concept.id, None), [])
-            }
-
-            for language_code in used_languages:
-                key = (concept.id, language_code)
-
-                lang_translations = tr_dict.get(key, [])
-                lang_resources = resource_dict.get(key, [])
-
-                lang_summary_message = summary_dict.get(key, None)
-                if lang_summary_message:
-                    assert len(lang_summary_message) == 1
-                    lang_summary_message = lang_summary_message[0].summary
-
-                lang_definition = def_dict.get(key, None)
-                if lang_definition:
-                    assert len(lang_definition) == 1
-                    lang_definition = lang_definition[0]
-
-                if not any((lang_translations, lang_resources, lang_definition, lang_summary_message)):
-                    # no real content
-                    continue
-
-                lang_data = {
-                    'iso_code': language_code,
-                    'translations': lang_translations,
-                    'externalresources': lang_resources,
-                    'definition': lang_definition,
-                    'summarymessage': lang_summary_message,
-                }
-                concept_data['languages'].append(lang_data)
-            if concept_data['languages']:
-                yield concept_data
-
-    data['concepts'] = generate_concepts()
-
-    #TODO:
-    # Raise Http404 if there are no concepts in the resulting glossary
-    #if not data['concepts']:
-    #    raise Http404
-    # Important enough? Can't easily do with generator.
-
-    # Create the HttpResponse object with the appropriate header.
-    response = HttpResponse(content_type='application/x-tbx')
-    if len(glossaries) == 1:
-        from django.utils.six.moves.urllib_parse import quote
-        encoded_name = b"%s.tbx" % quote(glossaries[0].name).encode('utf-8')
-        response['Content-Disposition'] = "attachment; filename=\"%s\"; filename*=UTF-8''%s" % (encoded_name, encoded_name)
-        # http://test.greenbytes.de/tech/tc2231/
-        # The encoding of filename is wrong, but seems like it will trigger the
-        # right bugs in older browsers that don't support filename* to actually
-        # display the right filename.
-    else:
-        response['Content-Disposition'] = 'attachment; filename=terminator_several_exported_glossaries.tbx'
-
-    # Create the response
-    t = loader.get_template('export.tbx')
-    response.write(t.render({'data': data}))
-    return response
-
-
 def autoterm(request, language_code):
     #TODO Make this view to export for any language pair and not only for
     # english and another language.
@@ -720,7 +653,7 @@ def autoterm(request, language_code):
     glossaries = list(Glossary.objects.all())
     if not glossaries:
         raise Http404
-    return export_glossaries_to_TBX(glossaries, [language, english])
+    return export_glossaries_to_TBX(glossaries, [language, english], request=request)
 
 
 @csrf_protect
@@ -739,7 +672,8 @@ def export(request):
             #exporting_message = "Exported succesfully."#TODO show export confirmation message
             return export_glossaries_to_TBX(glossaries, desired_languages,
                                             export_all_definitions,
-                                            export_terms)
+                                            export_terms,
+                                            request=request)
     else:
         export_form = ExportForm()
     context = {
@@ -751,99 +685,248 @@ def export(request):
     return render(request, 'export.html', context)
 
 
+def parse_search_cursor(cursor):
+    """Return (rank, concept_id, language_id, id) from the "after" parameter."""
+    match = re.match(r"^(\d+):(\d+):(.+):(\d+)$", cursor)
+    if not match:
+        return None
+    return (int(match.group(1)), int(match.group(2)), match.group(3), int(match.group(4)))
+
+
+def attach_definitions(translations):
+    """
+    Set .definition on the translations to the text of the definition of
+    their concept in their language (or None), with one query.
+
+    This is much faster than a correlated subquery for every row on some
+    databases (see the benchmark_search command).
+    """
+    concept_ids = set(t.concept_id for t in translations)
+    language_ids = set(t.language_id for t in translations)
+    # This gets a few more definitions than needed, but can use the index of
+    # (concept, language).
+    definitions = Definition.objects.filter(
+            concept_id__in=concept_ids,
+            language_id__in=language_ids,
+    ).values_list('concept_id', 'language_id', 'text')
+    texts = dict(((concept_id, language_id), text) for
+                 (concept_id, language_id, text) in definitions)
+    for translation in translations:
+        translation.definition = texts.get((translation.concept_id, translation.language_id))
+
+
+def search_cache_key(data, advanced, page_size, after):
+    """
+    The cache key for a page of search results. It changes when anything
+    changes in the searched glossaries (see touch_glossary()).
+    """
+    glossary = data['filter_by_glossary'] if advanced else None
+    if glossary:
+        state = [glossary.pk, glossary.last_modified.isoformat()]
+    else:
+        # The count notices deleted glossaries.
+        state = Glossary.objects.aggregate(count=Count('pk'), last=Max('last_modified'))
+        state = [state['count'], state['last'] and state['last'].isoformat()]
+    params = [make_search_key(data['search_string']), page_size, after]
+    if advanced:
+        params.extend(obj and obj.pk for obj in (
+                data['filter_by_language'],
+                data['filter_by_part_of_speech'],
+                data['filter_by_administrative_status'],
+        ))
+        params.extend([data['also_show_partial_matches'], data['max_differences']])
+    digest = hashlib.sha1(json.dumps([params, state]).encode('utf-8')).hexdigest()
+    return "terminator-search-%s" % digest
+
+
+def find_search_results(data, advanced, page_size, after):
+    """
+    Return the results on a page of a search, and the cursor for the next
+    page (or None).
+    """
+    qs = Translation.objects.all()
+    search_string = data['search_string']
+    search_key = make_search_key(search_string)
+    # For fuzzy searches: the edit distances of the matches
+    distances = None
+    if advanced:
+        glossary_filter = data['filter_by_glossary']
+        language_filter = data['filter_by_language']
+        part_of_speech_filter = data['filter_by_part_of_speech']
+        admin_status_filter = data['filter_by_administrative_status']
+        if glossary_filter:
+            qs = qs.filter(concept__glossary=glossary_filter)
+
+        if language_filter:
+            qs = qs.filter(language=language_filter)
+
+        #TODO add filter by is_finalized
+
+        if part_of_speech_filter:
+            qs = qs.filter(part_of_speech=part_of_speech_filter)
+
+        if admin_status_filter:
+            qs = qs.filter(administrative_status=admin_status_filter)
+
+        if data['max_differences']:
+            # The index can only filter by glossary and language; the rest of
+            # the filters are applied when ranking.
+            distances = fuzzy_matches(
+                    search_string,
+                    data['max_differences'],
+                    queryset=qs,
+                    language_id=language_filter.pk if language_filter else None,
+                    glossary_id=glossary_filter.pk if glossary_filter else None,
+            )
+        elif data['also_show_partial_matches']:
+            qs = get_search_backend().partial_match(qs, search_string)
+        else:
+            qs = qs.filter(search_key=search_key)
+    else:
+        qs = qs.filter(search_key=search_key)
+
+    ranks = None
+    if distances is not None:
+        # The closest matches first, and then like other searches. There can
+        # be too many to filter by in one query, so they are ranked here, one
+        # distance at a time until the page is filled. Ranks are below 100
+        # (see search_rank()), so all matches at a distance come before those
+        # further away.
+        by_distance = {}
+        for pk, distance in distances.items():
+            by_distance.setdefault(distance, []).append(pk)
+        ranked = []
+        for distance in sorted(by_distance):
+            if after and (distance + 1) * 100 <= after[0]:
+                # Only on previous pages
+                continue
+            pks = by_distance[distance]
+            # Stay below the query parameter limit of SQLite
+            for i in range(0, len(pks), 500):
+                rows = qs.filter(pk__in=pks[i:i+500]).annotate(rank=search_rank(search_key))
+                for (pk, rank, concept_id, language_id) in rows.values_list('pk', 'rank', 'concept_id', 'language_id'):
+                    key = (distance * 100 + rank, concept_id, language_id, pk)
+                    if not after or key > after:
+                        ranked.append(key)
+            if len(ranked) > page_size:
+                break
+        ranked.sort()
+        # One more to know if there is a next page
+        ranks = dict((key[-1], key[0]) for key in ranked[:page_size + 1])
+        qs = Translation.objects.filter(pk__in=ranks)
+    else:
+        # The best results first (see search_rank()). Keyset pagination: a
+        # page continues after the last result of the previous one, so deep
+        # pages are as cheap as the first.
+        qs = qs.annotate(rank=search_rank(search_key))
+        qs = qs.order_by('rank', 'concept_id', 'language_id', 'pk')
+        if after:
+            rank, concept_id, language_id, pk = after
+            qs = qs.filter(
+                    Q(rank__gt=rank) |
+                    Q(rank=rank, concept_id__gt=concept_id) |
+                    Q(rank=rank, concept_id=concept_id, language_id__gt=language_id) |
+                    Q(rank=rank, concept_id=concept_id, language_id=language_id, pk__gt=pk)
+            )
+
+    qs = qs.select_related(
+            'concept',
+            'concept__glossary',
+            'administrative_status',
+    )
+    deferred_fields = (
+            'administrative_status_reason',
+            'administrative_status__description',
+            'administrative_status__allows_reason',
+            'part_of_speech',
+            'grammatical_gender',
+            'grammatical_number',
+            'note',
+            'concept__repr_cache',
+            'concept__broader_concept',
+            'concept__subject_field',
+            'concept__glossary__description',
+            'concept__glossary__source_language',
+    )
+    qs = qs.defer(*deferred_fields)
+    if ranks is not None:
+        page = list(qs)
+        for translation in page:
+            translation.rank = ranks[translation.pk]
+        page.sort(key=lambda t: (t.rank, t.concept_id, t.language_id, t.pk))
+    else:
+        # One more to know if there is a next page
+        page = list(qs[:page_size + 1])
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        last = page[-1]
+        next_cursor = "%d:%d:%s:%d" % (last.rank, last.concept_id, last.language_id, last.pk)
+
+    attach_definitions(page)
+    inner_qs = Translation.objects.defer()
+    prefetch_related_objects(page, Prefetch(
+            'concept__translation_set', queryset=inner_qs, to_attr="others"))
+
+    previous_concept = None
+
+    search_results = []
+    for trans in page:
+        # If this is the first translation for this concept (after others,
+        # since the results are ranked)
+        if previous_concept != trans.concept_id:
+            is_first = True
+            previous_concept = trans.concept_id
+            others = trans.concept.others
+            others = list(islice((c for c in others if c.pk != trans.pk), 7))
+        else:
+            others = None
+            is_first = False
+
+        search_results.append({
+            "translation": trans,
+            "definition": trans.definition,
+            "other_translations": others,
+            "is_first": is_first,
+        })
+    return search_results, next_cursor
+
+
 def search(request):
     search_results = None
+    next_page_url = None
+    first_page_url = None
     if request.method == 'GET' and 'search_string' in request.GET:
-        if "advanced" in request.path:
+        advanced = "advanced" in request.path
+        if advanced:
             search_form = AdvancedSearchForm(request.GET)
         else:
             search_form = SearchForm(request.GET)
 
         if search_form.is_valid():
-            qs = Translation.objects.all()
             data = search_form.cleaned_data
-            search_string = data['search_string']
-            if "advanced" in request.path:
-                glossary_filter = data['filter_by_glossary']
-                language_filter = data['filter_by_language']
-                part_of_speech_filter = data['filter_by_part_of_speech']
-                admin_status_filter = data['filter_by_administrative_status']
-                if glossary_filter:
-                    qs = qs.filter(concept__glossary=glossary_filter)
-
-                if language_filter:
-                    qs = qs.filter(language=language_filter)
-
-                #TODO add filter by is_finalized
-
-                if part_of_speech_filter:
-                    qs = qs.filter(part_of_speech=part_of_speech_filter)
-
-                if admin_status_filter:
-                    qs = qs.filter(administrative_status=admin_status_filter)
-
-                if data['also_show_partial_matches']:
-                    qs = qs.filter(translation_text__icontains=search_string)
-                else:
-                    qs = qs.filter(translation_text__iexact=search_string)
-            else:
-                qs = qs.filter(translation_text__iexact=search_string)
-
-            # Limit for better worst-case performance. Consider pager.
-            limit = 20
+            page_size = 20
             if request.user.is_authenticated:
-                limit = 100
-
-            definition = Definition.objects.filter(
-                    concept=OuterRef('concept'),
-                    language=OuterRef('language'),
-            )
-            qs = qs.annotate(definition=Subquery(definition.values('text')))
-
-            qs = qs.select_related(
-                    'concept',
-                    'concept__glossary',
-                    'administrative_status',
-            )[:limit]
-            deferred_fields = (
-                    'administrative_status_reason',
-                    'administrative_status__description',
-                    'administrative_status__allows_reason',
-                    'part_of_speech',
-                    'grammatical_gender',
-                    'grammatical_number',
-                    'note',
-                    'concept__repr_cache',
-                    'concept__broader_concept',
-                    'concept__subject_field',
-                    'concept__glossary__description',
-                    'concept__glossary__source_language',
-            )
-            inner_qs = Translation.objects.defer()
-            qs = qs.prefetch_related(Prefetch(
-                    'concept__translation_set', queryset=inner_qs, to_attr="others"))
-            qs = qs.defer(*deferred_fields)
-
-            previous_concept = None
-
-            search_results = []
-            for trans in qs:# Translations are ordered by (concept, language)
-                # If this is the first translation for this concept
-                if previous_concept != trans.concept_id:
-                    is_first = True
-                    previous_concept = trans.concept_id
-                    others = trans.concept.others
-                    others = islice((c for c in others if c.pk != trans.pk), 7)
-                else:
-                    others = None
-                    is_first = False
-
-                search_results.append({
-                    "translation": trans,
-                    "definition": trans.definition,
-                    "other_translations": others,
-                    "is_first": is_first,
-                })
+                page_size = 100
+            after = parse_search_cursor(request.GET.get('after', ''))
+
+            # Popular searches are answered from the cache.
+            cache_key = search_cache_key(data, advanced, page_size, after)
+            cached = cache.get(cache_key)
+            count_search_cache_lookup(hit=cached is not None)
+            if cached is None:
+                cached = find_search_results(data, advanced, page_size, after)
+                cache.set(cache_key, cached, SEARCH_CACHE_TIMEOUT)
+            search_results, next_cursor = cached
+
+            if next_cursor:
+                next_page = request.GET.copy()
+                next_page['after'] = next_cursor
+                next_page_url = "?" + next_page.urlencode()
+            if after:
+                first_page = request.GET.copy()
+                del first_page['after']
+                first_page_url = "?" + first_page.urlencode()
     elif "advanced" in request.path:
         search_form = AdvancedSearchForm()
     else:
@@ -852,6 +935,8 @@ def search(request):
     context = {
         'search_form': search_form,
         'search_results': search_results,
+        'next_page_url': next_page_url,
+        'first_page_url': first_page_url,
         'next': request.get_full_path(),
     }
 
@@ -860,3 +945,12 @@ def search(request):
         template_name = 'advanced_search.html'
 
     return render(request, template_name, context)
+
+
+def suggest(request, language_code):
+    """Terms in the language that start with the text in q, as JSON."""
+    try:
+        terms = suggestions(language_code, request.GET.get('q', ''))
+    except Language.DoesNotExist:
+        raise Http404
+    return JsonResponse({'suggestions': terms})
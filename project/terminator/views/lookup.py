@@ -0,0 +1,182 @@
+# -*- coding: UTF-8 -*-
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Looking up many terms at a time, and finding terms in texts, for translation
+tools.
+"""
+
+import json
+
+from django.db import connection
+from django.http import JsonResponse
+from django.utils import six
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from terminator.models import Definition, Glossary, Language, Translation, make_search_key
+from terminator.search import find_terms
+
+
+# Larger requests are refused
+MAX_LOOKUP_TERMS = 10000
+MAX_LOOKUP_GLOSSARIES = 100
+MAX_ANNOTATE_LENGTH = 1000000
+
+
+def chunks(items, size=900):
+    """
+    Split items into lists that fit in the query parameter limit of the
+    database, with some parameters to spare for the rest of a query.
+    """
+    items = list(items)
+    if connection.vendor != 'sqlite':
+        # Only SQLite has a (default) limit, of 999 parameters.
+        yield items
+        return
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def lookup_terms(terms, source_language, target_language, glossaries=None):
+    """
+    Find the concepts with the given terms in the source language (ignoring
+    case and accents), with their terms in the target language (best first)
+    and their finalized definitions in both languages.
+
+    Returns a list with a dictionary for every term, in the same order. The
+    number of queries only depends on the limit of query parameters of the
+    database, not on the number of terms.
+    """
+    keys = dict((term, make_search_key(term)) for term in terms)
+    sources = Translation.objects.filter(language_id=source_language)
+    # The glossaries are query parameters too
+    chunk_size = 900
+    if glossaries:
+        glossaries = set(glossaries)
+        chunk_size -= len(glossaries)
+        sources = sources.filter(concept__glossary__in=glossaries)
+    sources = sources.values_list('search_key', 'concept_id', 'concept__glossary__name')
+    concept_ids = {}
+    concepts = {}
+    for chunk in chunks(set(keys.values()), chunk_size):
+        for search_key, concept_id, glossary_name in sources.filter(search_key__in=chunk):
+            ids = concept_ids.setdefault(search_key, [])
+            if concept_id not in ids:
+                ids.append(concept_id)
+            concepts[concept_id] = {
+                "id": concept_id,
+                "glossary": glossary_name,
+                "target_terms": [],
+                "definitions": {},
+            }
+
+    targets = Translation.objects.filter(language_id=target_language)
+    targets = targets.values_list('concept_id', 'translation_text', 'administrative_status_id', 'is_finalized')
+    definitions = Definition.objects.filter(
+            language_id__in=[source_language, target_language],
+            is_finalized=True,
+    ).values_list('concept_id', 'language_id', 'text')
+    for chunk in chunks(concepts):
+        for concept_id, text, status, is_finalized in targets.filter(concept_id__in=chunk):
+            concepts[concept_id]["target_terms"].append({
+                "term": text,
+                "status": status,
+                "is_finalized": is_finalized,
+            })
+        for concept_id, language_id, text in definitions.filter(concept_id__in=chunk):
+            concepts[concept_id]["definitions"][language_id] = text
+
+    # Like Translation.cmp_key()
+    weights = Translation.STATUS_WEIGHTS
+    for concept in concepts.values():
+        concept["target_terms"].sort(
+                key=lambda t: (weights.get(t["status"], 1), t["term"].lower()))
+
+    return [{
+        "term": term,
+        "concepts": [concepts[pk] for pk in sorted(concept_ids.get(keys[term], []))],
+    } for term in terms]
+
+
+def bad_request(message):
+    return JsonResponse({"error": message}, status=400)
+
+
+@csrf_exempt
+@require_POST
+def lookup(request):
+    """
+    Look up the terms in a JSON object like:
+    {"source": "en", "target": "gl", "terms": ["window", "tab"]}
+    with an optional list of glossary ids in "glossaries".
+    """
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        source_language = data["source"]
+        target_language = data["target"]
+        terms = data["terms"]
+        glossaries = data.get("glossaries")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return bad_request("Expected a JSON object with source, target and terms.")
+    if not isinstance(terms, list) or not all(isinstance(t, six.string_types) for t in terms):
+        return bad_request("The terms should be a list of strings.")
+    if len(terms) > MAX_LOOKUP_TERMS:
+        return bad_request("Too many terms (at most %d)." % MAX_LOOKUP_TERMS)
+    if glossaries is not None and (not isinstance(glossaries, list) or
+            not all(isinstance(g, int) for g in glossaries)):
+        return bad_request("The glossaries should be a list of ids.")
+    if glossaries and len(set(glossaries)) > MAX_LOOKUP_GLOSSARIES:
+        return bad_request("Too many glossaries (at most %d)." % MAX_LOOKUP_GLOSSARIES)
+    if not all(isinstance(l, six.string_types) for l in (source_language, target_language)):
+        return bad_request("Unknown language.")
+    languages = set([source_language, target_language])
+    if Language.objects.filter(pk__in=languages).count() != len(languages):
+        return bad_request("Unknown language.")
+    return JsonResponse({
+        "results": lookup_terms(terms, source_language, target_language, glossaries),
+    })
+
+
+@csrf_exempt
+@require_POST
+def annotate(request):
+    """
+    Find the terms of a language in a text, given in a JSON object like:
+    {"language": "en", "text": "Press the tab key."}
+    with an optional glossary id in "glossary".
+    """
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        language = data["language"]
+        text = data["text"]
+        glossary = data.get("glossary")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return bad_request("Expected a JSON object with language and text.")
+    if not isinstance(text, six.string_types):
+        return bad_request("The text should be a string.")
+    if len(text) > MAX_ANNOTATE_LENGTH:
+        return bad_request("The text is too long (at most %d characters)." % MAX_ANNOTATE_LENGTH)
+    if not isinstance(language, six.string_types):
+        return bad_request("Unknown language.")
+    if glossary is not None and (not isinstance(glossary, int) or
+            not Glossary.objects.filter(pk=glossary).exists()):
+        return bad_request("Unknown glossary.")
+    try:
+        annotations = find_terms(text, language, glossary)
+    except Language.DoesNotExist:
+        return bad_request("Unknown language.")
+    return JsonResponse({"annotations": annotations})
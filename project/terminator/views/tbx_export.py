@@ -0,0 +1,569 @@
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2011, 2013 Leandro Regueiro
+# Copyright 2017-2018 Friedel Wolff
+#
+# This file is part of Terminator.
+#
+# Terminator is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Terminator is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Terminator. If not, see <http://www.gnu.org/licenses/>.
+
+import calendar
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import django
+from django.conf import settings
+from django.db import connections
+from django.db.models import F, Q
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.template import loader
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.encoding import force_text
+from django.utils.http import http_date
+from django.utils.six.moves import zip
+from django.utils.six.moves.urllib_parse import quote
+from django.utils.translation import ugettext_lazy as _
+
+from terminator.models import *
+
+
+# The number of rows read per query by the exports
+EXPORT_CHUNK_SIZE = 2000
+
+
+def chunked(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Iterate over the objects of a queryset that is ordered by pk, reading
+    chunk_size of them per query (see ConceptCursor).
+    """
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1].pk
+
+
+class ConceptCursor(object):
+    """
+    Walk the rows of a query that is ordered by concept, one concept at a time.
+
+    Several of these are advanced in step with the concepts (like a merge
+    join), so that only the data of the current concept is kept in memory.
+
+    Only PostgreSQL streams the rows of iterator() from the database; other
+    databases would load all of them at once. So the rows are read in chunks
+    of about chunk_size rows instead, every query continuing after the last
+    concept that was read completely.
+    """
+
+    def __init__(self, queryset, key='concept_id', chunk_size=EXPORT_CHUNK_SIZE):
+        self.queryset = queryset
+        self.key = key
+        self.chunk_size = chunk_size
+        # The last concept of which all the rows were read
+        self.last_key = None
+        self.finished = False
+        self.rows = iter(())
+        self.current = self.next_row()
+
+    def next_row(self):
+        row = next(self.rows, None)
+        if row is None and not self.finished:
+            self.rows = iter(self.read_chunk())
+            row = next(self.rows, None)
+        return row
+
+    def read_chunk(self):
+        queryset = self.queryset
+        if self.last_key is not None:
+            queryset = queryset.filter(**{self.key + '__gt': self.last_key})
+        rows = list(queryset[:self.chunk_size])
+        if len(rows) < self.chunk_size:
+            self.finished = True
+            return rows
+        # The rows of the last concept might continue in the next chunk, so
+        # they are read again with it.
+        last_key = getattr(rows[-1], self.key)
+        complete = [row for row in rows if getattr(row, self.key) != last_key]
+        if not complete:
+            # A single concept with more rows than a chunk
+            complete = list(queryset.filter(**{self.key: last_key}))
+        self.last_key = getattr(complete[-1], self.key)
+        return complete
+
+    def take(self, concept_id):
+        """Return the rows of the given concept."""
+        rows = []
+        while self.current is not None:
+            row_concept = getattr(self.current, self.key)
+            if row_concept > concept_id:
+                break
+            if row_concept == concept_id:
+                rows.append(self.current)
+            # else: the row belongs to a concept that was not exported
+            self.current = self.next_row()
+        return rows
+
+
+def by_language(rows):
+    results = {}
+    for row in rows:
+        results.setdefault(row.language_id, []).append(row)
+    return results
+
+
+def glossary_concepts(glossary, used_languages, translation_filter, definition_filter, summary_filter):
+    """Generate the template data of the concepts of one glossary."""
+    glossary_filter = Q(concept__glossary=glossary)
+    concepts = Concept.objects.filter(glossary=glossary).order_by('id')
+    translations = ConceptCursor(Translation.objects.filter(
+                glossary_filter & translation_filter,
+            ).select_related(
+                'part_of_speech',
+                'grammatical_number',
+                'grammatical_gender',
+                'administrative_status',
+                'administrative_status_reason',
+            ).order_by('concept_id', 'language_id', 'id'))
+    context_sentences = ConceptCursor(ContextSentence.objects.filter(
+                translation__concept__glossary=glossary,
+            ).annotate(
+                translation_concept_id=F('translation__concept_id'),
+            ).order_by('translation__concept_id', 'id'), key='translation_concept_id')
+    corpus_examples = ConceptCursor(CorpusExample.objects.filter(
+                translation__concept__glossary=glossary,
+            ).annotate(
+                translation_concept_id=F('translation__concept_id'),
+            ).order_by('translation__concept_id', 'id'), key='translation_concept_id')
+    definitions = ConceptCursor(Definition.objects.filter(
+                glossary_filter & definition_filter,
+            ).order_by('concept_id', 'language_id'))
+    resources = ConceptCursor(ExternalResource.objects.filter(
+                glossary_filter,
+            ).order_by('concept_id', 'id'))
+    summaries = ConceptCursor(ConceptInLanguage.objects.filter(
+                glossary_filter & summary_filter,
+            ).only('concept', 'language', 'summary').order_by('concept_id', 'language_id'))
+    Through = Concept.related_concepts.through
+    related_concepts = ConceptCursor(Through.objects.filter(
+                from_concept__glossary=glossary,
+            ).order_by('from_concept_id', 'to_concept_id'), key='from_concept_id')
+
+    # The subject fields are few, so their labels are looked up in advance.
+    subject_fields = concepts.filter(subject_field__isnull=False).values('subject_field_id')
+    subject_field_labels = {}
+    subject_translations = Translation.objects.filter(
+            concept_id__in=subject_fields,
+    ).order_by('concept_id', 'language_id', 'id').values_list('concept_id', 'translation_text')
+    for (concept_id, translation_text) in subject_translations.iterator():
+        subject_field_labels.setdefault(concept_id, translation_text)
+
+    for concept in chunked(concepts):
+        concept_translations = translations.take(concept.id)
+        sentence_dict = {}
+        for sentence in context_sentences.take(concept.id):
+            sentence_dict.setdefault(sentence.translation_id, []).append(sentence)
+        example_dict = {}
+        for example in corpus_examples.take(concept.id):
+            example_dict.setdefault(example.translation_id, []).append(example)
+        for translation in concept_translations:
+            translation.context_sentences = sentence_dict.get(translation.id, [])
+            translation.corpus_examples = example_dict.get(translation.id, [])
+        tr_dict = by_language(concept_translations)
+        def_dict = by_language(definitions.take(concept.id))
+        resource_dict = by_language(resources.take(concept.id))
+        summary_dict = by_language(summaries.take(concept.id))
+
+        concept_data = {
+            'concept': concept,
+            'languages': [],
+            'externalresources': resource_dict.get(None, []),
+            'subject_field_label': subject_field_labels.get(concept.subject_field_id, ""),
+            'related_ids': [r.to_concept_id for r in related_concepts.take(concept.id)],
+        }
+
+        for language_code in used_languages:
+            lang_translations = tr_dict.get(language_code, [])
+            lang_resources = resource_dict.get(language_code, [])
+
+            lang_summary_message = summary_dict.get(language_code, None)
+            if lang_summary_message:
+                assert len(lang_summary_message) == 1
+                lang_summary_message = lang_summary_message[0].summary
+
+            lang_definition = def_dict.get(language_code, None)
+            if lang_definition:
+                assert len(lang_definition) == 1
+                lang_definition = lang_definition[0]
+
+            if not any((lang_translations, lang_resources, lang_definition, lang_summary_message)):
+                # no real content
+                continue
+
+            lang_data = {
+                'iso_code': language_code,
+                'translations': lang_translations,
+                'externalresources': lang_resources,
+                'definition': lang_definition,
+                'summarymessage': lang_summary_message,
+            }
+            concept_data['languages'].append(lang_data)
+        if concept_data['languages']:
+            yield concept_data
+
+
+def export_filters(export_all_definitions, export_terms):
+    """The filters for translations, definitions and summaries to export."""
+    preferred = AdministrativeStatus.objects.get(name="Preferred")
+    admitted = AdministrativeStatus.objects.get(name="Admitted")
+    not_recommended = AdministrativeStatus.objects.get(name="Not recommended")
+
+    translation_filter = Q()
+    if export_terms == 'preferred':
+        translation_filter |= Q(administrative_status=preferred)
+    elif export_terms == 'preferred+admitted':
+        translation_filter |= Q(administrative_status=preferred)
+        translation_filter |= Q(administrative_status=admitted)
+    elif export_terms == 'preferred+admitted+not_recommended':
+        translation_filter |= Q(administrative_status__in=(preferred, admitted, not_recommended))
+
+    # Only the finished summary messages are exported
+    summary_filter = Q(is_finalized=True)
+    definition_filter = Q()
+    if not export_all_definitions:
+        definition_filter &= Q(is_finalized=True)
+    return translation_filter, definition_filter, summary_filter
+
+
+def export_data(glossaries, desired_languages=None, export_all_definitions=False, export_terms="all"):
+    """
+    Prepare the template data for exporting the given glossaries.
+
+    The concepts are provided by a generator, and nothing is read for them
+    before the first one is needed.
+    """
+    if desired_languages is None:
+        desired_languages = []
+    # The same order everywhere, so that the same export is always the same
+    # file (see the export_tbx command).
+    glossaries = sorted(glossaries, key=lambda g: g.pk)
+    if len(glossaries) == 1:
+        glossary_data = glossaries[0]
+    else:
+        glossary_description = _("TBX file created by exporting the following "
+                                 "glossaries: ")
+        glossaries_names_list = []
+        for gloss in glossaries:
+            glossaries_names_list.append(gloss.name)
+        glossary_description += ", ".join(glossaries_names_list)
+        glossary_data = {
+            "name": _("Terminator TBX exported glossary"),
+            "description": glossary_description,
+        }
+    data = {
+        'glossary': glossary_data,
+        'concepts': [],
+    }
+
+    concept_qs = Concept.objects.filter(glossary__in=glossaries)
+
+    #Give template an indication of whether any related concepts are used:
+    data["use_related_concepts"] = Concept.objects.filter(
+            related_concepts__id__in=concept_qs,
+    ).exists()
+
+    translation_filter, definition_filter, summary_filter = export_filters(export_all_definitions, export_terms)
+
+    # Assume that there is at least a term or a definition for a used language.
+    glossary_filter = Q(concept__glossary__in=glossaries)
+    translations = Translation.objects.filter(glossary_filter & translation_filter)
+    definitions = Definition.objects.filter(glossary_filter & definition_filter)
+    used_languages = set(translations.values_list('language', flat=True).distinct())
+    used_languages.update(definitions.values_list('language', flat=True).distinct())
+    used_languages.difference_update(set(desired_languages))
+    used_languages = sorted(used_languages)
+
+    data['used_languages'] = used_languages
+    data['export_terms'] = export_terms
+    data['export_all_definitions'] = export_all_definitions
+
+    def generate_concepts():
+        #generator so that we don't keep things in memory
+        for glossary in glossaries:
+            for concept_data in glossary_concepts(
+                    glossary,
+                    used_languages,
+                    translation_filter,
+                    definition_filter,
+                    summary_filter,
+            ):
+                yield concept_data
+
+    data['concepts'] = generate_concepts()
+    return data
+
+
+def render_tbx(data):
+    """
+    Render the TBX document for the export data piece by piece.
+
+    The header is produced before any concept is read, and every termEntry is
+    rendered and handed over on its own, so that nothing has to wait for (or
+    keep) the whole document.
+    """
+    yield loader.get_template('export_header.tbx').render({'data': data})
+    entry_template = loader.get_template('export_entry.tbx')
+    for concept in data['concepts']:
+        yield entry_template.render({'data': data, 'concept': concept})
+    yield loader.get_template('export_footer.tbx').render({'data': data})
+
+
+def export_worker(task):
+    """
+    Render one glossary of a parallel export to a file (in a worker process).
+
+    Either only its termEntries are rendered, to be combined with the others in
+    one document, or a whole TBX document for the glossary.
+    """
+    (glossary_id, path, whole_document, options) = task
+    glossary = Glossary.objects.get(pk=glossary_id)
+    if whole_document:
+        desired_languages = Language.objects.filter(pk__in=options['desired_languages'])
+        data = export_data([glossary], desired_languages, options['export_all_definitions'], options['export_terms'])
+        chunks = render_tbx(data)
+    else:
+        data = {'use_related_concepts': options['use_related_concepts']}
+        filters = export_filters(options['export_all_definitions'], options['export_terms'])
+        concepts = glossary_concepts(glossary, options['used_languages'], *filters)
+        entry_template = loader.get_template('export_entry.tbx')
+        chunks = (entry_template.render({'data': data, 'concept': concept}) for concept in concepts)
+    with io.open(path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return path
+
+
+def export_parallel(glossaries, desired_languages=None, export_all_definitions=False, export_terms="all", processes=None, separate_files=False):
+    """
+    Export glossaries with a pool of processes that each render a glossary.
+
+    Without separate_files this generates the chunks of one TBX document like
+    render_tbx(), stitched together from the parts in glossary order.
+    Otherwise it generates (glossary, path) for a separate TBX file per
+    glossary. The files are removed afterwards.
+    """
+    glossaries = sorted(glossaries, key=lambda g: g.pk)
+    options = {
+        'desired_languages': [force_text(language.pk) for language in desired_languages or []],
+        'export_all_definitions': export_all_definitions,
+        'export_terms': export_terms,
+    }
+    data = None
+    if not separate_files:
+        data = export_data(glossaries, desired_languages, export_all_definitions, export_terms)
+        options['used_languages'] = data['used_languages']
+        options['use_related_concepts'] = data['use_related_concepts']
+
+    tmp_dir = tempfile.mkdtemp(prefix='terminator-export-')
+    tasks = [(g.pk, os.path.join(tmp_dir, "%d.tbx" % g.pk), separate_files, options) for g in glossaries]
+    pool = None
+    if processes == 1:
+        paths = (export_worker(task) for task in tasks)
+    else:
+        # With fork (the default on Unix) the workers inherit the database
+        # connections of this process, which they must not share. Workers
+        # started in other ways need to set up Django themselves.
+        connections.close_all()
+        pool = multiprocessing.Pool(processes, initializer=django.setup)
+        paths = pool.imap(export_worker, tasks)
+    try:
+        if data is not None:
+            yield loader.get_template('export_header.tbx').render({'data': data})
+        for glossary, path in zip(glossaries, paths):
+            if separate_files:
+                yield glossary, path
+            else:
+                with io.open(path, 'r', encoding='utf-8', newline='') as f:
+                    for chunk in iter(lambda: f.read(64 * 1024), ''):
+                        yield chunk
+            os.remove(path)
+        if data is not None:
+            yield loader.get_template('export_footer.tbx').render({'data': data})
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# Change this when the export output changes, so that old cached files are not
+# used any more.
+EXPORT_CACHE_VERSION = 1
+
+
+def export_cache_key(glossaries, desired_languages, export_all_definitions, export_terms):
+    """
+    Return the name of the cached file for an export, and the time of the last
+    change in the exported glossaries.
+
+    The name consists of a hash of the export options, and a hash of the state
+    of the glossaries. Any change in a glossary gives a new name.
+    """
+    glossaries = sorted(glossaries, key=lambda g: g.pk)
+    options = [
+        EXPORT_CACHE_VERSION,
+        [g.pk for g in glossaries],
+        sorted(force_text(language.pk) for language in desired_languages or []),
+        bool(export_all_definitions),
+        export_terms,
+    ]
+    state = [g.last_modified.isoformat() for g in glossaries]
+    options_hash = hashlib.sha1(json.dumps(options).encode('utf-8')).hexdigest()[:20]
+    state_hash = hashlib.sha1(json.dumps(state).encode('utf-8')).hexdigest()[:20]
+    last_modified = max(g.last_modified for g in glossaries)
+    return "%s-%s" % (options_hash, state_hash), last_modified
+
+
+def write_through_cache(chunks, path):
+    """
+    Pass on the rendered chunks as bytes, and write them compressed to path.
+
+    The file only appears at path once it is complete. Older files for the
+    same export options are removed then.
+    """
+    cache_dir = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode='wb') as gzip_file:
+                for chunk in chunks:
+                    chunk = chunk.encode('utf-8')
+                    gzip_file.write(chunk)
+                    yield chunk
+        os.rename(tmp_path, path)
+    finally:
+        # Only left if the rendering failed or the client went away
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    options_hash = os.path.basename(path).split('-')[0]
+    for name in os.listdir(cache_dir):
+        old_path = os.path.join(cache_dir, name)
+        if name.startswith(options_hash + '-') and old_path != path:
+            try:
+                os.remove(old_path)
+            except OSError:
+                # Another process got to it first
+                pass
+
+
+def accepts_gzip(request):
+    """
+    Whether the Accept-Encoding header of the request allows gzip, honouring
+    q-values (like "gzip;q=0" to refuse it) and "*".
+    """
+    if request is None:
+        return False
+    qualities = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = [part.strip() for part in coding.split(';')]
+        name = parts[0].lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _sep, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    for name in ('gzip', 'x-gzip', '*'):
+        if name in qualities:
+            return qualities[name] > 0
+    return False
+
+
+def export_glossaries_to_TBX(glossaries, desired_languages=None, export_all_definitions=False, export_terms="all", request=None):
+    """
+    Return a response with the TBX export of the given glossaries.
+
+    If settings.EXPORT_CACHE_DIR is set, every export is kept there (gzipped)
+    until something in its glossaries changes, and repeated downloads are
+    served from there. When a request is given, conditional GET requests are
+    answered with 304 Not Modified where possible.
+    """
+    if not glossaries:
+        raise Http404
+    cache_dir = getattr(settings, 'EXPORT_CACHE_DIR', None)
+    cache_key, last_modified = export_cache_key(glossaries, desired_languages, export_all_definitions, export_terms)
+    etag = 'W/"%s"' % cache_key
+    last_modified = calendar.timegm(last_modified.utctimetuple())
+    if request is not None and request.method in ('GET', 'HEAD'):
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            return response
+
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, cache_key + '.tbx.gz')
+    if cache_path and os.path.exists(cache_path):
+        if accepts_gzip(request):
+            response = FileResponse(open(cache_path, 'rb'), content_type='application/x-tbx')
+            response['Content-Encoding'] = 'gzip'
+            response['Content-Length'] = os.path.getsize(cache_path)
+        else:
+            response = FileResponse(gzip.open(cache_path, 'rb'), content_type='application/x-tbx')
+    else:
+        data = export_data(glossaries, desired_languages, export_all_definitions, export_terms)
+
+        #TODO:
+        # Raise Http404 if there are no concepts in the resulting glossary
+        #if not data['concepts']:
+        #    raise Http404
+        # Important enough? Can't easily do with generator.
+
+        # The document is sent to the client while it is being rendered.
+        chunks = render_tbx(data)
+        if cache_path:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            chunks = write_through_cache(chunks, cache_path)
+        response = StreamingHttpResponse(chunks, content_type='application/x-tbx')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if cache_dir:
+        # The same URL is gzipped or not once it is in the cache
+        patch_vary_headers(response, ('Accept-Encoding',))
+    if len(glossaries) == 1:
+        encoded_name = b"%s.tbx" % quote(glossaries[0].name).encode('utf-8')
+        response['Content-Disposition'] = "attachment; filename=\"%s\"; filename*=UTF-8''%s" % (encoded_name, encoded_name)
+        # http://test.greenbytes.de/tech/tc2231/
+        # The encoding of filename is wrong, but seems like it will trigger the
+        # right bugs in older browsers that don't support filename* to actually
+        # display the right filename.
+    else:
+        response['Content-Disposition'] = 'attachment; filename=terminator_several_exported_glossaries.tbx'
+    return response
@@ -17,30 +17,70 @@
 # You should have received a copy of the GNU General Public License along with
 # Terminator. If not, see <http://www.gnu.org/licenses/>.
 
-from xml.dom import minidom
+from datetime import timedelta
+import hashlib
+import itertools
+import json
+import logging
+import threading
+from xml.etree import ElementTree
 
+from django.conf import settings
 from django.contrib.admin.models import LogEntry, ADDITION
 from django.contrib.auth.decorators import login_required
-from django.db import transaction
-from django.shortcuts import render
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Max, Q
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404, render
 from django.utils.encoding import force_text
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_protect
 
-from terminator.forms import ImportForm, SearchForm
+from terminator.forms import GLOSSARY_NAME_TAKEN, ImportForm, SearchForm
 from terminator.models import *
+from terminator.search import translations_changed
 
 
-def getText(nodelist):
+logger = logging.getLogger(__name__)
+
+
+XML_LANG = u"{http://www.w3.org/XML/1998/namespace}lang"
+
+
+def getText(element):
     """
-    Extract the stripped text from all text nodes in a node list.
-    This is used for getting the text from text nodes in TBX files.
+    Extract the stripped text directly contained in an element.
+    This is used for getting the text from text nodes in TBX files. Text inside
+    child elements is not included.
     """
-    rc = u""
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            rc += node.data
-    return rc.strip()
+    rc = [element.text or u""]
+    for child in element:
+        rc.append(child.tail or u"")
+    return force_text(u"".join(rc)).strip()
+
+
+def iter_term_entries(tbx_file):
+    """
+    Yield the termEntry elements of a TBX file one at a time.
+
+    The file is parsed incrementally and every termEntry is dropped from the
+    tree once the caller is done with it, so that memory use doesn't grow with
+    the size of the file.
+    """
+    ancestors = []
+    for event, element in ElementTree.iterparse(tbx_file, events=("start", "end")):
+        if event == "start":
+            ancestors.append(element)
+            continue
+        ancestors.pop()
+        if element.tag == u"termEntry":
+            yield element
+            if ancestors:
+                ancestors[-1].remove(element)
+            element.clear()
 
 
 def lookup_dict(model, values=True):
@@ -50,40 +90,176 @@ def lookup_dict(model, values=True):
     return dict((x.tbx_representation.lower(), x) for x in qs)
 
 
-def import_uploaded_file(uploaded_file, imported_glossary):
-    #TODO Split this function in several shorter functions.
-    #TODO Validate the uploaded file in order to check that it is a valid TBX
-    # file, or even a text file.
-    #TODO Use lxml/etree instead of xml.dom.minidom.
-    tbx_file = minidom.parse(uploaded_file)
+def bulk_create_with_ids(model, objects, scope=None):
+    """
+    Insert the objects with bulk_create() and make sure that they get their
+    primary keys set.
 
-    #TODO Perhaps add the title and description from the TBX file to the
-    # glossary instead of using the ones provided in the import form. Or maybe
-    # just append the TBX values (if provided) to the description (only the
-    # description) provided in the import form.
+    Only some databases (PostgreSQL) return the new ids from a bulk insert. For
+    the others we look them up afterwards in the queryset given as scope, which
+    must not receive new rows from anybody else while we work on it (see
+    TBXImporter). If it did, an IntegrityError is raised instead of matching
+    the wrong ids.
+    """
+    if not objects:
+        return
+    if scope is None or connection.features.can_return_ids_from_bulk_insert:
+        model.objects.bulk_create(objects)
+        return
+    last_id = model.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    model.objects.bulk_create(objects)
+    new_ids = scope.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)
+    new_ids = list(new_ids)
+    if len(new_ids) != len(objects):
+        raise IntegrityError("%d %s rows were inserted, but %d new ones were found" % (
+                len(objects), model.__name__, len(new_ids)))
+    for obj, new_id in zip(objects, new_ids):
+        obj.id = new_id
+
+
+def historical_records(objects, history_type='+'):
+    """Unsaved simple_history records for objects created in bulk."""
+    if not objects:
+        return []
+    model = objects[0].__class__
+    HistoricalModel = model.history.model
+    history_date = now()
+    attnames = [field.attname for field in model._meta.fields]
+    return [HistoricalModel(
+                history_date=history_date,
+                history_type=history_type,
+                history_user=None,
+                history_change_reason=None,
+                **dict((attname, getattr(obj, attname)) for attname in attnames)
+            ) for obj in objects]
+
+
+def entry_hash(entry):
+    """A hash of everything that is imported from a parsed termEntry."""
+    content = [
+        sorted(entry["relations"]),
+        [(d.language_id, d.text, d.source) for d in entry["definitions"]],
+        [(r.language_id, r.address, r.link_type_id, r.description)
+            for r in entry["resources"]],
+        [(t.language_id, t.translation_text, t.is_finalized,
+          t.administrative_status_id, t.administrative_status_reason_id,
+          t.part_of_speech_id, t.grammatical_gender_id,
+          t.grammatical_number_id, t.note,
+          [s.text for s in sentences],
+          [(e.address, e.description) for e in examples])
+            for (t, sentences, examples) in entry["translations"]],
+    ]
+    return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+IMPORT_BATCH_SIZE = 500
+
+# Longer termEntry ids are cut to this length to fit in Concept.tbx_id, both
+# where they are defined and where they are referred to.
+TBX_ID_LENGTH = Concept._meta.get_field('tbx_id').max_length
+
+# The fields of a Translation that come from the TBX file
+TRANSLATION_FIELDS = (
+        'is_finalized',
+        'administrative_status_id',
+        'administrative_status_reason_id',
+        'part_of_speech_id',
+        'grammatical_gender_id',
+        'grammatical_number_id',
+        'note',
+)
 
-    #glossary_name = getText(tbx_file.getElementsByTagName(u"title")[0].childNodes)
-    #glossary_description = getText(tbx_file.getElementsByTagName(u"p")[0].childNodes)
-    #imported_glossary.name = glossary_name
-    #imported_glossary.description = glossary_description
-    #imported_glossary.save()
 
-    # Keep all of these in memory for repeated use.
-    languages = set(Language.objects.all().values_list('iso_code', flat=True))
-    parts_of_speech = lookup_dict(PartOfSpeech)
-    admin_statusses = lookup_dict(AdministrativeStatus, values=False)
-    genders = lookup_dict(GrammaticalGender)
-    numbers = lookup_dict(GrammaticalNumber)
-    link_types = lookup_dict(ExternalLinkType)
-
-    concept_object = None
-    concept_list = []
-    concept_pool = {}
-    language_pool = set()
-    for concept_tag in tbx_file.getElementsByTagName(u"termEntry"):
-        concept_id = concept_tag.getAttribute(u"id")
+class TBXImporter(object):
+    """
+    Import the termEntry elements of a TBX file into a glossary.
+
+    Concepts are parsed one by one, but written to the database in batches of
+    batch_size concepts with bulk_create(), so that the number of queries
+    depends on the number of batches instead of the number of rows. Relations
+    between concepts are set once all the concepts are in the database, since
+    termEntries can refer to termEntries later in the file.
+
+    With merge=True the termEntries are matched on their id with the concepts
+    already in the glossary. Concepts with unchanged contents are skipped,
+    changed ones are updated in place (keeping their URLs and definition
+    history) and the rest are added. Concepts missing from the file are left
+    alone.
+
+    The import has to run in a transaction, which locks the glossary until it
+    commits.
+    """
+
+    def __init__(self, glossary, batch_size=IMPORT_BATCH_SIZE, progress=None, merge=False):
+        # Adding concepts to the glossary waits for the lock (foreign keys
+        # lock the row they refer to), so that the ids of the new rows can be
+        # found (see bulk_create_with_ids()), and merges see all the concepts.
+        Glossary.objects.select_for_update().filter(pk=glossary.pk).exists()
+        self.glossary = glossary
+        self.batch_size = batch_size
+        self.merge = merge
+        # Called with the importer after every batch
+        self.progress = progress
+
+        # Keep all of these in memory for repeated use.
+        self.languages = set(Language.objects.all().values_list('iso_code', flat=True))
+        self.parts_of_speech = lookup_dict(PartOfSpeech)
+        self.admin_statusses = lookup_dict(AdministrativeStatus, values=False)
+        self.genders = lookup_dict(GrammaticalGender)
+        self.numbers = lookup_dict(GrammaticalNumber)
+        self.link_types = lookup_dict(ExternalLinkType)
+        self.reasons = dict((r.name.lower(), r) for r in AdministrativeStatusReason.objects.all())
+
+        # TBX id -> database id of all the concepts (None until written)
+        self.concept_ids = {}
+        # TBX id -> (database id, import_hash) of the concepts to merge into
+        self.existing = {}
+        if merge:
+            existing = list(Concept.objects.filter(glossary=glossary).values_list('id', 'tbx_id', 'import_hash'))
+            # Our own exports use ids like "cid-123", so concepts that were not
+            # imported can still be matched. They have no import_hash, so they
+            # always count as changed. The hash only covers what is imported
+            # from a termEntry (see entry_hash()), so other changes to the
+            # file, and changes made here since the last import, don't make a
+            # concept count as changed.
+            for (concept_id, tbx_id, import_hash) in existing:
+                self.existing["cid-%d" % concept_id] = (concept_id, import_hash)
+            for (concept_id, tbx_id, import_hash) in existing:
+                if tbx_id:
+                    self.existing[tbx_id] = (concept_id, import_hash)
+            self.concept_ids.update((key, value[0]) for key, value in self.existing.items())
+        self.seen_keys = set()
+        # Database ids of the concepts that were added or changed
+        self.touched = set()
+        # (TBX id, relation type, TBX id of the other concept)
+        self.relations = []
+        self.language_pool = set()
+        self.concept_count = 0
+        self.created_count = 0
+        self.updated_count = 0
+        self.batch = []
+
+    def import_file(self, tbx_file):
+        for concept_tag in iter_term_entries(tbx_file):
+            self.add_term_entry(concept_tag)
+        self.finish()
+
+    def add_term_entry(self, concept_tag):
+        entry = self.parse_term_entry(concept_tag)
+        self.relations.extend(entry["relations"])
+        entry["concept"].import_hash = entry_hash(entry)
+        self.batch.append(entry)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def parse_term_entry(self, concept_tag):
+        """Build the unsaved objects for one termEntry element."""
+        concept_id = concept_tag.get(u"id", u"")[:TBX_ID_LENGTH]
+        # ElementTree doesn't know the parent of an element, so keep a map for
+        # the elements in this termEntry.
+        parents = dict((child, parent) for parent in concept_tag.iter() for child in parent)
         # The concept id should be unique on all the TBX file.
-        if concept_id in concept_pool:
+        if concept_id in self.seen_keys:
             excp_msg = (_("There is already another \"%s\" tag with an "
                           "\"%s\" attribute with the value \"%s\" in the "
                           "TBX file.") %
@@ -91,16 +267,25 @@ def import_uploaded_file(uploaded_file, imported_glossary):
             excp_msg += force_text(_("\n\nIf you want to import this TBX file"
                                   " you must fix this in the TBX file."))
             raise Exception(excp_msg)
-        concept_object = Concept(glossary=imported_glossary)
-        concept_object.save()
-        concept_pool_entry = {"object": concept_object}
+        entry = {
+            "key": concept_id,
+            "concept": Concept(glossary=self.glossary, tbx_id=concept_id),
+            "relations": [],
+            "definitions": [],
+            "resources": [],
+            "translations": [],
+            "src_translations": [],
+        }
+        if concept_id:
+            self.seen_keys.add(concept_id)
+            self.concept_ids.setdefault(concept_id, None)
 
         # Get the subject field and broader concept for the current
         # termEntry tag.
         # NOTE: Be careful because the following returns all the descrip
         # tags, even from langSet or lower levels.
-        for descrip_tag in concept_tag.getElementsByTagName(u"descrip"):
-            if descrip_tag.getAttribute("type") == "subjectField":
+        for descrip_tag in concept_tag.iter(u"descrip"):
+            if descrip_tag.get(u"type", u"") == "subjectField":
                 # Only accept subjectFields that are inside a descripGrp
                 # and that have a sibling ref tag pointing to a concept.
                 # NOTE: This means that the subjectFields are other
@@ -109,39 +294,28 @@ def import_uploaded_file(uploaded_file, imported_glossary):
                 #TODO Consider if it would be worth raising an exception
                 # with an explanatory message in the case that it is not
                 # inside a descripGrp tag.
-                if descrip_tag.parentNode.tagName == "descripGrp":
-                    ref_tags = descrip_tag.parentNode.getElementsByTagName(u"ref")
+                if parents[descrip_tag].tag == "descripGrp":
+                    ref_tags = list(parents[descrip_tag].iter(u"ref"))
                     if ref_tags:
                         # Only the first ref tag in the descripGrp is used.
-                        concept_pool_entry["subject"] = ref_tags[0].getAttribute(u"target")
-            if descrip_tag.getAttribute(u"type") == u"broaderConceptGeneric":
-                broader = descrip_tag.getAttribute(u"target")
+                        subject = ref_tags[0].get(u"target", u"")[:TBX_ID_LENGTH]
+                        entry["relations"].append((concept_id, "subject", subject))
+            if descrip_tag.get(u"type", u"") == u"broaderConceptGeneric":
+                broader = descrip_tag.get(u"target", u"")[:TBX_ID_LENGTH]
                 if broader:
-                    concept_pool_entry["broader"] = broader
+                    entry["relations"].append((concept_id, "broader", broader))
 
         # Get the related concepts information for the current termEntry.
-        concept_pool_entry["related"] = []
-        for ref_tag in concept_tag.getElementsByTagName(u"ref"):
-            if ref_tag.getAttribute(u"type") == u"crossReference":
+        for ref_tag in concept_tag.iter(u"ref"):
+            if ref_tag.get(u"type", u"") == u"crossReference":
                 # The crossReference should be just below the termEntry tag.
-                if ref_tag.parentNode == concept_tag:
-                    related_key = ref_tag.getAttribute(u"target")
+                if parents[ref_tag] == concept_tag:
+                    related_key = ref_tag.get(u"target", u"")[:TBX_ID_LENGTH]
                     if related_key:
-                        concept_pool_entry["related"].append(related_key)
-        # If the termEntry has no related concepts remove the key related
-        # from concept_pool_entry.
-        if not concept_pool_entry["related"]:
-            concept_pool_entry.pop("related")
-
-        concept_list.append(concept_object)
-        # Save all the concept relations for setting them when the TBX file
-        # is fully readed.
-        if concept_id:
-            concept_pool[concept_id] = concept_pool_entry
+                        entry["relations"].append((concept_id, "related", related_key))
 
-        src_translations = []
-        for language_tag in concept_tag.getElementsByTagName(u"langSet"):
-            lang_id = language_tag.getAttribute(u"xml:lang")
+        for language_tag in concept_tag.iter(u"langSet"):
+            lang_id = language_tag.get(XML_LANG, u"")
             if not lang_id:
                 excp_msg = (_("\"%s\" tag without \"%s\" attribute in "
                               "concept \"%s\".") %
@@ -150,7 +324,7 @@ def import_uploaded_file(uploaded_file, imported_glossary):
                                       "file you must add that attribute "
                                       "to that tag in the TBX file."))
                 raise Exception(excp_msg)
-            if lang_id not in languages:
+            if lang_id not in self.languages:
                 excp_msg = (_("\"%s\" tag with code \"%s\" in its \"%s\" "
                               "attribute, found in concept \"%s\", but "
                               "there is no Language with that code in "
@@ -164,46 +338,44 @@ def import_uploaded_file(uploaded_file, imported_glossary):
                                     ("xml:lang", "langSet"))
                 raise Exception(excp_msg)
 
-            language_pool.add(lang_id)
+            self.language_pool.add(lang_id)
             # Get the definition for each language.
             # NOTE: Be careful because the following returns all the
             # descrip tags, and not all of them are definitions.
-            for descrip_tag in language_tag.getElementsByTagName(u"descrip"):
-                descrip_type = descrip_tag.getAttribute(u"type")
+            for descrip_tag in language_tag.iter(u"descrip"):
+                descrip_type = descrip_tag.get(u"type", u"")
                 if descrip_type == u"definition":
-                    definition_text = getText(descrip_tag.childNodes)
+                    definition_text = getText(descrip_tag)
                     if definition_text:
                         definition_object = Definition(
-                                concept=concept_object,
                                 language_id=lang_id,
                                 text=definition_text,
                                 is_finalized=False,
                         )
-                        definition_object._history_user = None
                         # If the definition is inside a descripGrp tag, it
                         # may have a source.
-                        if descrip_tag.parentNode.tagName == "descripGrp":
-                            definition_source_list = descrip_tag.parentNode.getElementsByTagName(u"xref")
+                        if parents[descrip_tag].tag == "descripGrp":
+                            definition_source_list = list(parents[descrip_tag].iter(u"xref"))
                             if definition_source_list:
                                 #TODO There is no check to see if this xref
                                 # xref tag has type="xSource".
-                                definition_object.source = definition_source_list[0].getAttribute(u"target")
-                        definition_object.save()
+                                definition_object.source = definition_source_list[0].get(u"target", u"")
+                        entry["definitions"].append(definition_object)
                     # Each langSet should have at most one definition, and
                     # since Terminator doesn't import other descrip tags at
                     # langSet level then stop looping.
                     break
 
             # Get the external resources for each language.
-            for xref_tag in language_tag.getElementsByTagName(u"xref"):
+            for xref_tag in language_tag.iter(u"xref"):
                 # If the xref tag is a child of the langSet tag, or in
                 # other words, if the xref tag is not inside a descripGrp
                 # tag alongside a definition in order to provide the source
                 # for that definition.
-                if xref_tag.parentNode == language_tag:
-                    resource_type = xref_tag.getAttribute(u"type").lower()
+                if parents[xref_tag] == language_tag:
+                    resource_type = xref_tag.get(u"type", u"").lower()
                     try:
-                        resource_link_type = link_types[resource_type]
+                        resource_link_type = self.link_types[resource_type]
                     except KeyError:
                         excp_msg = (_("External Link Type \"%s\", found "
                                       "inside a \"%s\" tag in the \"%s\" "
@@ -218,26 +390,25 @@ def import_uploaded_file(uploaded_file, imported_glossary):
                                               "External Link Type on the "
                                               "TBX file."))
                         raise Exception(excp_msg)
-                    resource_target = xref_tag.getAttribute(u"target")
-                    resource_description = getText(xref_tag.childNodes)
+                    resource_target = xref_tag.get(u"target", u"")
+                    resource_description = getText(xref_tag)
                     # TODO If resource_description doesn't exist raise an
                     # exception.
                     if resource_target and resource_description:
                         external_resource_object = ExternalResource(
-                                concept=concept_object,
                                 language_id=lang_id,
                                 address=resource_target,
                                 link_type_id=resource_link_type,
                                 description=resource_description,
                         )
-                        external_resource_object.save()
+                        entry["resources"].append(external_resource_object)
 
             # Get the translations and related data for each language.
-            tig_tags = language_tag.getElementsByTagName(u"tig")
+            tig_tags = language_tag.iter(u"tig")
             #TODO Make the import work for ntig tags too.
 
             for translation_tag in tig_tags:
-                term_tags = translation_tag.getElementsByTagName(u"term")
+                term_tags = list(translation_tag.iter(u"term"))
                 # Proceed only if there is at least one term tag inside
                 # this tig or ntig tag.
                 if not term_tags:
@@ -245,18 +416,18 @@ def import_uploaded_file(uploaded_file, imported_glossary):
 
                 # The next line only works with the first term tag
                 # skipping other term tags if present.
-                translation_text = getText(term_tags[0].childNodes)
+                translation_text = getText(term_tags[0])
                 if translation_text:
                     translation_object = Translation(
-                            concept=concept_object,
                             language_id=lang_id,
                             translation_text=translation_text,
+                            search_key=make_search_key(translation_text),
                     )
-                    if lang_id == imported_glossary.source_language_id:
-                        src_translations.append(translation_object)
+                    if lang_id == self.glossary.source_language_id:
+                        entry["src_translations"].append(translation_object)
 
-                for termnote_tag in translation_tag.getElementsByTagName(u"termNote"):
-                    termnote_type = termnote_tag.getAttribute(u"type")
+                for termnote_tag in translation_tag.iter(u"termNote"):
+                    termnote_type = termnote_tag.get(u"type", u"")
                     #TODO the Parts of Speech, Grammatical Genders,
                     # Grammatical Numbers, Administrative Statuses and
                     # Administrative Status Reasons specified in the
@@ -274,9 +445,9 @@ def import_uploaded_file(uploaded_file, imported_glossary):
                         # Speech is capitalized it should be converted
                         # to lowercase in the next line in order to get
                         # the Part of Speech import working.
-                        pos_text = getText(termnote_tag.childNodes)
+                        pos_text = getText(termnote_tag)
                         try:
-                            pos_id = parts_of_speech[pos_text.lower()]
+                            pos_id = self.parts_of_speech[pos_text.lower()]
                         except KeyError:
                             raise Exception(_("Part of Speech \"%s\", "
                                               "found in \"%s\" "
@@ -296,9 +467,9 @@ def import_uploaded_file(uploaded_file, imported_glossary):
 
                         translation_object.part_of_speech_id = pos_id
                     elif termnote_type == u"grammaticalGender":
-                        gramm_gender_text = getText(termnote_tag.childNodes)
+                        gramm_gender_text = getText(termnote_tag)
                         try:
-                            gender_id = genders[gramm_gender_text.lower()]
+                            gender_id = self.genders[gramm_gender_text.lower()]
                         except KeyError:
                             raise Exception(_("Grammatical Gender "
                                               "\"%s\", found in \"%s\""
@@ -318,9 +489,9 @@ def import_uploaded_file(uploaded_file, imported_glossary):
                                              lang_id, concept_id))
                         translation_object.grammatical_gender_id = gender_id
                     elif termnote_type == u"grammaticalNumber":
-                        gramm_number_text = getText(termnote_tag.childNodes)
+                        gramm_number_text = getText(termnote_tag)
                         try:
-                            number_id = numbers[gramm_number_text.lower()]
+                            number_id = self.numbers[gramm_number_text.lower()]
                         except KeyError:
                             raise Exception(_("Grammatical Number "
                                               "\"%s\", found in \"%s\""
@@ -342,12 +513,12 @@ def import_uploaded_file(uploaded_file, imported_glossary):
                     elif termnote_type == u"processStatus":
                         # Values of processStatus different from
                         # finalized are ignored.
-                        if getText(termnote_tag.childNodes) == u"finalized":
+                        if getText(termnote_tag) == u"finalized":
                             translation_object.is_finalized = True
                     elif termnote_type == u"administrativeStatus":
-                        admin_status_text = getText(termnote_tag.childNodes)
+                        admin_status_text = getText(termnote_tag)
                         try:
-                            admin_status = admin_statusses[admin_status_text.lower()]
+                            admin_status = self.admin_statusses[admin_status_text.lower()]
                         except KeyError:
                             raise Exception(_("Administrative Status "
                                               "\"%s\", found in \"%s\""
@@ -369,22 +540,20 @@ def import_uploaded_file(uploaded_file, imported_glossary):
                         # If the Administrative Status is inside a
                         # termGrp tag it may have an Administrative
                         # Status Reason.
-                        if admin_status.allows_reason and termnote_tag.parentNode != translation_tag:
-                            reason_tag_list = termnote_tag.parentNode.getElementsByTagName(u"note")
+                        if admin_status.allows_reason and parents[termnote_tag] != translation_tag:
+                            reason_tag_list = list(parents[termnote_tag].iter(u"note"))
                             if reason_tag_list:
-                                try:
-                                    reason_object = AdministrativeStatusReason.objects.get(name__iexact=getText(reason_tag_list[0].childNodes))
-                                except AdministrativeStatusReason.DoesNotExist:
-                                    pass #TODO Raise an exception
-                                else:
+                                reason_object = self.reasons.get(getText(reason_tag_list[0]).lower())
+                                if reason_object is not None:
                                     translation_object.administrative_status_reason = reason_object
+                                #TODO Raise an exception for unknown reasons
                     elif termnote_type == u"termType":
                         # It might be phraseologicalUnit, acronym or
                         # abbreviation that in Terminator are internally
                         # represented as PartOfSpeech objects.
-                        termtype_text = getText(termnote_tag.childNodes)
+                        termtype_text = getText(termnote_tag)
                         try:
-                            pos_id = parts_of_speech[pos_text.lower()]
+                            pos_id = self.parts_of_speech[pos_text.lower()]
                         except KeyError:
                             raise Exception(_("TermType \"%s\", found "
                                               "in \"%s\" translation "
@@ -406,11 +575,11 @@ def import_uploaded_file(uploaded_file, imported_glossary):
                                              lang_id, concept_id))
                         translation_object.part_of_speech_id = pos_id
 
-                for note_tag in translation_tag.getElementsByTagName(u"note"):
+                for note_tag in translation_tag.iter(u"note"):
                     # Ensure that this note tag is not at lower levels
                     # inside the translation tag.
-                    if note_tag.parentNode == translation_tag:
-                        note_text = getText(note_tag.childNodes)
+                    if parents[note_tag] == translation_tag:
+                        note_text = getText(note_tag)
                         if note_text:
                             translation_object.note = note_text
                         # Each translation should have at most one
@@ -423,113 +592,432 @@ def import_uploaded_file(uploaded_file, imported_glossary):
                     translation_object.grammatical_gender = None
                     translation_object.grammatical_number = None
 
-                # Save the translation because the next tags can create
-                # objects that will refer to the translation object and
-                # thus it should have an id set.
-                translation_object.save(update_repr_cache=False)
-
                 # Get the context phrase for the current translation.
-                for descrip_tag in translation_tag.getElementsByTagName(u"descrip"):
-                    descrip_type = descrip_tag.getAttribute(u"type")
+                context_sentences = []
+                for descrip_tag in translation_tag.iter(u"descrip"):
+                    descrip_type = descrip_tag.get(u"type", u"")
                     if descrip_type == u"context":
                         phrase_object = ContextSentence(
-                                translation=translation_object,
-                                text=getText(descrip_tag.childNodes),
+                                text=getText(descrip_tag),
                         )
-                        phrase_object.save()
+                        context_sentences.append(phrase_object)
 
                 # Get the corpus examples for the current translation.
-                for xref_tag in translation_tag.getElementsByTagName(u"xref"):
-                    xref_type = xref_tag.getAttribute(u"type")
+                corpus_examples = []
+                for xref_tag in translation_tag.iter(u"xref"):
+                    xref_type = xref_tag.get(u"type", u"")
                     if xref_type == u"corpusTrace":
-                        xref_target = xref_tag.getAttribute(u"target")
-                        xref_description = getText(xref_tag.childNodes)
+                        xref_target = xref_tag.get(u"target", u"")
+                        xref_description = getText(xref_tag)
                         if xref_target and xref_description:
                             corpus_example_object = CorpusExample(
-                                    translation=translation_object,
                                     address=xref_target,
                                     description=xref_description,
                             )
-                            corpus_example_object.save()
+                            corpus_examples.append(corpus_example_object)
 
-            if src_translations:
-                concept_object.repr_cache = concept_object.repr_from(src_translations)
+                entry["translations"].append((translation_object, context_sentences, corpus_examples))
+        return entry
 
-    #populate glossary.other_languages
-    source_lang = imported_glossary.source_language_id
-    if source_lang in language_pool:
-        language_pool.remove(source_lang)
-    imported_glossary.other_languages.add(*Language.objects.filter(iso_code__in=language_pool))
+    def merge_changed(self, entries):
+        """
+        Bring the existing data of changed concepts in line with the entries.
 
-    # Once the file has been completely parsed is time to add the concept
-    # relationships and save the concepts. This is done this way since some
-    # termEntry refer to termEntries that haven't been parsed yet.
-    try:
-        for concept_key, current in concept_pool.items():
-            if "subject" in current:
-                try:
-                    current["object"].subject_field = concept_pool[current["subject"]]["object"]
-                except KeyError:
+        Translations and definitions that are still in the file are updated in
+        place and get their ids set, the ones that are gone are deleted. The
+        rest of the entry data is simply replaced.
+        """
+        concept_ids = [entry["concept"].id for entry in entries]
+        old_translations = {}
+        for translation in Translation.objects.filter(concept_id__in=concept_ids):
+            key = (translation.concept_id, translation.language_id, translation.translation_text)
+            old_translations.setdefault(key, []).append(translation)
+        old_definitions = dict(
+                ((d.concept_id, d.language_id), d) for d in
+                Definition.objects.filter(concept_id__in=concept_ids)
+        )
+        for entry in entries:
+            concept_id = entry["concept"].id
+            for translation, _sentences, _examples in entry["translations"]:
+                key = (concept_id, translation.language_id, translation.translation_text)
+                if not old_translations.get(key):
+                    continue
+                old = old_translations[key].pop(0)
+                translation.id = old.id
+                translation.concept_id = concept_id
+                if any(getattr(old, f) != getattr(translation, f) for f in TRANSLATION_FIELDS):
+                    translation.save(update_repr_cache=False)
+            for definition in entry["definitions"]:
+                old = old_definitions.pop((concept_id, definition.language_id), None)
+                if old is None:
+                    continue
+                definition.id = old.id
+                definition.concept_id = concept_id
+                definition.is_finalized = old.is_finalized
+                if (old.text, old.source) != (definition.text, definition.source):
+                    # Recorded in the history as a change
+                    definition.save()
+
+        removed = list(itertools.chain.from_iterable(old_translations.values()))
+        # flush() only sets the repr_cache of concepts that still have source
+        # terms.
+        source_language_id = self.glossary.source_language_id
+        repr_cache_changed(set(t.concept_id for t in removed if t.language_id == source_language_id))
+        removed = [t.pk for t in removed]
+        for i in range(0, len(removed), 300):
+            Translation.objects.filter(pk__in=removed[i:i+300]).delete()
+        for definition in old_definitions.values():
+            definition.delete()
+        ContextSentence.objects.filter(translation__concept_id__in=concept_ids).delete()
+        CorpusExample.objects.filter(translation__concept_id__in=concept_ids).delete()
+        ExternalResource.objects.filter(concept_id__in=concept_ids).delete()
+        # New terms and definitions are added in bulk, without signals
+        snapshots = ConceptSnapshot.objects.filter(concept_id__in=concept_ids)
+        snapshots_changed(snapshots.values_list('concept_id', 'language_id'))
+        snapshots.delete()
+        bulk_update_field(Concept, 'import_hash',
+                dict((entry["concept"].id, entry["concept"].import_hash) for entry in entries))
+
+    def flush(self):
+        """Write the buffered concepts and their data to the database."""
+        if not self.batch:
+            return
+        new_entries = []
+        changed_entries = []
+        for entry in self.batch:
+            concept_id, import_hash = (None, None)
+            if entry["key"]:
+                concept_id, import_hash = self.existing.get(entry["concept"].tbx_id, (None, None))
+            if concept_id is None:
+                new_entries.append(entry)
+            elif import_hash != entry["concept"].import_hash:
+                entry["concept"].id = concept_id
+                changed_entries.append(entry)
+        concepts = [entry["concept"] for entry in new_entries]
+        bulk_create_with_ids(Concept, concepts, Concept.objects.filter(glossary=self.glossary))
+        if changed_entries:
+            self.merge_changed(changed_entries)
+        entries = new_entries + changed_entries
+
+        definitions = []
+        resources = []
+        translations = []
+        repr_caches = {}
+        # Nothing else builds the snapshots of concepts that were imported
+        snapshots = set()
+        for entry in entries:
+            concept = entry["concept"]
+            self.touched.add(concept.id)
+            snapshots.add((concept.id, self.glossary.source_language_id))
+            if entry["key"]:
+                self.concept_ids[entry["key"]] = concept.id
+            for obj in itertools.chain(entry["definitions"], entry["resources"]):
+                obj.concept_id = concept.id
+            definitions.extend(d for d in entry["definitions"] if d.id is None)
+            resources.extend(entry["resources"])
+            for translation, _sentences, _examples in entry["translations"]:
+                translation.concept_id = concept.id
+                snapshots.add((concept.id, translation.language_id))
+                if translation.id is None:
+                    translations.append(translation)
+            snapshots.update((concept.id, d.language_id) for d in entry["definitions"])
+            if entry["src_translations"]:
+                repr_caches[concept.id] = concept.repr_from(entry["src_translations"])
+
+        # The ids of the translations are only needed if something refers to
+        # them.
+        translation_scope = None
+        if any(sentences or examples for _t, sentences, examples in
+                itertools.chain.from_iterable(e["translations"] for e in entries)):
+            translation_scope = Translation.objects.filter(concept__glossary=self.glossary)
+        bulk_create_with_ids(Translation, translations, translation_scope)
+        context_sentences = []
+        corpus_examples = []
+        for entry in entries:
+            for translation, sentences, examples in entry["translations"]:
+                for obj in itertools.chain(sentences, examples):
+                    obj.translation_id = translation.id
+                context_sentences.extend(sentences)
+                corpus_examples.extend(examples)
+        ContextSentence.objects.bulk_create(context_sentences)
+        CorpusExample.objects.bulk_create(corpus_examples)
+
+        bulk_create_with_ids(Definition, definitions,
+                Definition.objects.filter(concept__glossary=self.glossary))
+        Definition.history.model.objects.bulk_create(historical_records(definitions))
+        ExternalResource.objects.bulk_create(resources)
+        bulk_update_field(Concept, 'repr_cache', repr_caches)
+        navigation_changed(self.glossary.id)
+        snapshots_changed(snapshots)
+
+        self.concept_count += len(self.batch)
+        self.created_count += len(new_entries)
+        self.updated_count += len(changed_entries)
+        self.batch = []
+        if self.progress:
+            self.progress(self)
+
+    def finish(self):
+        """Write what is left, and set the relations between concepts."""
+        self.flush()
+
+        #populate glossary.other_languages
+        source_lang = self.glossary.source_language_id
+        self.language_pool.discard(source_lang)
+        self.glossary.other_languages.add(*Language.objects.filter(iso_code__in=self.language_pool))
+
+        # Now that all the concepts are in the database we can resolve the
+        # references between them. Nothing is written before all of them are
+        # checked.
+        # Relations of merged concepts are replaced, so they start out empty.
+        subject_fields = dict.fromkeys(self.touched)
+        broader_concepts = dict.fromkeys(self.touched)
+        related_pairs = set()
+        for concept_key, relation, other_key in self.relations:
+            if not concept_key:
+                # A termEntry without id can't be referred to, and its
+                # relations were never imported.
+                continue
+            other_id = self.concept_ids.get(other_key)
+            if other_id is None:
+                if relation == "subject":
                     excp_msg = (_("The concept \"%s\" uses the concept"
                                   " \"%s\" as its subject field, but that "
                                   "concept id doesn't exist in the TBX "
                                   "file.") %
-                                (concept_key, current["subject"]))
-                    excp_msg += force_text(_("\n\nIf you want to import this "
-                                          "TBX file you must fix this."))
-                    raise Exception(excp_msg)
-            if "broader" in current:
-                try:
-                    current["object"].broader_concept = concept_pool[current["broader"]]["object"]
-                except KeyError:
+                                (concept_key, other_key))
+                elif relation == "broader":
                     excp_msg = (_("The concept \"%s\" uses the concept"
                                   " \"%s\" as its broader concept, but "
                                   "that concept id doesn't exist in the "
                                   "TBX file.") %
-                                (concept_key, current["broader"]))
-                    excp_msg += force_text(_("\n\nIf you want to import this "
-                                          "TBX file you must fix this."))
-                    raise Exception(excp_msg)
-            if "related" in current:
-                for related_key in current["related"]:
-                    try:
-                        current["object"].related_concepts.add(concept_pool[related_key]["object"])
-                    except KeyError:
-                        excp_msg = (_("The concept \"%s\" uses the concept"
-                                      " \"%s\" as one of its related "
-                                      "concepts (cross reference), but "
-                                      "that concept id doesn't exist in "
-                                      "the TBX file.") %
-                                    (concept_key, related_key))
-                        excp_msg += force_text(_("\n\nIf you want to import "
-                                              "this TBX file you must fix "
-                                              "this."))
-                        raise Exception(excp_msg)
-            # Save the concept object once its relationships with other
-            # concepts in the glossary are set.
-            # TODO Save the concept object only if it is changed.
-            current["object"].save()
-    except:
-        # In case of failure during the concept relationships assignment
-        # the subject_field and broader_concept must be set to None in
-        # order to delete all the glossary data because this two fields
-        # have on_delete=models.PROTECT
-        for concept_dict in concept_pool.values():
-            concept = concept_dict["object"]
-            concept.subject_field = None
-            concept.broader_concept = None
-            # The next line is unnecessary, but keep it because in the
-            # future it might be necessary.
-            #concept.related_concepts.clear()
-            concept.save()
-        # Raise the exception again in order to show the error in the UI.
-        raise
-
-    if len(concept_pool) == 0 and concept_object:
-        # Nothing was added to the pool (no IDs?), but there was at least one
-        # concept. We still have to save for the sake of the repr_cache.
-        for concept in concept_list:
-            concept.save()
+                                (concept_key, other_key))
+                else:
+                    excp_msg = (_("The concept \"%s\" uses the concept"
+                                  " \"%s\" as one of its related "
+                                  "concepts (cross reference), but "
+                                  "that concept id doesn't exist in "
+                                  "the TBX file.") %
+                                (concept_key, other_key))
+                excp_msg += force_text(_("\n\nIf you want to import this "
+                                      "TBX file you must fix this."))
+                raise Exception(excp_msg)
+            concept_id = self.concept_ids[concept_key]
+            if relation == "subject":
+                subject_fields[concept_id] = other_id
+            elif relation == "broader":
+                broader_concepts[concept_id] = other_id
+            else:
+                # related_concepts is symmetrical
+                related_pairs.add((concept_id, other_id))
+                related_pairs.add((other_id, concept_id))
+
+        neighbours = set()
+        touched = list(self.touched)
+        if self.merge:
+            # Unchanged concepts keep what they have.
+            subject_fields = dict((k, v) for (k, v) in subject_fields.items() if k in self.touched)
+            broader_concepts = dict((k, v) for (k, v) in broader_concepts.items() if k in self.touched)
+            # Unchanged concepts that showed the old relations of changed ones
+            for i in range(0, len(touched), 300):
+                neighbours.update(neighbour_concept_ids(touched[i:i+300]))
+        else:
+            # New concepts have no relations to clear.
+            subject_fields = dict((k, v) for (k, v) in subject_fields.items() if v)
+            broader_concepts = dict((k, v) for (k, v) in broader_concepts.items() if v)
+        bulk_update_field(Concept, 'subject_field', subject_fields)
+        bulk_update_field(Concept, 'broader_concept', broader_concepts)
+        Through = Concept.related_concepts.through
+        if self.merge:
+            # Only the relations of added or changed concepts are replaced.
+            related_pairs = set(pair for pair in related_pairs if pair[0] in self.touched or pair[1] in self.touched)
+            for i in range(0, len(touched), 300):
+                ids = touched[i:i+300]
+                Through.objects.filter(Q(from_concept_id__in=ids) | Q(to_concept_id__in=ids)).delete()
+        Through.objects.bulk_create([
+            Through(from_concept_id=from_id, to_concept_id=to_id)
+            for (from_id, to_id) in sorted(related_pairs)
+        ])
+        if self.merge:
+            # and the ones that show the new relations. The snapshots of the
+            # imported concepts are built anyway (see flush()).
+            for i in range(0, len(touched), 300):
+                neighbours.update(neighbour_concept_ids(touched[i:i+300]))
+            neighbours = list(neighbours - self.touched)
+            for i in range(0, len(neighbours), 300):
+                outdate_snapshots(ConceptSnapshot.objects.filter(concept__in=neighbours[i:i+300]))
+        # Nothing above sends signals, so mark the change ourselves.
+        Glossary.objects.filter(pk=self.glossary.pk).update(last_modified=now())
+        translations_changed()
+
+
+def import_uploaded_file(uploaded_file, imported_glossary, batch_size=IMPORT_BATCH_SIZE):
+    #TODO Validate the uploaded file in order to check that it is a valid TBX
+    # file, or even a text file.
+
+    #TODO Perhaps add the title and description from the TBX file to the
+    # glossary instead of using the ones provided in the import form. Or maybe
+    # just append the TBX values (if provided) to the description (only the
+    # description) provided in the import form.
+
+    #glossary_name = getText(tbx_file.getElementsByTagName(u"title")[0].childNodes)
+    #glossary_description = getText(tbx_file.getElementsByTagName(u"p")[0].childNodes)
+    #imported_glossary.name = glossary_name
+    #imported_glossary.description = glossary_description
+    #imported_glossary.save()
+
+    importer = TBXImporter(imported_glossary, batch_size=batch_size)
+    importer.import_file(uploaded_file)
+    return importer
+
+
+# A running job is claimed again if its worker didn't update the heartbeat
+# for this many seconds, since the worker probably died. The import of the
+# dead worker was rolled back with its transaction.
+IMPORT_JOB_TIMEOUT = 10 * 60
+IMPORT_JOB_HEARTBEAT_INTERVAL = 60
+
+
+def claim_import_job():
+    """
+    Mark the oldest pending (or abandoned) ImportJob as running and return
+    it.
+    """
+    abandoned = now() - timedelta(seconds=IMPORT_JOB_TIMEOUT)
+    claimable = ImportJob.objects.filter(
+            Q(status=ImportJob.PENDING) |
+            Q(status=ImportJob.RUNNING, heartbeat__lt=abandoned) |
+            # Claimed before jobs had heartbeats
+            Q(status=ImportJob.RUNNING, heartbeat=None, started__lt=abandoned)
+    )
+    for job in claimable.order_by('id')[:10]:
+        # Another worker might have claimed it in the mean time.
+        claimed = claimable.filter(
+                pk=job.pk,
+                status=job.status,
+                heartbeat=job.heartbeat,
+        ).update(status=ImportJob.RUNNING, started=now(), heartbeat=now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+class Heartbeat(threading.Thread):
+    """
+    Update the heartbeat of a running job every IMPORT_JOB_HEARTBEAT_INTERVAL
+    seconds until stopped. This uses the database connection of its own
+    thread, since the transaction of the import hides its changes until the
+    commit.
+
+    Failed updates (like "database is locked" on SQLite, while the import
+    writes) are logged and tried again at the next interval, so that the job
+    is only given up on if they keep failing for IMPORT_JOB_TIMEOUT.
+    """
+
+    def __init__(self, job):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.job_id = job.pk
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(IMPORT_JOB_HEARTBEAT_INTERVAL):
+                try:
+                    ImportJob.objects.filter(
+                            pk=self.job_id,
+                            status=ImportJob.RUNNING,
+                    ).update(heartbeat=now())
+                except OperationalError:
+                    logger.exception("Updating the heartbeat of import job %d failed", self.job_id)
+                    # Start over with a new connection
+                    connection.close()
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def import_glossary(tbx_file, name, description, source_language_id, user_id=None, progress=None):
+    """
+    Create a glossary with the contents of a TBX file and return the
+    importer. The glossary is created in the same transaction as its contents,
+    so it only becomes visible once the whole file is imported.
+    """
+    with transaction.atomic():
+        glossary = Glossary(
+                name=name,
+                description=description,
+                source_language_id=source_language_id,
+        )
+        try:
+            with transaction.atomic():
+                glossary.save()
+        except IntegrityError:
+            # The import form checks this, but another import might have
+            # been faster.
+            raise ValueError(force_text(GLOSSARY_NAME_TAKEN))
+        importer = TBXImporter(glossary, progress=progress)
+        importer.import_file(tbx_file)
+        if user_id:
+            LogEntry.objects.log_action(
+                user_id=user_id,
+                content_type_id=ContentType.objects.get_for_model(glossary).pk,
+                object_id=glossary.pk,
+                object_repr=force_text(glossary),
+                action_flag=ADDITION,
+            )
+    return importer
+
+
+def run_import_job(job):
+    """
+    Import the file of the given ImportJob and record the outcome in the job.
+    """
+    if job.status != ImportJob.RUNNING:
+        job.status = ImportJob.RUNNING
+        job.started = job.heartbeat = now()
+        job.save()
+
+    progress = {}
+
+    def report_progress(importer):
+        progress['concept_count'] = importer.concept_count
+        cache.set(job.progress_cache_key(), importer.concept_count, 24 * 60 * 60)
+
+    heartbeat = Heartbeat(job)
+    heartbeat.start()
+    try:
+        job.imported_file.open('rb')
+        try:
+            importer = import_glossary(
+                    job.imported_file,
+                    job.glossary_name,
+                    job.glossary_description,
+                    job.source_language_id,
+                    user_id=job.user_id,
+                    progress=report_progress,
+            )
+        finally:
+            job.imported_file.close()
+    except Exception as e:
+        job.status = ImportJob.FAILED
+        job.error = force_text(e.args[0]) if e.args else force_text(e)
+        job.concept_count = progress.get('concept_count', 0)
+    else:
+        job.status = ImportJob.SUCCEEDED
+        job.glossary = importer.glossary
+        job.concept_count = importer.concept_count
+    finally:
+        heartbeat.stop()
+    job.finished = now()
+    job.imported_file.delete(save=False)
+    job.save()
+    cache.delete(job.progress_cache_key())
+    return job
 
 
 # TODO: need much better permissions checking:
@@ -543,28 +1031,60 @@ def import_view(request):
     if request.method == 'POST':
         import_form = ImportForm(request.POST, request.FILES)
         if import_form.is_valid():
-            glossary = import_form.save()
-            try:
-                with transaction.atomic():
-                    import_uploaded_file(request.FILES['imported_file'], glossary)
-            except Exception as e:
-                glossary.delete()
-                import_error_message = _("The import process failed:\n\n")
-                import_error_message += force_text(e.args[0])
-                context['import_error_message'] = import_error_message
-            else:
-                import_message = _("TBX file succesfully imported.")
-                context['import_message'] = import_message
-                context['glossary'] = glossary
-                import_form = ImportForm()
-                LogEntry.objects.log_action(
-                    user_id=request.user.pk,
-                    content_type_id=ContentType.objects.get_for_model(glossary).pk,
-                    object_id=glossary.pk,
-                    object_repr=force_text(glossary),
-                    action_flag=ADDITION,
+            data = import_form.cleaned_data
+            if getattr(settings, 'IMPORT_IN_BACKGROUND', False):
+                job = ImportJob(
+                        user=request.user,
+                        imported_file=request.FILES['imported_file'],
+                        glossary_name=data['name'],
+                        glossary_description=data['description'],
+                        source_language=data['source_language'],
                 )
+                job.save()
+                # The job worker (manage.py run_import_jobs) will do the rest.
+                context['import_job'] = job
+                import_form = ImportForm()
+            else:
+                # Imported straight from the upload, without storing it
+                try:
+                    importer = import_glossary(
+                            request.FILES['imported_file'],
+                            data['name'],
+                            data['description'],
+                            data['source_language'].pk,
+                            user_id=request.user.pk,
+                    )
+                except Exception as e:
+                    import_error_message = _("The import process failed:\n\n")
+                    import_error_message += force_text(e.args[0]) if e.args else force_text(e)
+                    context['import_error_message'] = import_error_message
+                else:
+                    import_message = _("TBX file succesfully imported.")
+                    context['import_message'] = import_message
+                    context['glossary'] = importer.glossary
+                    import_form = ImportForm()
     else:
         import_form = ImportForm()
     context['import_form'] = import_form
     return render(request, 'import.html', context)
+
+
+@login_required
+def import_job_status(request, pk):
+    job = get_object_or_404(ImportJob, pk=pk)
+    if job.user_id != request.user.pk and not request.user.is_superuser:
+        raise PermissionDenied
+    elapsed = job.elapsed()
+    if elapsed is not None:
+        elapsed = elapsed.total_seconds()
+    glossary_url = None
+    if job.glossary_id:
+        glossary_url = job.glossary.get_absolute_url()
+    return JsonResponse({
+        'id': job.pk,
+        'status': job.status,
+        'concepts_processed': job.progress(),
+        'elapsed': elapsed,
+        'error': job.error,
+        'glossary': glossary_url,
+    })
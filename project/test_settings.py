@@ -1,3 +1,5 @@
+import tempfile
+
 from settings import *
 
 DATABASES = {
@@ -7,4 +9,6 @@ DATABASES = {
     }
 }
 
-
+MEDIA_ROOT = tempfile.mkdtemp(prefix='terminator-media-')
+# Tests that need it enable it with their own directory
+EXPORT_CACHE_DIR = None